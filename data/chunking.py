@@ -0,0 +1,86 @@
+import re
+
+# Chunkers are generators of {"chunk_id", "text", "start", "end"} dicts. The chunk id is the character offset
+# where the chunk starts, so it is stable for a given text and chunker and never depends on other chunks.
+
+# Input limits of the embedding models, in tokens
+MODEL_MAX_TOKENS = {
+    "intfloat/multilingual-e5-large": 512,
+    "amazon.titan-embed-text-v1": 8192,
+    "textembedding-gecko@001": 3072,
+}
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+|\n\s*\n')
+
+def check_overlap(chunk_size, overlap, unit="characters"):
+    # Windows advance by chunk_size - overlap, so a larger overlap would never move forward
+    if not 0 <= overlap < chunk_size:
+        raise ValueError(f"Chunk overlap must be at least 0 and less than the chunk size of {chunk_size} {unit}, got {overlap}")
+
+def split_characters(text, chunk_size=512, overlap=50):
+    check_overlap(chunk_size, overlap)
+    step = chunk_size - overlap
+    for start in range(0, len(text), step):
+        end = min(start + chunk_size, len(text))
+        yield {"chunk_id": start, "text": text[start:end], "start": start, "end": end}
+        # The next window would only repeat the overlap
+        if end == len(text):
+            break
+
+def split_tokens(text, tokenizer, max_tokens=256, overlap=32):
+    # Windows of max_tokens tokens mapped back to character offsets, so no chunk is silently truncated by the model
+    check_overlap(max_tokens, overlap, "tokens")
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    step = max_tokens - overlap
+    for first in range(0, len(offsets), step):
+        last = min(first + max_tokens, len(offsets)) - 1
+        start, end = offsets[first][0], offsets[last][1]
+        yield {"chunk_id": start, "text": text[start:end], "start": start, "end": end}
+        if last == len(offsets) - 1:
+            break
+
+def split_sentences(text, max_chars=512, overlap=50):
+    # Packs whole sentences into chunks of up to max_chars, starting a new chunk at paragraph breaks. Trailing
+    # sentences of up to overlap characters are repeated at the start of the next chunk. Sentences longer than
+    # max_chars are split by characters.
+    check_overlap(max_chars, overlap)
+    sentences = []
+    position = 0
+    for boundary in SENTENCE_END.finditer(text):
+        sentences.append((position, boundary.start(), "\n\n" in boundary.group()))
+        position = boundary.end()
+    sentences.append((position, len(text), True))
+
+    current = []
+    for start, end, paragraph_end in sentences:
+        if start == end:
+            continue
+        if end - start > max_chars:
+            yield from _flush(text, current)
+            current = []
+            for chunk in split_characters(text[start:end], max_chars, overlap):
+                yield {**chunk, "chunk_id": start + chunk["start"], "start": start + chunk["start"], "end": start + chunk["end"]}
+            continue
+        if current and end - current[0][0] > max_chars:
+            yield from _flush(text, current)
+            current = _overlap(current, overlap)
+            if current and end - current[0][0] > max_chars:
+                current = []
+        current.append((start, end))
+        if paragraph_end:
+            yield from _flush(text, current)
+            current = []
+    yield from _flush(text, current)
+
+def _flush(text, sentences):
+    if sentences:
+        start, end = sentences[0][0], sentences[-1][1]
+        yield {"chunk_id": start, "text": text[start:end], "start": start, "end": end}
+
+def _overlap(sentences, overlap):
+    kept = []
+    for start, end in reversed(sentences):
+        if sentences[-1][1] - start > overlap:
+            break
+        kept.insert(0, (start, end))
+    return kept
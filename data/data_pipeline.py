@@ -1,41 +1,133 @@
 import json
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 import argparse
 import time
-import requests
-import random
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from collections import deque
 from datetime import date
 import os
-from pinecone import Pinecone
-from transformers import AutoModel, AutoTokenizer
-from pinecone import Pinecone
-import pandas as pd
+import sys
+import numpy as np
 import itertools
-import boto3
-from botocore.config import Config
-import vertexai
-from vertexai.preview.language_models import TextEmbeddingModel
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../utils"))
+from vector_files import list_vector_files, write_vector_file, remove_vector_file, iter_vector_records
+from chunking import MODEL_MAX_TOKENS, check_overlap, split_characters, split_tokens, split_sentences
+from providers import get_embedder, load_e5_tokenizer
+from metrics import span, add_span_hook, print_span
+from compression import PROJECTION_METHODS, fit_projection, project_records, save_projection, load_projection
+from pipeline_cache import open_cache, text_hash, get_article, put_article, get_embeddings, put_embeddings, changed_records, mark_upserted, stale_upserts, forget_upserts, clear_upserts
+from pipeline_cache import get_checkpoint, put_checkpoint, mark_written, clear_checkpoint
+from stages import StagedPipeline
+from dedup import Deduplicator
+from pdf_parsing import document_slug, pdf_page_count, extract_pages
 
 # load_dotenv()
 
 API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 PINECONE_NAMESPACE = os.getenv("PINECONE_NAMESPACE")
-AWS_TITAN_ENABLED = os.getenv("AWS_TITAN_ENABLED").lower() == 'true'
-GCP_GEMINI_ENABLED = os.getenv("GCP_GEMINI_ENABLED").lower() == 'true'
 DATA_DIR = os.path.join(os.path.dirname(__file__), "./jsonl")
-GEMINI_PROJECT=os.getenv("GEMINI_PROJECT", "")
-GEMINI_LOCATION=os.getenv("GEMINI_LOCATION", "us-central1")
-GEMINI_MODEL=os.getenv("GEMINI_MODEL", "textembedding-gecko@001")
+NPY_DIR = os.path.join(os.path.dirname(__file__), "./npy")
+# "jsonl", "npy" or "both"; npy stores the vectors as a memory-mappable matrix instead of JSON float lists
+VECTOR_FORMAT = os.getenv("VECTOR_FORMAT", "both")
+# "float32", "float16" or "int8" (scalar quantized per dimension)
+VECTOR_DTYPE = os.getenv("VECTOR_DTYPE", "float32")
+# Written by the compress action; when it exists the npy vectors are projected with it before they are stored
+PROJECTION_PATH = os.getenv("PROJECTION_PATH", os.path.join(NPY_DIR, "projection.npz"))
+# "pca" or "truncate" (Matryoshka models only), and the number of dimensions kept
+COMPRESS_METHOD = os.getenv("COMPRESS_METHOD", "pca")
+COMPRESS_DIMENSIONS = int(os.getenv("COMPRESS_DIMENSIONS", "256"))
+# "characters", "tokens" (embedding model tokenizer) or "sentences"
+CHUNKER = os.getenv("CHUNKER", "characters")
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "512"))
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "50"))
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "256"))
+CHUNK_TOKEN_OVERLAP = int(os.getenv("CHUNK_TOKEN_OVERLAP", "32"))
+PIPELINE_CACHE_PATH = os.getenv("PIPELINE_CACHE_PATH", os.path.join(os.path.dirname(__file__), "./cache/pipeline.db"))
+ARTICLES_PER_SECTION = int(os.getenv("ARTICLES_PER_SECTION", "3"))
+SCRAPE_WORKERS = int(os.getenv("SCRAPE_WORKERS", "8"))
+REQUESTS_PER_HOST_PER_SECOND = float(os.getenv("REQUESTS_PER_HOST_PER_SECOND", "4"))
+# Items waiting between two scrape stages, and fetched articles that are chunked and embedded together
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", "16"))
+EMBED_ARTICLES_PER_BATCH = int(os.getenv("EMBED_ARTICLES_PER_BATCH", "8"))
+# Chunks are dropped before writing when an earlier chunk of the run, in any section, has a MinHash Jaccard
+# similarity of at least DEDUP_JACCARD or an embedding cosine similarity of at least DEDUP_COSINE (0 disables a check)
+DEDUP = os.getenv("DEDUP", "true").lower() == 'true'
+DEDUP_JACCARD = float(os.getenv("DEDUP_JACCARD", "0.8"))
+DEDUP_COSINE = float(os.getenv("DEDUP_COSINE", "0.97"))
+# ingest_pdfs reads every PDF in PDF_DIR into a dataset of section PDF_SECTION. Page text is extracted by
+# PDF_WORKERS processes, PDF_PAGES_PER_TASK pages at a time, and EMBED_PAGES_PER_BATCH pages are embedded together.
+PDF_DIR = os.getenv("PDF_DIR", os.path.join(os.path.dirname(__file__), "../aws/RAG/03_Data-Pipeline/data"))
+PDF_SECTION = os.getenv("PDF_SECTION", "lectures")
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", str(os.cpu_count() or 1)))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+EMBED_PAGES_PER_BATCH = int(os.getenv("EMBED_PAGES_PER_BATCH", "16"))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", "100"))
+# Pinecone rejects upsert requests over 2MB, so leave some headroom for the request envelope
+UPSERT_BATCH_BYTES = int(os.getenv("UPSERT_BATCH_BYTES", "1800000"))
+UPSERT_MAX_IN_FLIGHT = int(os.getenv("UPSERT_MAX_IN_FLIGHT", "4"))
+# Pinecone deletes at most 1000 ids per request
+DELETE_BATCH_SIZE = 1000
+# "true" prints every timed stage (fetch, parse, chunk, embed, dedup, write, upsert_batch) as it ends
+TRACE_SPANS = os.getenv("TRACE_SPANS", "false").lower() == 'true'
+if TRACE_SPANS:
+    add_span_hook(print_span)
 # Commented out some sections to reduce the scrape time
 news_sections = ["us", "world", "politics", "business", "health", "entertainment", "style", "travel", "sports"]
 #news_sections = ["world", "politics", "business"]
 
-def get_article_urls(section):
+_session = None
+_session_lock = threading.Lock()
+_host_next_request = {}
+_host_lock = threading.Lock()
+
+def get_http_session(pool_size=SCRAPE_WORKERS):
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+            # Keep-alive connections are shared by all scrape threads; pool_block bounds the open connections per host
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, pool_block=True, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+    return _session
+
+def host_key(url):
+    # cnn.com and www.cnn.com are the same site: section pages are listed on www.cnn.com, articles on cnn.com
+    host = urlparse(url).netloc.lower()
+    return host[4:] if host.startswith("www.") else host
+
+def wait_for_host(url):
+    # Space out requests to the same host instead of sleeping a random amount after every request
+    host = host_key(url)
+    interval = 1 / REQUESTS_PER_HOST_PER_SECOND
+    with _host_lock:
+        now = time.monotonic()
+        scheduled = max(now, _host_next_request.get(host, now))
+        _host_next_request[host] = scheduled + interval
+    if scheduled > now:
+        time.sleep(scheduled - now)
+
+def http_get(url):
+    wait_for_host(url)
+    response = get_http_session().get(url, timeout=(5, 30))
+    response.raise_for_status()
+    return response
+
+def get_article_urls(section, max_articles=ARTICLES_PER_SECTION):
     articles = []
-    response = requests.get(f"https://www.cnn.com/{section}")
+    response = http_get(f"https://www.cnn.com/{section}")
 
+    from bs4 import BeautifulSoup
     # Parse the HTML content
     soup = BeautifulSoup(response.content, 'html.parser')
     links = soup.select('a[data-link-type="article"]')
@@ -43,149 +135,637 @@ def get_article_urls(section):
     for link in links:
         articles.append(f"{site_prefix}{link['href']}")
 
-    articles_no_duplicates = list(set(articles))
-
-    return list(articles_no_duplicates)[:3]
-
-def get_article_details(urls, section):
-    details = []
-    #for url in urls:
-    for url in urls:
-        try:
-            response = requests.get(url)
-            soup = BeautifulSoup(response.content, 'html.parser')
-            script_tag = soup.find('script', {'type': 'application/ld+json'})
-            data = json.loads(script_tag.string)
-            text = data[0]['articleBody']
-            details.append({"url": url, "text": text, "scrape_date": date.today().strftime("%m/%d/%Y")})
-            print(f"Web scraped article from {url}")
-            time.sleep(random.uniform(.1, 1))  
-        except Exception as e:
-            print(f"Web scraped article from {url}: {e}")
-    print(f"Web scraped {len(details)} articles from section: {section}")
-    return details
-
-def create_jsonl_file(section, article_details):
-    with open(f'jsonl/cnn_articles_{section}.jsonl', 'w') as f:
-        for article_detail in article_details:
-            for text_embedding in generate_embeddings_from_text(article_detail['text']):
-                doc_id = get_article_id(article_detail['url'])
-                jsonl_element = {}
-                jsonl_element['id'] = f"doc-{doc_id}#chunk{text_embedding['chunk_id']}"
-                jsonl_element['values'] = text_embedding['embedding']
-                jsonl_element['metadata'] = {"text": text_embedding['text'], 
-                                             "scrape_date": article_detail['scrape_date'], 
-                                             "section": section, 
-                                             "source": article_detail['url']}
-               
-                f.write(json.dumps(jsonl_element) + '\n')
-            print(f"Wrote article as doc_id: {doc_id} to jsonl file")
-    print(f"Wrote {len(article_details)} articles to data directory for section: {section}")
+    # dict.fromkeys drops duplicates but keeps the page order
+    articles_no_duplicates = list(dict.fromkeys(articles))
 
-def generate_embeddings_from_text(text):
-    chunk_size = 512
-    overlap = 50
-    text_embeddings = []
-    chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size-overlap)]
-    
-    if AWS_TITAN_ENABLED:
-        bedrock = create_bedrock_connection()
-        model_id = 'amazon.titan-embed-text-v1'
-        application_json = 'application/json' 
-        
-        for chunk in chunks:
-            body = json.dumps({"inputText": chunk})
-            response = bedrock.invoke_model(body=body, modelId=model_id, accept=application_json, contentType=application_json)
-            response_body = json.loads(response['body'].read())
-            embedding = response_body.get('embedding')
-            
-            text_embeddings.append({'text':chunk,
-                                    'chunk_id':chunks.index(chunk),
-                                    'embedding':embedding })
-        print(f"Generated embeddings for {len(chunks)} chunks using AWS Titan")
-    elif GCP_GEMINI_ENABLED:
-        vertexai.init(project=GEMINI_PROJECT, location=GEMINI_LOCATION)
-        model = TextEmbeddingModel.from_pretrained(GEMINI_MODEL)
-        for chunk in chunks:
-            response = model.get_embeddings([chunk])
-            embedding = response[0].values
-            
-            text_embeddings.append({'text':chunk,
-                                    'chunk_id':chunks.index(chunk),
-                                    'embedding':embedding })
-        print(f"Generated embeddings for {len(chunks)} chunks using GCP Gemini")
+    return articles_no_duplicates[:max_articles]
+
+def get_article_detail(url):
+    try:
+        from bs4 import BeautifulSoup
+        response = http_get(url)
+        soup = BeautifulSoup(response.content, 'html.parser')
+        script_tag = soup.find('script', {'type': 'application/ld+json'})
+        data = json.loads(script_tag.string)
+        text = data[0]['articleBody']
+        print(f"Web scraped article from {url}")
+        return {"url": url, "text": text, "scrape_date": date.today().strftime("%m/%d/%Y")}
+    except Exception as e:
+        print(f"Web scraped article from {url}: {e}")
+        return None
+
+def article_records(section, article_detail, chunks, embeddings):
+    doc_id = get_article_id(article_detail['url'])
+    return [{'id': f"doc-{doc_id}#chunk{chunk['chunk_id']}",
+             'values': embedding,
+             'metadata': {"text": chunk['text'], 
+                          "scrape_date": article_detail['scrape_date'], 
+                          "section": section, 
+                          "source": article_detail['url']}}
+            for chunk, embedding in zip(chunks, embeddings)]
+
+def dataset_name(section):
+    return f"cnn_articles_{section}"
+
+def record_source(record):
+    return record['metadata']['source']
+
+def part_file_path(name):
+    # Records of a dataset that is still being written; it does not end in .jsonl, so it is never read as a dataset
+    return os.path.join(DATA_DIR, f"{name}.jsonl.part")
+
+def append_records(path, records):
+    # One write per item, flushed to disk before the item is checkpointed as written
+    with open(path, 'a') as f:
+        f.write(''.join(json.dumps(record) + '\n' for record in records))
+        f.flush()
+        os.fsync(f.fileno())
+
+def read_part_records(name, written_keys, record_key=record_source):
+    # A crash can leave a torn last line, and records of an item whose checkpoint was never committed
+    records = []
+    path = part_file_path(name)
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line) if line.endswith('\n') else None
+                except json.JSONDecodeError:
+                    record = None
+                if record is not None and record_key(record) in written_keys:
+                    records.append(record)
+    return records
+
+def write_dataset(name, records, vector_format=VECTOR_FORMAT, projection=None):
+    if vector_format in ("jsonl", "both"):
+        path = os.path.join(DATA_DIR, f"{name}.jsonl")
+        with open(path + ".tmp", 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        os.replace(path + ".tmp", path)
+        print(f"Wrote {len(records)} vectors to jsonl file: {name}")
+    if vector_format == "jsonl":
+        # upsert and print prefer the npy sidecar, so one left from an earlier run would shadow the new records
+        remove_vector_file(NPY_DIR, name)
+    if vector_format in ("npy", "both"):
+        write_vector_file(NPY_DIR, name, compress_records(records, projection), VECTOR_DTYPE)
+        print(f"Wrote {len(records)} vectors to {VECTOR_DTYPE} npy file: {name}")
+
+class DatasetWriter:
+    # Appends the records of each item (an article, or a PDF page) to its dataset's part file and checkpoints the
+    # item under its key. Once every item of a dataset is written, the dataset's files are replaced and its
+    # checkpoints are cleared. record_key maps a record back to the key of its item. The projection of the npy
+    # files is loaded once per run.
+    #
+    # With a deduplicator, near-duplicates are dropped when a dataset is finished. Datasets are finished in the
+    # given order, each after the ones before it, so a chunk is always kept by the first dataset in the order that
+    # has it, however the items arrive. on_finished(name, records) is called with the kept records of each dataset.
+
+    def __init__(self, vector_format=VECTOR_FORMAT, record_key=record_source, deduplicator=None, order=()):
+        self.vector_format = vector_format
+        self.record_key = record_key
+        self.deduplicator = deduplicator
+        self.projection = get_projection()
+        self.order = list(order)
+        self.on_finished = None
+        self.finished = []
+        self.keys = {}
+        self.pending = {}
+        self.ready = set()
+        self.lock = threading.Lock()
+
+    def start(self, name, checkpoint):
+        written = {key for key, done in checkpoint if done}
+        # Rewrite the part file without leftovers of the failed run, so new records are not appended to a torn line
+        path = part_file_path(name)
+        records = read_part_records(name, written, self.record_key)
+        with open(path + ".tmp", 'w') as f:
+            f.write(''.join(json.dumps(record) + '\n' for record in records))
+        os.replace(path + ".tmp", path)
+        with self.lock:
+            self.keys[name] = [key for key, _ in checkpoint]
+            self.pending[name] = {key for key, done in checkpoint if not done}
+            if not self.pending[name]:
+                self.ready.add(name)
+            self.finish_ready()
+
+    def write(self, name, key, records):
+        append_records(part_file_path(name), records)
+        mark_written(get_cache(), name, key)
+        with self.lock:
+            self.pending[name].discard(key)
+            if not self.pending[name]:
+                self.ready.add(name)
+            self.finish_ready()
+
+    def skip(self, name):
+        # A dataset whose items could not be listed; the datasets after it in the order stop waiting for it
+        with self.lock:
+            if name in self.order:
+                self.order.remove(name)
+            self.finish_ready()
+
+    def finish_ready(self):
+        while self.ready:
+            # Datasets outside the order don't wait for any other
+            unordered = sorted(self.ready - set(self.order))
+            if unordered:
+                name = unordered[0]
+            elif self.order[0] in self.ready:
+                name = self.order.pop(0)
+            else:
+                return
+            self.ready.discard(name)
+            self.finish(name)
+
+    def finish(self, name):
+        keys = self.keys.pop(name)
+        del self.pending[name]
+        # Items finish out of order; sorting is stable, so the chunks of an item keep their order
+        position = {key: index for index, key in enumerate(keys)}
+        records = sorted(read_part_records(name, set(keys), self.record_key), key=lambda record: position[self.record_key(record)])
+        if self.deduplicator is not None:
+            with span("dedup", dataset=name, vectors=len(records)):
+                records = self.deduplicator.filter(records)
+        write_dataset(name, records, self.vector_format, self.projection)
+        os.remove(part_file_path(name))
+        clear_checkpoint(get_cache(), name)
+        print(f"Wrote {len({self.record_key(record) for record in records})} of {len(keys)} items to data directory: {name}")
+        self.finished.append(name)
+        if self.on_finished is not None and records:
+            self.on_finished(name, records)
+
+def embed_document_chunks(document_ids, document_chunks):
+    # Chunks that were already embedded with the current model are read from the cache under their document id
+    # (an article id or a PDF page); the rest of the chunks are embedded together in batches
+    model = embedding_model_name()
+    cache = get_cache()
+    document_embeddings = []
+    missing = []
+    for document_index, (document_id, chunks) in enumerate(zip(document_ids, document_chunks)):
+        chunk_hashes = [text_hash(chunk) for chunk in chunks]
+        cached = get_embeddings(cache, document_id, chunk_hashes, model)
+        document_embeddings.append([cached.get(chunk_hash) for chunk_hash in chunk_hashes])
+        missing.extend((document_index, chunk_index, chunk_hash, chunk)
+                       for chunk_index, (chunk_hash, chunk) in enumerate(zip(chunk_hashes, chunks)) if chunk_hash not in cached)
+
+    new_embeddings = {}
+    for (document_index, chunk_index, chunk_hash, _), embedding in zip(missing, embed_texts([chunk for *_, chunk in missing])):
+        document_embeddings[document_index][chunk_index] = embedding
+        new_embeddings.setdefault(document_index, []).append((chunk_hash, embedding))
+    for document_index, embeddings in new_embeddings.items():
+        put_embeddings(cache, document_ids[document_index], embeddings, model)
+
+    reused = sum(len(chunks) for chunks in document_chunks) - len(missing)
+    print(f"Generated embeddings for {len(missing)} chunks using {model}, reused {reused} cached embeddings")
+    return document_embeddings
+
+def chunk_tokens():
+    # Leave room for the special tokens the model adds around every input
+    return min(CHUNK_TOKENS, MODEL_MAX_TOKENS.get(embedding_model_name().split(":")[0], 512) - 2)
+
+def check_chunker(chunker=CHUNKER):
+    # Rejects an overlap the chunker can't advance past before anything is fetched or parsed
+    if chunker == "tokens":
+        check_overlap(chunk_tokens(), CHUNK_TOKEN_OVERLAP, "tokens")
     else:
-        model = AutoModel.from_pretrained('intfloat/multilingual-e5-large')
-        tokenizer = AutoTokenizer.from_pretrained('intfloat/multilingual-e5-large')
-        
-        for chunk in chunks:
-            tokens = tokenizer(chunk, return_tensors='pt', padding=True)
-            outputs = model(**tokens)
-            embedding = outputs.last_hidden_state.mean(dim=1).squeeze().tolist()
-            
-            text_embeddings.append({'text':chunk,
-                                    'chunk_id':chunks.index(chunk),
-                                    'embedding':embedding })
-        print(f"Generated embeddings for {len(chunks)} chunks using E5 Large model")
+        check_overlap(CHUNK_SIZE, CHUNK_OVERLAP)
+
+def chunk_text(text, chunker=CHUNKER):
+    if chunker == "tokens":
+        return split_tokens(text, load_e5_tokenizer(), chunk_tokens(), CHUNK_TOKEN_OVERLAP)
+    elif chunker == "sentences":
+        return split_sentences(text, CHUNK_SIZE, CHUNK_OVERLAP)
+    return split_characters(text, CHUNK_SIZE, CHUNK_OVERLAP)
+
+def generate_embeddings_from_text(text):
+    chunks = list(chunk_text(text))
+    embeddings = embed_texts([chunk['text'] for chunk in chunks])
+    text_embeddings = [{'text': chunk['text'], 'chunk_id': chunk['chunk_id'], 'embedding': embedding}
+                       for chunk, embedding in zip(chunks, embeddings)]
+    print(f"Generated embeddings for {len(chunks)} chunks using {embedding_model_name()}")
     return text_embeddings
 
-def create_bedrock_connection():
-    config = Config(connect_timeout=5, read_timeout=60, retries={"total_max_attempts": 20, "mode": "adaptive"})
-    region = 'us-east-1'
-    bedrock = boto3.client(
-                service_name='bedrock-runtime',
-                region_name=region,
-                endpoint_url=f'https://bedrock-runtime.{region}.amazonaws.com',
-                                    config=config)
-    return bedrock
-
-def scrape():
-    for section in news_sections:
-        urls = get_article_urls(section)
-        article_details = get_article_details(urls, section)
-        create_jsonl_file(section, article_details)
-
-def upsert():
-    pc = Pinecone(api_key=API_KEY)
-    index = pc.Index(PINECONE_INDEX_NAME)
+def embedding_model_name():
+    return get_embedder().model_name
 
-    for filename in os.listdir(DATA_DIR):
-        if filename.endswith('.jsonl'):
-            filepath = os.path.join(DATA_DIR, filename)
-            with open(filepath, 'r') as file:
-                df = pd.read_json(file, lines=True)
-                index.upsert_from_dataframe(df, namespace=PINECONE_NAMESPACE)
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = open_cache(PIPELINE_CACHE_PATH)
+    return _cache
+
+def embed_texts(texts):
+    # The registry builds the embedder once per process; it batches the texts the way its provider accepts them
+    if not texts:
+        return []
+    return get_embedder().embed_batch(texts)
+
+def load_checkpoint(name, list_keys):
+    # Returns [(key, written)]. An unfinished run over the dataset is resumed with the keys it listed before.
+    cache = get_cache()
+    checkpoint = get_checkpoint(cache, name)
+    if checkpoint:
+        print(f"Resuming {name}: {sum(done for _, done in checkpoint)} of {len(checkpoint)} items already written")
+        return checkpoint
+    keys = list_keys()
+    put_checkpoint(cache, name, keys)
+    return [(key, False) for key in keys]
+
+def fetch_article(section, url, refresh=False):
+    # Articles are downloaded on every scrape, since a url that was seen before may have been edited since. When
+    # the text is unchanged the cached article, and with it its scrape date, is kept unless a refresh is requested,
+    # so its records come out the same and are not upserted again. A failed download falls back to the cached
+    # article.
+    cache = get_cache()
+    cached = get_article(cache, url)
+    with span("fetch", section=section):
+        article_detail = get_article_detail(url)
+    if article_detail is None:
+        return None if refresh else cached
+    if cached is not None and not refresh and text_hash(cached['text']) == text_hash(article_detail['text']):
+        return cached
+    put_article(cache, url, get_article_id(url), section, article_detail)
+    return article_detail
+
+def embed_articles(articles, chunker=CHUNKER):
+    # articles is a list of (section, url, article detail or None); returns (section, url, records) for each
+    fetched = [(section, article_detail) for section, _, article_detail in articles if article_detail is not None]
+    with span("chunk", articles=len(fetched), chunker=chunker):
+        article_chunks = [list(chunk_text(article_detail['text'], chunker)) for _, article_detail in fetched]
+    with span("embed", chunks=sum(len(chunks) for chunks in article_chunks)):
+        article_embeddings = embed_document_chunks([get_article_id(article_detail['url']) for _, article_detail in fetched],
+                                                   [[chunk['text'] for chunk in chunks] for chunks in article_chunks])
+    records = {article_detail['url']: article_records(section, article_detail, chunks, embeddings)
+               for (section, article_detail), chunks, embeddings in zip(fetched, article_chunks, article_embeddings)}
+    # Articles that could not be fetched are written with no records, so the section can still finish
+    return [(section, url, records.get(url, [])) for section, url, _ in articles]
+
+def upsert_records(index, records, namespace, dataset=""):
+    cache = get_cache()
+    sized_records = changed_records(cache, namespace, ((record, len(json.dumps(record))) for record in records))
+    for batch in batch_records(sized_records):
+        upsert_batch(index, batch, namespace)
+        mark_upserted(cache, namespace, batch, dataset)
+
+def create_deduplicator(enabled=DEDUP):
+    return Deduplicator(DEDUP_JACCARD, DEDUP_COSINE) if enabled else None
+
+def add_write_stages(pipeline, writer, inbox, upsert_namespace=None):
+    # inbox holds (dataset name, item key, records). With a namespace the records of each dataset are also upserted
+    # as soon as the dataset is finished. Returns the index handle, or None without a namespace.
+    index = create_index() if upsert_namespace else None
+    upserts = pipeline.queue() if upsert_namespace else None
+    if upsert_namespace:
+        # Datasets can also finish in the discover stage, when a resumed run had already written all of their items
+        writer.on_finished = lambda name, records: pipeline.put(upserts, (name, compress_records(records, writer.projection)))
+
+    def write(items, emit):
+        for name, key, records in items:
+            with span("write", dataset=name, vectors=len(records)):
+                writer.write(name, key, records)
 
-def upsert_into_namespace():
+    def upsert(items, emit):
+        for name, records in items:
+            upsert_records(index, records, upsert_namespace, name)
+
+    pipeline.stage("write", write, inbox, upserts)
+    if upsert_namespace:
+        pipeline.stage("upsert", upsert, upserts, workers=UPSERT_MAX_IN_FLIGHT)
+    return index
+
+def scrape(max_articles=ARTICLES_PER_SECTION, workers=SCRAPE_WORKERS, vector_format=VECTOR_FORMAT, refresh=False,
+           chunker=CHUNKER, upsert_namespace=None, dedup=DEDUP):
+    # discover -> fetch -> chunk and embed -> write (-> upsert) run at the same time, connected by bounded queues,
+    # so downloads overlap with embedding. Written articles are checkpointed, and a scrape that failed resumes
+    # with the articles it had not written yet.
+    check_chunker(chunker)
+    get_http_session(workers)
+    os.makedirs(DATA_DIR, exist_ok=True)
+    # Near-duplicates are kept by the section that comes first in news_sections
+    writer = DatasetWriter(vector_format, deduplicator=create_deduplicator(dedup),
+                           order=[dataset_name(section) for section in news_sections])
+    pipeline = StagedPipeline(INGEST_QUEUE_SIZE)
+    sections, urls, articles, embedded = (pipeline.queue() for _ in range(4))
+
+    def list_sections(emit):
+        for section in news_sections:
+            emit(section)
+
+    def discover(items, emit):
+        for section in items:
+            # A section whose page can't be loaded is skipped, like an article that can't be downloaded
+            try:
+                checkpoint = load_checkpoint(dataset_name(section), lambda: get_article_urls(section, max_articles))
+            except Exception as e:
+                print(f"Listed no articles of section {section}: {e}")
+                writer.skip(dataset_name(section))
+                continue
+            writer.start(dataset_name(section), checkpoint)
+            for url, done in checkpoint:
+                if not done:
+                    emit((section, url))
+
+    def fetch(items, emit):
+        for section, url in items:
+            emit((section, url, fetch_article(section, url, refresh)))
+
+    def embed(items, emit):
+        for section, url, records in embed_articles(items, chunker):
+            emit((dataset_name(section), url, records))
+
+    pipeline.source("sections", list_sections, sections)
+    pipeline.stage("discover", discover, sections, urls, workers=len(news_sections))
+    pipeline.stage("fetch", fetch, urls, articles, workers=workers)
+    pipeline.stage("embed", embed, articles, embedded, batch_size=EMBED_ARTICLES_PER_BATCH)
+    index = add_write_stages(pipeline, writer, embedded, upsert_namespace)
+    pipeline.join()
+    report_duplicates(writer.deduplicator)
+    if upsert_namespace:
+        delete_stale_vectors(index, upsert_namespace, writer.finished)
+
+def report_duplicates(deduplicator):
+    if deduplicator is not None:
+        print(f"Dropped {deduplicator.dropped} near-duplicate chunks out of {deduplicator.checked}")
+
+def pdf_dataset_name(filename, section=PDF_SECTION):
+    # Ends in the section like the scrape datasets, so upsert_into_namespace puts a whole collection in one namespace
+    return f"pdf-{document_slug(filename)}_{section}"
+
+def page_key(filename, page):
+    return f"{filename}#page{page}"
+
+def record_page(record):
+    return page_key(record['metadata']['source'], record['metadata']['page'])
+
+def page_records(section, filename, page, chunks, embeddings):
+    return [{'id': f"pdf-{document_slug(filename)}#page{page}#chunk{chunk['chunk_id']}",
+             'values': embedding,
+             'metadata': {"text": chunk['text'],
+                          "section": section,
+                          "source": filename,
+                          "page": page}}
+            for chunk, embedding in zip(chunks, embeddings)]
+
+def embed_pages(pages, section=PDF_SECTION, chunker=CHUNKER):
+    # pages is a list of (dataset name, filename, page, text); returns (dataset name, page key, records) for each.
+    # Pages are chunked on their own, so every chunk belongs to exactly one page.
+    with span("chunk", pages=len(pages), chunker=chunker):
+        page_chunks = [list(chunk_text(text, chunker)) for *_, text in pages]
+    with span("embed", chunks=sum(len(chunks) for chunks in page_chunks)):
+        page_embeddings = embed_document_chunks([page_key(filename, page) for _, filename, page, _ in pages],
+                                                [[chunk['text'] for chunk in chunks] for chunks in page_chunks])
+    return [(name, page_key(filename, page), page_records(section, filename, page, chunks, embeddings))
+            for (name, filename, page, _), chunks, embeddings in zip(pages, page_chunks, page_embeddings)]
+
+def ingest_pdfs(pdf_dir=PDF_DIR, workers=PDF_WORKERS, vector_format=VECTOR_FORMAT, chunker=CHUNKER, section=PDF_SECTION,
+                upsert_namespace=None, dedup=DEDUP):
+    # Every PDF in pdf_dir becomes one dataset. Page text is extracted on a pool of worker processes and streamed
+    # through the same chunk and embed -> write (-> upsert) stages as the scrape, checkpointed per page.
+    check_chunker(chunker)
+    filenames = sorted(filename for filename in os.listdir(pdf_dir) if filename.lower().endswith('.pdf'))
+    if not filenames:
+        print(f"No PDF files found in {pdf_dir}")
+        return
+    os.makedirs(DATA_DIR, exist_ok=True)
+    writer = DatasetWriter(vector_format, record_page, create_deduplicator(dedup),
+                           order=[pdf_dataset_name(filename, section) for filename in filenames])
+    pipeline = StagedPipeline(INGEST_QUEUE_SIZE)
+    documents, tasks, pages, embedded = (pipeline.queue() for _ in range(4))
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        def list_documents(emit):
+            for filename in filenames:
+                emit(filename)
+
+        def discover(items, emit):
+            for filename in items:
+                name = pdf_dataset_name(filename, section)
+                path = os.path.join(pdf_dir, filename)
+                checkpoint = load_checkpoint(name, lambda: [page_key(filename, page)
+                                                            for page in range(1, pool.submit(pdf_page_count, path).result() + 1)])
+                writer.start(name, checkpoint)
+                # The checkpoint lists the pages in order, so its position is the page number
+                remaining = [page for page, (_, done) in enumerate(checkpoint, 1) if not done]
+                for start in range(0, len(remaining), PDF_PAGES_PER_TASK):
+                    emit((name, filename, path, remaining[start:start + PDF_PAGES_PER_TASK]))
+
+        def parse(items, emit):
+            for name, filename, path, page_numbers in items:
+                with span("parse", document=filename, pages=len(page_numbers)):
+                    extracted = pool.submit(extract_pages, path, page_numbers).result()
+                for page, text in extracted:
+                    emit((name, filename, page, text))
+
+        def embed(items, emit):
+            for item in embed_pages(items, section, chunker):
+                emit(item)
+
+        pipeline.source("documents", list_documents, documents)
+        pipeline.stage("discover", discover, documents, tasks, workers=min(len(filenames), workers))
+        # One thread per worker process keeps every process busy
+        pipeline.stage("parse", parse, tasks, pages, workers=workers)
+        pipeline.stage("embed", embed, pages, embedded, batch_size=EMBED_PAGES_PER_BATCH)
+        index = add_write_stages(pipeline, writer, embedded, upsert_namespace)
+        pipeline.join()
+    report_duplicates(writer.deduplicator)
+    if upsert_namespace:
+        delete_stale_vectors(index, upsert_namespace, writer.finished)
+
+def list_datasets():
+    # A dataset is the output of one scrape section, stored as JSONL, as an npy matrix, or both
+    jsonl_names = [filename[:-len('.jsonl')] for filename in os.listdir(DATA_DIR) if filename.endswith('.jsonl')]
+    return sorted(set(jsonl_names) | set(list_vector_files(NPY_DIR)))
+
+def iter_dataset_records(name, limit=None):
+    # Yields (record, approximate request bytes); the npy sidecar is preferred because it skips float parsing
+    if name in list_vector_files(NPY_DIR):
+        for record in iter_vector_records(NPY_DIR, name, limit):
+            values = record['values']
+            record['values'] = values.astype(np.float32).tolist()
+            yield record, len(json.dumps(record['metadata'])) + 20 * values.size
+    else:
+        with open(os.path.join(DATA_DIR, f"{name}.jsonl"), 'r') as file:
+            lines = (line for line in file if line.strip())
+            for line in itertools.islice(lines, limit):
+                yield json.loads(line), len(line.encode('utf-8'))
+
+def batch_records(sized_records, max_vectors=UPSERT_BATCH_SIZE, max_bytes=UPSERT_BATCH_BYTES):
+    # Records are read one at a time so only the current batch is held in memory. A record that is over the byte
+    # limit on its own would be rejected by Pinecone, so it is skipped.
+    batch = []
+    batch_bytes = 0
+    for record, record_bytes in sized_records:
+        if record_bytes > max_bytes:
+            print(f"Skipped vector {record['id']}: {record_bytes} bytes is over the {max_bytes} byte request limit")
+            continue
+        if batch and (len(batch) >= max_vectors or batch_bytes + record_bytes > max_bytes):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(record)
+        batch_bytes += record_bytes
+    if batch:
+        yield batch
+
+def upsert_batches(index, batches, namespace, max_in_flight=UPSERT_MAX_IN_FLIGHT, on_upserted=None):
+    # At most max_in_flight requests are outstanding; the next batch is only read once one of them completes
+    upserted = 0
+    in_flight = deque()
+
+    def complete(future):
+        batch = future.result()
+        if on_upserted is not None:
+            on_upserted(batch)
+        return len(batch)
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        for batch in batches:
+            if len(in_flight) >= max_in_flight:
+                upserted += complete(in_flight.popleft())
+            in_flight.append(executor.submit(upsert_batch, index, batch, namespace))
+        while in_flight:
+            upserted += complete(in_flight.popleft())
+    return upserted
+
+def upsert_batch(index, batch, namespace):
+    with span("upsert_batch", namespace=namespace, vectors=len(batch)):
+        index.upsert(vectors=batch, namespace=namespace)
+    return batch
+
+def upsert_dataset(index, name, namespace, full=False):
+    # Unless a full upsert is requested, vectors that are unchanged since the last upsert into the namespace are skipped
+    cache = get_cache()
+    records = iter_dataset_records(name)
+    if not full:
+        records = changed_records(cache, namespace, records)
+    return upsert_batches(index, batch_records(records), namespace,
+                          on_upserted=lambda batch: mark_upserted(cache, namespace, batch, name))
+
+def delete_stale_vectors(index, namespace, datasets):
+    # Deletes the vectors that were upserted from these datasets but that none of them holds any more, such as the
+    # chunks past the end of an article that got shorter, or a chunk that dedup now drops
+    if not datasets:
+        return 0
+    cache = get_cache()
+    current_ids = {record['id'] for name in datasets for record, _ in iter_dataset_records(name)}
+    stale = stale_upserts(cache, namespace, datasets, current_ids)
+    for start in range(0, len(stale), DELETE_BATCH_SIZE):
+        batch = stale[start:start + DELETE_BATCH_SIZE]
+        index.delete(ids=batch, namespace=namespace)
+        forget_upserts(cache, namespace, batch)
+    if stale:
+        print(f"Deleted {len(stale)} vectors that are no longer in the data from namespace: {namespace}")
+    return len(stale)
+
+def create_index():
+    # The Pinecone client is only imported by the actions that talk to the index
+    from pinecone import Pinecone
     pc = Pinecone(api_key=API_KEY)
-    index = pc.Index(PINECONE_INDEX_NAME)
+    return pc.Index(PINECONE_INDEX_NAME)
+
+def upsert(full=False):
+    index = create_index()
+
+    names = list_datasets()
+    for name in names:
+        upserted = upsert_dataset(index, name, PINECONE_NAMESPACE, full)
+        print(f"Upserted {upserted} new or changed vectors from {name} into namespace: {PINECONE_NAMESPACE}")
+    delete_stale_vectors(index, PINECONE_NAMESPACE, names)
 
+def upsert_into_namespace(full=False):
+    index = create_index()
+
+    namespaces = {}
+    for name in list_datasets():
+        PINECONE_NAMESPACE = name.split("_")[-1]
+        print(f"Namespace to insert recs: {PINECONE_NAMESPACE}")
+        upserted = upsert_dataset(index, name, PINECONE_NAMESPACE, full)
+        print(f"Upserted {upserted} new or changed vectors from {name} into namespace: {PINECONE_NAMESPACE}")
+        namespaces.setdefault(PINECONE_NAMESPACE, []).append(name)
+    # Several datasets can share a namespace, e.g. the PDFs of one section
+    for namespace, names in namespaces.items():
+        delete_stale_vectors(index, namespace, names)
+
+def convert_to_npy(vector_dtype=VECTOR_DTYPE):
+    projection = get_projection()
     for filename in os.listdir(DATA_DIR):
         if filename.endswith('.jsonl'):
-            filepath = os.path.join(DATA_DIR, filename)
-            with open(filepath, 'r') as file:
-                df = pd.read_json(file, lines=True)
-                PINECONE_NAMESPACE = filepath.split(".")[-2].split("_")[-1]
-                print(f"Namespace to insert recs: {PINECONE_NAMESPACE}")
-                index.upsert_from_dataframe(df, namespace=PINECONE_NAMESPACE)
+            with open(os.path.join(DATA_DIR, filename), 'r') as file:
+                records = [json.loads(line) for line in file if line.strip()]
+            write_vector_file(NPY_DIR, filename[:-len('.jsonl')], compress_records(records, projection), vector_dtype)
+            print(f"Converted {len(records)} vectors from {filename} to {vector_dtype} npy file")
+
+def get_projection():
+    return load_projection(PROJECTION_PATH) if os.path.exists(PROJECTION_PATH) else None
+
+def compress_records(records, projection):
+    # The JSONL files keep full-precision vectors so the projection can be refitted later
+    return records if projection is None else project_records(records, projection)
+
+def read_jsonl_records(name):
+    path = os.path.join(DATA_DIR, f"{name}.jsonl")
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+def full_precision_records(name, projection):
+    # Returns the newest full-precision records of a dataset, and whether its JSONL file must be written from them.
+    # The JSONL file holds them unless a later --format npy run replaced the dataset; such npy vectors are used
+    # instead, unless they are already projected. Returns (None, False) when the full vectors are gone.
+    jsonl_records = read_jsonl_records(name)
+    if name not in list_vector_files(NPY_DIR):
+        return jsonl_records, False
+    npy_records = [record for record, _ in iter_dataset_records(name)]
+    if jsonl_records is not None and [(record['id'], record['metadata']) for record in jsonl_records] == \
+            [(record['id'], record['metadata']) for record in npy_records]:
+        return jsonl_records, False
+    if npy_records and projection is not None and len(npy_records[0]['values']) == projection['dimensions']:
+        return None, False
+    return npy_records, True
+
+def compress(method=COMPRESS_METHOD, dimensions=COMPRESS_DIMENSIONS, vector_dtype=VECTOR_DTYPE):
+    # Fits the projection on the full-precision vectors of every dataset, then rewrites the npy files with the
+    # projected vectors. upsert reads the npy files, so the index (and the queries, see ProjectedEmbedder) must use
+    # the new dimension. Datasets without a current JSONL file get one first, so the projection can be refitted.
+    previous = get_projection()
+    datasets = {}
+    for name in list_datasets():
+        records, stale_jsonl = full_precision_records(name, previous)
+        if records is None:
+            print(f"Not compressing: {name} only has compressed npy vectors. Write it again with --format jsonl or both first.")
+            return
+        datasets[name] = (records, stale_jsonl)
+    vectors = [record['values'] for records, _ in datasets.values() for record in records]
+    if not vectors:
+        print(f"No vectors to compress in {DATA_DIR} or {NPY_DIR}")
+        return
+    projection = fit_projection(vectors, method, dimensions)
+    for name, (records, stale_jsonl) in datasets.items():
+        if stale_jsonl:
+            write_dataset(name, records, "jsonl")
+    save_projection(PROJECTION_PATH, projection)
+    print(f"Fitted {method} projection from {len(vectors[0])} to {projection['dimensions']} dimensions on {len(vectors)} vectors")
+    for name, (records, _) in datasets.items():
+        write_vector_file(NPY_DIR, name, project_records(records, projection), vector_dtype)
+        print(f"Wrote {len(records)} compressed vectors to {vector_dtype} npy file: {name}")
 
 def print_test_vectors():
-    for filename in os.listdir(DATA_DIR):
-        if filename.endswith('.jsonl'):
-            filepath = os.path.join(DATA_DIR, filename)
-            with open(filepath, 'r') as file:
-                for line in itertools.islice(file, 3):
-                    data = json.loads(line)
-                    print(f'----- TEST EMBEDDING -----')
-                    values = str(data["values"]).replace('[', '').replace(']', '')
-                    print(f'{values}\n\n')
-                    print(f'----- TEST EMBEDDING METADATA -----')
-                    print(f'{data["metadata"]}\n\n')
+    for name in list_datasets():
+        for data, _ in iter_dataset_records(name, limit=3):
+            print(f'----- TEST EMBEDDING -----')
+            values = str(data["values"]).replace('[', '').replace(']', '')
+            print(f'{values}\n\n')
+            print(f'----- TEST EMBEDDING METADATA -----')
+            print(f'{data["metadata"]}\n\n')
 
 def delete_data():
-    pc = Pinecone(api_key=API_KEY)
-    index = pc.Index(PINECONE_INDEX_NAME)
+    index = create_index()
     index.delete(delete_all=True, namespace=PINECONE_NAMESPACE)
+    clear_upserts(get_cache(), PINECONE_NAMESPACE)
     print(f"Deleted all vectors in index: {PINECONE_INDEX_NAME} for namespace: {PINECONE_NAMESPACE}")
 
 def get_article_id(url):
@@ -197,19 +777,41 @@ def get_article_id(url):
 
 def main():
     parser = argparse.ArgumentParser(description="CLI for upserting and deleted pinecone index data")
-    parser.add_argument("action", choices=["scrape", "upsert", "delete", "print", "upsert_into_namespace"], help="Action to perform: 'scrape' to scrape data from base url, 'upsert' to insert or update data, 'delete' to delete all data in namespace, 'upsert' data into multiple namespaces")
+    parser.add_argument("action", choices=["scrape", "upsert", "delete", "print", "upsert_into_namespace", "convert", "compress", "ingest_pdfs"], help="Action to perform: 'scrape' to scrape data from base url, 'ingest_pdfs' to load the PDF files of --pdf-dir, 'upsert' to insert or update data, 'delete' to delete all data in namespace, 'upsert' data into multiple namespaces, 'convert' existing jsonl files to npy files, 'compress' the npy files with a fitted projection")
+    parser.add_argument("--max-articles", type=int, default=ARTICLES_PER_SECTION, help="Maximum number of articles to scrape per section")
+    parser.add_argument("--workers", type=int, default=SCRAPE_WORKERS, help="Number of concurrent article downloads, shared by all sections")
+    parser.add_argument("--format", choices=["jsonl", "npy", "both"], default=VECTOR_FORMAT, help="Output format for scraped vectors")
+    parser.add_argument("--chunker", choices=["characters", "tokens", "sentences"], default=CHUNKER, help="How article text is split into chunks")
+    parser.add_argument("--refresh", action="store_true", help="Store every fetched article with today's scrape date, even when its text is unchanged")
+    parser.add_argument("--method", choices=PROJECTION_METHODS, default=COMPRESS_METHOD, help="Projection fitted by compress")
+    parser.add_argument("--dimensions", type=int, default=COMPRESS_DIMENSIONS, help="Dimensions kept by compress")
+    parser.add_argument("--dtype", choices=["float32", "float16", "int8"], default=VECTOR_DTYPE, help="Element type of the npy files written by convert and compress")
+    parser.add_argument("--upsert", action="store_true", help="Upsert the vectors of each article or PDF page into PINECONE_NAMESPACE as soon as it is written")
+    parser.add_argument("--no-dedup", action="store_true", help="Write near-duplicate chunks instead of dropping them")
+    parser.add_argument("--pdf-dir", default=PDF_DIR, help="Directory with the PDF files for ingest_pdfs")
+    parser.add_argument("--pdf-workers", type=int, default=PDF_WORKERS, help="Processes extracting PDF text")
+    parser.add_argument("--section", default=PDF_SECTION, help="Section metadata and dataset suffix of the ingested PDF files")
+    parser.add_argument("--full", action="store_true", help="Upsert every vector, including the ones that are unchanged since the last upsert")
     args = parser.parse_args()
 
     if args.action == "scrape":
-        scrape()
+        scrape(args.max_articles, args.workers, args.format, args.refresh, args.chunker,
+               PINECONE_NAMESPACE if args.upsert else None, DEDUP and not args.no_dedup)
     elif args.action == "upsert":
-        upsert()
+        upsert(args.full)
     elif args.action == "print":
         print_test_vectors()
     elif args.action == "delete":
         delete_data()
     elif args.action == "upsert_into_namespace":
-        upsert_into_namespace()
+        upsert_into_namespace(args.full)
+    elif args.action == "convert":
+        convert_to_npy(args.dtype)
+    elif args.action == "ingest_pdfs":
+        ingest_pdfs(args.pdf_dir, args.pdf_workers, args.format, args.chunker, args.section,
+                    PINECONE_NAMESPACE if args.upsert else None, DEDUP and not args.no_dedup)
+    elif args.action == "compress":
+        compress(args.method, args.dimensions, args.dtype)
 
 if __name__ == "__main__":
     main()
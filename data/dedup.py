@@ -0,0 +1,104 @@
+import re
+import threading
+import zlib
+import numpy as np
+
+# Near-duplicate detection for chunks before they are written. A chunk is dropped when an earlier chunk of the
+# same run has about the same words (MinHash estimate of the Jaccard similarity of word shingles, with LSH
+# banding to find candidates) or about the same embedding (cosine similarity). Both checks are vectorized
+# over the shingles and the stored vectors.
+
+WORD = re.compile(r'\w+')
+# MinHash permutations are (a * hash + b) mod this Mersenne prime
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+
+def shingle_hashes(text, words_per_shingle=3):
+    words = WORD.findall(text.lower())
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    shingles = {' '.join(words[i:i + words_per_shingle]) for i in range(max(1, len(words) - words_per_shingle + 1))}
+    return np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+class Deduplicator:
+    def __init__(self, jaccard=0.8, cosine=0.97, num_perm=128, bands=16, words_per_shingle=3, seed=0):
+        # A threshold of 0 turns its check off. bands must divide num_perm; more bands find candidates with a
+        # lower similarity at the cost of more comparisons.
+        self.jaccard = jaccard
+        self.cosine = cosine
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.words_per_shingle = words_per_shingle
+        rng = np.random.default_rng(seed)
+        self.a = rng.integers(1, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, 1 << 32, size=num_perm, dtype=np.uint64)
+        self.signatures = []
+        self.buckets = [{} for _ in range(bands)]
+        self.vectors = None
+        self.count = 0
+        self.checked = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def signature(self, text):
+        hashes = shingle_hashes(text, self.words_per_shingle)
+        if not len(hashes):
+            return None
+        # One row per shingle, one column per permutation; uint64 arithmetic wraps, which is fine for hashing
+        return ((np.outer(hashes, self.a) + self.b) % MERSENNE_PRIME).min(axis=0)
+
+    def band_keys(self, signature):
+        return [signature[band * self.rows:(band + 1) * self.rows].tobytes() for band in range(self.bands)]
+
+    def is_text_duplicate(self, signature):
+        if signature is None or not self.jaccard:
+            return False
+        candidates = {position for band, key in enumerate(self.band_keys(signature)) for position in self.buckets[band].get(key, ())}
+        return any(np.mean(self.signatures[position] == signature) >= self.jaccard for position in candidates)
+
+    def normalize(self, records):
+        vectors = np.asarray([record['values'] for record in records], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def vector_similarities(self, vectors):
+        # Highest cosine similarity of each vector to the vectors kept so far
+        if self.vectors is None or not self.count:
+            return np.zeros(len(vectors), dtype=np.float32)
+        return (vectors @ self.vectors[:self.count].T).max(axis=1)
+
+    def keep(self, signature, vector):
+        if signature is not None:
+            for band, key in enumerate(self.band_keys(signature)):
+                self.buckets[band].setdefault(key, []).append(len(self.signatures))
+        self.signatures.append(signature)
+        # The vector store doubles in size when it is full, so adding n vectors costs O(n) copies in total
+        if self.vectors is None:
+            self.vectors = np.empty((64, len(vector)), dtype=np.float32)
+        elif self.count == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.empty_like(self.vectors)])
+        self.vectors[self.count] = vector
+        self.count += 1
+
+    def filter(self, records):
+        # Returns the records that are not near-duplicates of an earlier record or of each other, and keeps them
+        if not records:
+            return records
+        with self.lock:
+            vectors = self.normalize(records)
+            similarities = self.vector_similarities(vectors) if self.cosine else None
+            start = self.count
+            kept = []
+            for index, (record, vector) in enumerate(zip(records, vectors)):
+                signature = self.signature(record['metadata']['text'])
+                duplicate = self.is_text_duplicate(signature)
+                if self.cosine and not duplicate:
+                    # Compare with the stored vectors from before this call, and with the ones kept from this call
+                    duplicate = similarities[index] >= self.cosine or (
+                        self.count > start and (self.vectors[start:self.count] @ vector).max() >= self.cosine)
+                if duplicate:
+                    self.dropped += 1
+                else:
+                    self.keep(signature, vector)
+                    kept.append(record)
+            self.checked += len(records)
+            return kept
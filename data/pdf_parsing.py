@@ -0,0 +1,27 @@
+import os
+import re
+
+# Text extraction from PDF files with PyMuPDF. These functions run in the worker processes of
+# data_pipeline.py ingest_pdfs, so they take and return plain values that can be pickled.
+
+def document_slug(filename):
+    # Lowercase letters, digits and dashes, so the slug can be part of dataset names and vector ids
+    return re.sub(r'[^a-z0-9]+', '-', os.path.splitext(os.path.basename(filename))[0].lower()).strip('-')
+
+def clean_page_text(text):
+    # PDF text has a line break after every printed line. Words hyphenated across lines are joined, and
+    # single line breaks become spaces; blank lines still separate paragraphs for the sentence chunker.
+    text = re.sub(r'(?<=[a-z])-\n(?=[a-z])', '', text)
+    paragraphs = (' '.join(paragraph.split()) for paragraph in re.split(r'\n\s*\n', text))
+    return '\n\n'.join(paragraph for paragraph in paragraphs if paragraph)
+
+def pdf_page_count(path):
+    import pymupdf
+    with pymupdf.open(path) as document:
+        return document.page_count
+
+def extract_pages(path, pages):
+    # Returns [(page, text)] with pages numbered from 1, like a PDF viewer
+    import pymupdf
+    with pymupdf.open(path) as document:
+        return [(page, clean_page_text(document[page - 1].get_text())) for page in pages]
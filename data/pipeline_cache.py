@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import numpy as np
+
+# Local cache that lets a scrape skip articles it has already fetched, chunks it has already embedded and
+# vectors that are already in the index. It also holds the checkpoints of unfinished ingests: the items (article
+# urls or PDF pages) listed for each dataset and which of them are already written to the dataset's part file.
+# Connections are shared by the pipeline threads, so every call takes the lock.
+_lock = threading.Lock()
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS articles (
+    url TEXT PRIMARY KEY,
+    article_id TEXT NOT NULL,
+    section TEXT NOT NULL,
+    text TEXT NOT NULL,
+    scrape_date TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS embeddings (
+    article_id TEXT NOT NULL,
+    chunk_hash TEXT NOT NULL,
+    model TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    PRIMARY KEY (article_id, chunk_hash, model)
+);
+CREATE TABLE IF NOT EXISTS upserts (
+    namespace TEXT NOT NULL,
+    vector_id TEXT NOT NULL,
+    record_hash TEXT NOT NULL,
+    dataset TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (namespace, vector_id)
+);
+CREATE TABLE IF NOT EXISTS checkpoints (
+    dataset TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    item TEXT NOT NULL,
+    written INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (dataset, item)
+);
+"""
+
+def open_cache(path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.executescript(SCHEMA)
+    # Caches written before upserts were tracked per dataset get the column; their rows belong to no dataset
+    if "dataset" not in [column[1] for column in conn.execute("PRAGMA table_info(upserts)")]:
+        conn.execute("ALTER TABLE upserts ADD COLUMN dataset TEXT NOT NULL DEFAULT ''")
+    return conn
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def record_hash(record):
+    # Covers both the metadata and the vector, so a re-embedded chunk with the same text is upserted again
+    digest = hashlib.sha256(json.dumps(record['metadata'], sort_keys=True).encode('utf-8'))
+    digest.update(np.asarray(record['values'], dtype=np.float32).tobytes())
+    return digest.hexdigest()
+
+def get_article(conn, url):
+    with _lock:
+        row = conn.execute("SELECT text, scrape_date FROM articles WHERE url = ?", (url,)).fetchone()
+    if row is None:
+        return None
+    return {"url": url, "text": row[0], "scrape_date": row[1]}
+
+def put_article(conn, url, article_id, section, article_detail):
+    with _lock, conn:
+        conn.execute("INSERT OR REPLACE INTO articles VALUES (?, ?, ?, ?, ?)",
+                     (url, article_id, section, article_detail['text'], article_detail['scrape_date']))
+
+def get_embeddings(conn, article_id, chunk_hashes, model):
+    # Returns {chunk_hash: embedding} for the chunks that are already embedded with this model
+    if not chunk_hashes:
+        return {}
+    placeholders = ",".join("?" * len(chunk_hashes))
+    with _lock:
+        rows = conn.execute(f"SELECT chunk_hash, embedding FROM embeddings WHERE article_id = ? AND model = ? AND chunk_hash IN ({placeholders})",
+                            (article_id, model, *chunk_hashes)).fetchall()
+    return {chunk_hash: np.frombuffer(blob, dtype=np.float32).tolist() for chunk_hash, blob in rows}
+
+def put_embeddings(conn, article_id, embeddings, model):
+    # embeddings is a list of (chunk_hash, embedding) pairs
+    rows = [(article_id, chunk_hash, model, np.asarray(embedding, dtype=np.float32).tobytes()) for chunk_hash, embedding in embeddings]
+    with _lock, conn:
+        conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+
+def changed_records(conn, namespace, sized_records):
+    # Drops (record, size) pairs whose content was already upserted into the namespace
+    for record, size in sized_records:
+        with _lock:
+            row = conn.execute("SELECT record_hash FROM upserts WHERE namespace = ? AND vector_id = ?",
+                               (namespace, record['id'])).fetchone()
+        if row is None or row[0] != record_hash(record):
+            yield record, size
+
+def mark_upserted(conn, namespace, records, dataset=""):
+    rows = [(namespace, record['id'], record_hash(record), dataset) for record in records]
+    with _lock, conn:
+        conn.executemany("INSERT OR REPLACE INTO upserts (namespace, vector_id, record_hash, dataset) VALUES (?, ?, ?, ?)", rows)
+
+def stale_upserts(conn, namespace, datasets, current_ids):
+    # Ids upserted into the namespace from these datasets that none of them holds any more
+    placeholders = ",".join("?" * len(datasets))
+    with _lock:
+        rows = conn.execute(f"SELECT vector_id FROM upserts WHERE namespace = ? AND dataset IN ({placeholders})",
+                            (namespace, *datasets)).fetchall()
+    return sorted(vector_id for vector_id, in rows if vector_id not in current_ids)
+
+def forget_upserts(conn, namespace, vector_ids):
+    with _lock, conn:
+        conn.executemany("DELETE FROM upserts WHERE namespace = ? AND vector_id = ?", [(namespace, vector_id) for vector_id in vector_ids])
+
+def clear_upserts(conn, namespace):
+    with _lock, conn:
+        conn.execute("DELETE FROM upserts WHERE namespace = ?", (namespace,))
+
+def get_checkpoint(conn, dataset):
+    # Returns [(item, written)] in listing order, or [] when the dataset has no unfinished ingest
+    with _lock:
+        rows = conn.execute("SELECT item, written FROM checkpoints WHERE dataset = ? ORDER BY position", (dataset,)).fetchall()
+    return [(item, bool(written)) for item, written in rows]
+
+def put_checkpoint(conn, dataset, items):
+    with _lock, conn:
+        conn.execute("DELETE FROM checkpoints WHERE dataset = ?", (dataset,))
+        conn.executemany("INSERT INTO checkpoints (dataset, position, item) VALUES (?, ?, ?)",
+                         [(dataset, position, item) for position, item in enumerate(items)])
+
+def mark_written(conn, dataset, item):
+    with _lock, conn:
+        conn.execute("UPDATE checkpoints SET written = 1 WHERE dataset = ? AND item = ?", (dataset, item))
+
+def clear_checkpoint(conn, dataset):
+    with _lock, conn:
+        conn.execute("DELETE FROM checkpoints WHERE dataset = ?", (dataset,))
@@ -0,0 +1,103 @@
+import queue
+import threading
+
+# Threads connected by bounded queues. Every stage reads items from its inbox and emits items into its outbox;
+# when the stage upstream is done and the inbox is drained, the last worker of the stage passes the end marker on.
+# A full outbox blocks the producer, so a slow stage holds back the stages in front of it instead of letting
+# work pile up in memory. The first error in any stage stops every stage and is raised again by join().
+
+_DONE = object()
+
+class Stopped(Exception):
+    pass
+
+class StagedPipeline:
+    def __init__(self, queue_size=16):
+        self.queue_size = queue_size
+        self.stop = threading.Event()
+        self.errors = []
+        self.threads = []
+
+    def queue(self):
+        return queue.Queue(maxsize=self.queue_size)
+
+    def put(self, outbox, item):
+        while not self.stop.is_set():
+            try:
+                outbox.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+        raise Stopped()
+
+    def get(self, inbox):
+        while not self.stop.is_set():
+            try:
+                return inbox.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        raise Stopped()
+
+    def source(self, name, func, outbox):
+        # func(emit) produces every item of the stage
+        self.stage(name, lambda _, emit: func(emit), None, outbox)
+
+    def stage(self, name, func, inbox, outbox=None, workers=1, batch_size=1):
+        # func(items, emit) is called with up to batch_size items that were waiting in the inbox
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def emit(item):
+            if outbox is not None:
+                self.put(outbox, item)
+
+        def run():
+            try:
+                if inbox is None:
+                    func(None, emit)
+                else:
+                    self.consume(inbox, func, emit, batch_size)
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last and outbox is not None:
+                    self.put(outbox, _DONE)
+            except Stopped:
+                pass
+            except BaseException as error:
+                self.errors.append(error)
+                self.stop.set()
+
+        for worker in range(workers):
+            thread = threading.Thread(target=run, name=f"{name}-{worker}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def consume(self, inbox, func, emit, batch_size):
+        while True:
+            item = self.get(inbox)
+            if item is _DONE:
+                # Leave the marker for the other workers of this stage
+                self.put(inbox, _DONE)
+                return
+            items = [item]
+            while len(items) < batch_size:
+                try:
+                    item = inbox.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    self.put(inbox, _DONE)
+                    break
+                items.append(item)
+            func(items, emit)
+
+    def join(self):
+        try:
+            for thread in self.threads:
+                thread.join()
+        except KeyboardInterrupt:
+            self.stop.set()
+            raise
+        if self.errors:
+            raise self.errors[0]
@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../utils"))
+import data_pipeline
+from pipeline_cache import open_cache
+
+@pytest.fixture
+def data_dirs(tmp_path, monkeypatch):
+    # Temporary jsonl and npy directories, projection file and pipeline cache for data_pipeline.py
+    monkeypatch.setattr(data_pipeline, "DATA_DIR", str(tmp_path / "jsonl"))
+    monkeypatch.setattr(data_pipeline, "NPY_DIR", str(tmp_path / "npy"))
+    monkeypatch.setattr(data_pipeline, "PROJECTION_PATH", str(tmp_path / "npy" / "projection.npz"))
+    cache = open_cache(str(tmp_path / "pipeline.db"))
+    monkeypatch.setattr(data_pipeline, "get_cache", lambda: cache)
+    os.makedirs(tmp_path / "jsonl")
+    os.makedirs(tmp_path / "npy")
+    yield tmp_path
+    cache.close()
@@ -0,0 +1,88 @@
+import re
+
+import pytest
+
+import data_pipeline
+from chunking import split_characters, split_sentences, split_tokens
+
+# Chunk offsets and ids of chunking.py
+
+def check_offsets(text, chunks):
+    for chunk in chunks:
+        assert text[chunk["start"]:chunk["end"]] == chunk["text"]
+        assert chunk["chunk_id"] == chunk["start"]
+    assert len({chunk["chunk_id"] for chunk in chunks}) == len(chunks)
+
+def whitespace_tokenizer(text, add_special_tokens=False, return_offsets_mapping=False):
+    # Stands in for a Hugging Face fast tokenizer: one token per word
+    return {"offset_mapping": [match.span() for match in re.finditer(r'\S+', text)]}
+
+def test_character_chunks_of_repeated_text_have_unique_stable_ids():
+    text = "The same sentence again. " * 100
+    chunks = list(split_characters(text, 100, 20))
+    check_offsets(text, chunks)
+    # Repeated windows have the same text but not the same id
+    assert len({chunk["text"] for chunk in chunks[:-1]}) < len(chunks) - 1
+    assert [chunk["start"] for chunk in chunks] == list(range(0, len(text) - 20, 80))
+    assert chunks[-1]["end"] == len(text)
+    assert list(split_characters(text, 100, 20)) == chunks
+    # Appending text only changes the chunks at the end
+    longer = list(split_characters(text + "A new ending.", 100, 20))
+    assert longer[:len(chunks) - 1] == chunks[:-1]
+
+def test_sentence_chunks_keep_whole_sentences_and_overlap():
+    sentences = [f"Sentence number {i} is here." for i in range(30)]
+    text = ' '.join(sentences)
+    chunks = list(split_sentences(text, 120, 60))
+    check_offsets(text, chunks)
+    for chunk in chunks:
+        assert len(chunk["text"]) <= 120
+        assert chunk["text"].startswith("Sentence") and chunk["text"].endswith(".")
+    for previous, chunk in zip(chunks, chunks[1:]):
+        # The next chunk repeats the trailing sentences that fit in the overlap
+        assert previous["start"] < chunk["start"] < previous["end"]
+        assert previous["end"] - chunk["start"] <= 60
+    assert chunks[-1]["end"] == len(text)
+
+def test_sentence_chunks_of_repeated_sentences_have_unique_ids():
+    text = "Repeated line. " * 50 + "\n\nRepeated line. " * 5
+    chunks = list(split_sentences(text, 64, 16))
+    check_offsets(text, chunks)
+
+def test_sentence_chunks_break_at_paragraphs():
+    text = "First paragraph.\n\nSecond paragraph. Still second."
+    assert [chunk["text"] for chunk in split_sentences(text, 500, 50)] == ["First paragraph.", "Second paragraph. Still second."]
+
+def test_long_sentence_falls_back_to_character_windows():
+    long_sentence = "word " * 60 + "end."
+    text = "Short start. " + long_sentence + " Short end."
+    chunks = list(split_sentences(text, 100, 10))
+    check_offsets(text, chunks)
+    assert chunks[0]["text"] == "Short start."
+    assert chunks[-1]["text"] == "Short end."
+    windows = chunks[1:-1]
+    assert windows[0]["start"] == text.index("word")
+    assert all(len(window["text"]) <= 100 for window in windows)
+    assert [window["start"] for window in windows] == list(range(windows[0]["start"], windows[-1]["start"] + 1, 90))
+
+def test_token_chunks_map_token_windows_back_to_text():
+    text = ' '.join(f"w{i}" for i in range(25))
+    chunks = list(split_tokens(text, whitespace_tokenizer, max_tokens=10, overlap=3))
+    check_offsets(text, chunks)
+    # Windows of 10 tokens that advance by 7, the last one ending at the last token
+    assert [chunk["text"].split() for chunk in chunks] == [[f"w{i}" for i in range(first, min(first + 10, 25))]
+                                                          for first in (0, 7, 14, 21)]
+
+@pytest.mark.parametrize("split", [lambda: split_characters("text " * 50, 10, 10),
+                                   lambda: split_sentences("Text. " * 50, 10, 12),
+                                   lambda: split_tokens("text " * 50, whitespace_tokenizer, 4, 4)])
+def test_overlap_must_be_less_than_the_chunk_size(split):
+    with pytest.raises(ValueError):
+        list(split())
+
+def test_pipeline_rejects_overlap_before_chunking(monkeypatch):
+    monkeypatch.setattr(data_pipeline, "CHUNK_OVERLAP", data_pipeline.CHUNK_SIZE)
+    with pytest.raises(ValueError):
+        data_pipeline.check_chunker("characters")
+    with pytest.raises(ValueError):
+        data_pipeline.check_chunker("sentences")
@@ -0,0 +1,78 @@
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import data_pipeline
+from compression import load_projection, project
+from vector_files import write_vector_file
+
+# compress against temporary jsonl and npy directories
+
+DIMENSION = 16
+
+def make_records(prefix, count, seed):
+    vectors = np.random.default_rng(seed).standard_normal((count, DIMENSION))
+    return [{"id": f"{prefix}#chunk{i}", "values": vector.tolist(), "metadata": {"text": f"{prefix} {i}"}}
+            for i, vector in enumerate(vectors)]
+
+def write_jsonl(name, records):
+    with open(os.path.join(data_pipeline.DATA_DIR, f"{name}.jsonl"), 'w') as f:
+        f.write(''.join(json.dumps(record) + '\n' for record in records))
+
+def npy_records(name):
+    return {record['id']: np.asarray(record['values']) for record, _ in data_pipeline.iter_dataset_records(name)}
+
+@pytest.fixture(autouse=True)
+def directories(data_dirs):
+    return data_dirs
+
+def test_compress_projects_every_dataset_from_its_newest_vectors():
+    both = make_records("both", 20, 0)
+    write_jsonl("both", both)
+    write_vector_file(data_pipeline.NPY_DIR, "both", both)
+    # Written with --format npy after an earlier run left a JSONL file behind
+    write_jsonl("rewritten", make_records("old", 5, 1))
+    rewritten = make_records("new", 20, 2)
+    write_vector_file(data_pipeline.NPY_DIR, "rewritten", rewritten)
+    npy_only = make_records("npy", 20, 3)
+    write_vector_file(data_pipeline.NPY_DIR, "npy_only", npy_only)
+
+    data_pipeline.compress("pca", 4, "float32")
+
+    projection = load_projection(data_pipeline.PROJECTION_PATH)
+    for name, records in (("both", both), ("rewritten", rewritten), ("npy_only", npy_only)):
+        stored = npy_records(name)
+        assert list(stored) == [record['id'] for record in records]
+        # A query projected with the saved projection lands where the stored vector of the same text is
+        for record in records:
+            assert np.allclose(project(record['values'], projection), stored[record['id']], atol=1e-4)
+        # The JSONL file now holds the full-precision vectors the npy file was projected from
+        assert [record['id'] for record in data_pipeline.read_jsonl_records(name)] == [record['id'] for record in records]
+
+def test_compress_can_be_refitted():
+    records = make_records("npy", 30, 4)
+    write_vector_file(data_pipeline.NPY_DIR, "npy_only", records)
+    data_pipeline.compress("pca", 8, "float32")
+    data_pipeline.compress("pca", 4, "float32")
+
+    projection = load_projection(data_pipeline.PROJECTION_PATH)
+    assert projection["dimensions"] == 4
+    stored = npy_records("npy_only")
+    assert all(np.allclose(project(record['values'], projection), stored[record['id']], atol=1e-4) for record in records)
+
+def test_compress_refuses_when_only_compressed_vectors_are_left():
+    records = make_records("npy", 30, 5)
+    write_vector_file(data_pipeline.NPY_DIR, "npy_only", records)
+    data_pipeline.compress("pca", 4, "float32")
+    os.remove(os.path.join(data_pipeline.DATA_DIR, "npy_only.jsonl"))
+    before = npy_records("npy_only")
+
+    data_pipeline.compress("pca", 2, "float32")
+
+    assert load_projection(data_pipeline.PROJECTION_PATH)["dimensions"] == 4
+    after = npy_records("npy_only")
+    assert all(np.array_equal(before[key], after[key]) for key in before)
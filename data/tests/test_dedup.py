@@ -0,0 +1,115 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+import data_pipeline
+from dedup import Deduplicator
+from fakes import FakeIndex, fake_embedding
+
+# Near-duplicate checks of dedup.py, and which dataset keeps a duplicate chunk when DatasetWriter finishes them
+
+WORDS = ("the storm moved north overnight and power was cut to thousands of homes while crews worked to clear "
+         "fallen trees from roads across the county officials said schools would stay closed on monday and "
+         "residents were asked to avoid travel until the roads were safe again").split()
+
+def chunk(source, offset, text, values=None):
+    return {"id": f"doc-{source}#chunk{offset}", "values": values if values is not None else fake_embedding(text, 32),
+            "metadata": {"text": text, "source": source}}
+
+def edited(text, position, word):
+    words = text.split()
+    words[position] = word
+    return ' '.join(words)
+
+STORY = ' '.join(WORDS)
+OTHER = "a new museum opened downtown with an exhibit of paintings from local artists and a cafe on the roof"
+
+def test_text_near_duplicate_is_dropped():
+    deduplicator = Deduplicator(jaccard=0.8, cosine=0)
+    records = [chunk("a", 0, STORY), chunk("b", 0, edited(STORY, 40, "tuesday")), chunk("c", 0, OTHER)]
+    assert deduplicator.filter(records) == [records[0], records[2]]
+    assert (deduplicator.checked, deduplicator.dropped) == (3, 1)
+
+def test_text_below_jaccard_threshold_is_kept():
+    deduplicator = Deduplicator(jaccard=0.8, cosine=0)
+    half = ' '.join(WORDS[:len(WORDS) // 2] + OTHER.split())
+    records = [chunk("a", 0, STORY), chunk("b", 0, half)]
+    assert deduplicator.filter(records) == records
+
+def test_zero_thresholds_disable_the_checks():
+    deduplicator = Deduplicator(jaccard=0, cosine=0)
+    records = [chunk("a", 0, STORY), chunk("b", 0, STORY)]
+    assert deduplicator.filter(records) == records
+
+def test_embedding_near_duplicate_is_dropped():
+    rng = np.random.default_rng(0)
+    vector = rng.standard_normal(32)
+    close = vector + 0.05 * rng.standard_normal(32)
+    far = vector + 0.8 * rng.standard_normal(32)
+    deduplicator = Deduplicator(jaccard=0, cosine=0.97)
+    records = [chunk("a", 0, STORY, vector.tolist()), chunk("b", 0, OTHER, close.tolist()), chunk("c", 0, "far", far.tolist())]
+    assert deduplicator.filter(records) == [records[0], records[2]]
+
+def test_duplicates_are_found_within_and_across_batches():
+    deduplicator = Deduplicator()
+    first = [chunk("a", 0, STORY), chunk("a", 300, STORY), chunk("a", 600, OTHER)]
+    assert deduplicator.filter(first) == [first[0], first[2]]
+    second = [chunk("b", 0, OTHER), chunk("b", 100, "a different story about the weather in another state entirely")]
+    assert deduplicator.filter(second) == [second[1]]
+    assert (deduplicator.checked, deduplicator.dropped) == (5, 2)
+
+def read_dataset(name):
+    with open(os.path.join(data_pipeline.DATA_DIR, f"{name}.jsonl")) as f:
+        return [json.loads(line)['id'] for line in f]
+
+@pytest.mark.parametrize("arrival", [["first", "second"], ["second", "first"]])
+def test_first_dataset_in_order_keeps_the_duplicate(data_dirs, arrival):
+    writer = data_pipeline.DatasetWriter("jsonl", deduplicator=Deduplicator(), order=["first", "second"])
+    items = {"first": ("a", [chunk("a", 0, STORY)]), "second": ("b", [chunk("b", 0, STORY), chunk("b", 300, OTHER)])}
+    for name, (key, _) in items.items():
+        writer.start(name, [(key, False)])
+    for name in arrival:
+        writer.write(name, *items[name])
+
+    assert writer.finished == ["first", "second"]
+    assert read_dataset("first") == ["doc-a#chunk0"]
+    assert read_dataset("second") == ["doc-b#chunk300"]
+
+def test_finished_dataset_waits_for_the_datasets_before_it(data_dirs):
+    finished = []
+    writer = data_pipeline.DatasetWriter("jsonl", deduplicator=Deduplicator(), order=["first", "second"])
+    writer.on_finished = lambda name, records: finished.append((name, [record['id'] for record in records]))
+    writer.start("first", [("a", False)])
+    writer.start("second", [("b", False)])
+    writer.write("second", "b", [chunk("b", 0, STORY)])
+    assert finished == []
+    writer.write("first", "a", [chunk("a", 0, OTHER)])
+    assert finished == [("first", ["doc-a#chunk0"]), ("second", ["doc-b#chunk0"])]
+
+def test_resumed_part_file_records_are_deduplicated(data_dirs):
+    # The crashed run wrote item a, and part of item b's records but not its checkpoint
+    with open(data_pipeline.part_file_path("first"), 'w') as f:
+        f.write(json.dumps(chunk("a", 0, STORY)) + '\n')
+        f.write(json.dumps(chunk("b", 0, OTHER)) + '\n')
+        f.write('{"id": "doc-b#chu')
+    writer = data_pipeline.DatasetWriter("jsonl", deduplicator=Deduplicator(), order=["first"])
+    writer.start("first", [("a", True), ("b", False)])
+    writer.write("first", "b", [chunk("b", 0, edited(STORY, 40, "tuesday")), chunk("b", 300, OTHER)])
+
+    assert read_dataset("first") == ["doc-a#chunk0", "doc-b#chunk300"]
+
+def test_upsert_deletes_vectors_dropped_from_a_dataset(data_dirs):
+    index = FakeIndex()
+    kept, dropped = chunk("a", 0, STORY), chunk("b", 0, OTHER)
+    data_pipeline.write_dataset("first", [kept, dropped], "jsonl")
+    data_pipeline.upsert_dataset(index, "first", "news")
+    data_pipeline.delete_stale_vectors(index, "news", ["first"])
+    assert index.ids["news"] == {kept['id'], dropped['id']}
+
+    data_pipeline.write_dataset("first", [kept], "jsonl")
+    assert data_pipeline.upsert_dataset(index, "first", "news") == 0
+    assert data_pipeline.delete_stale_vectors(index, "news", ["first"]) == 1
+    assert index.ids["news"] == {kept['id']}
+    assert data_pipeline.delete_stale_vectors(index, "news", ["first"]) == 0
@@ -0,0 +1,124 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+import data_pipeline
+
+# The scrape helpers of data_pipeline.py against a local http.server stub instead of cnn.com
+
+SECTION_PAGE = b"""<html><body>
+<a data-link-type="article" href="/2024/01/02/us/first/index.html">First</a>
+<a data-link-type="article" href="/2024/01/02/us/second/index.html">Second</a>
+<a data-link-type="article" href="/2024/01/02/us/first/index.html">First again</a>
+<a data-link-type="video" href="/videos/clip">Video</a>
+<a data-link-type="article" href="/2024/01/02/us/third/index.html">Third</a>
+</body></html>"""
+
+class StubHandler(BaseHTTPRequestHandler):
+    # /flaky fails with 503 for the first server.failures requests; /us is a section page
+    def do_GET(self):
+        self.server.requests.append((self.path, time.monotonic()))
+        if self.path == "/flaky" and sum(path == "/flaky" for path, _ in self.server.requests) <= self.server.failures:
+            self.respond(503, b"unavailable")
+        elif self.path in ("/flaky", "/ok"):
+            self.respond(200, b"ok")
+        elif self.path == "/us":
+            self.respond(200, SECTION_PAGE)
+        else:
+            self.respond(404, b"not found")
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.requests = []
+    server.failures = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(autouse=True)
+def fresh_session(monkeypatch):
+    # Every test gets its own session and host schedule
+    monkeypatch.setattr(data_pipeline, "_session", None)
+    monkeypatch.setattr(data_pipeline, "_host_next_request", {})
+    monkeypatch.setattr(data_pipeline, "REQUESTS_PER_HOST_PER_SECOND", 1000)
+
+def test_http_get_retries_server_errors_with_backoff(server):
+    server.failures = 2
+    start = time.monotonic()
+    response = data_pipeline.http_get(f"{server.url}/flaky")
+    assert response.status_code == 200
+    times = [at for path, at in server.requests if path == "/flaky"]
+    assert len(times) == 3
+    # The first retry is immediate, the second waits backoff_factor * 2 seconds
+    assert times[2] - times[1] >= 0.9
+    assert time.monotonic() - start >= 0.9
+
+def test_http_get_raises_for_client_errors_without_retrying(server):
+    with pytest.raises(Exception):
+        data_pipeline.http_get(f"{server.url}/missing")
+    assert [path for path, _ in server.requests] == ["/missing"]
+
+def test_wait_for_host_spaces_requests_per_host(monkeypatch):
+    monkeypatch.setattr(data_pipeline, "REQUESTS_PER_HOST_PER_SECOND", 10)
+    times = []
+    for url in ("https://www.cnn.com/us", "http://cnn.com/2024/01/02/us/first", "http://cnn.com/2024/01/02/us/second"):
+        data_pipeline.wait_for_host(url)
+        times.append(time.monotonic())
+    # www.cnn.com and cnn.com share one schedule
+    assert times[1] - times[0] >= 0.09
+    assert times[2] - times[1] >= 0.09
+
+    start = time.monotonic()
+    data_pipeline.wait_for_host("https://example.com/")
+    assert time.monotonic() - start < 0.05
+
+def test_get_article_urls_dedups_in_page_order_and_caps(server, monkeypatch):
+    http_get = data_pipeline.http_get
+    monkeypatch.setattr(data_pipeline, "http_get", lambda url: http_get(url.replace("https://www.cnn.com", server.url)))
+
+    urls = data_pipeline.get_article_urls("us", max_articles=10)
+    assert urls == ["http://cnn.com/2024/01/02/us/first/index.html",
+                    "http://cnn.com/2024/01/02/us/second/index.html",
+                    "http://cnn.com/2024/01/02/us/third/index.html"]
+
+    assert data_pipeline.get_article_urls("us", max_articles=2) == urls[:2]
+
+def test_fetch_article_refetches_and_keeps_unchanged_articles(tmp_path, monkeypatch):
+    from pipeline_cache import open_cache, get_article
+    cache = open_cache(str(tmp_path / "pipeline.db"))
+    monkeypatch.setattr(data_pipeline, "get_cache", lambda: cache)
+    url = "http://cnn.com/2024/01/02/us/first/index.html"
+    pages = [{"url": url, "text": "First text", "scrape_date": "01/02/2024"},
+             {"url": url, "text": "First text", "scrape_date": "01/03/2024"},
+             {"url": url, "text": "Edited text", "scrape_date": "01/04/2024"},
+             None]
+    fetches = []
+    monkeypatch.setattr(data_pipeline, "get_article_detail", lambda url: fetches.append(url) or pages[len(fetches) - 1])
+
+    assert data_pipeline.fetch_article("us", url) == pages[0]
+    # Same text: the cached article and its scrape date are kept
+    assert data_pipeline.fetch_article("us", url) == pages[0]
+    # Edited text replaces the cached article
+    assert data_pipeline.fetch_article("us", url) == pages[2]
+    assert get_article(cache, url) == pages[2]
+    # A failed download falls back to the cached article
+    assert data_pipeline.fetch_article("us", url) == pages[2]
+    assert len(fetches) == 4
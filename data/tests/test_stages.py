@@ -0,0 +1,151 @@
+import json
+import threading
+import time
+
+import pytest
+
+import data_pipeline
+from fakes import fake_embedding
+from stages import StagedPipeline
+
+# stages.StagedPipeline, and the checkpointed scrape built on it with DatasetWriter
+
+def test_items_pass_through_stages_with_several_workers():
+    pipeline = StagedPipeline(queue_size=4)
+    numbers, doubled = pipeline.queue(), pipeline.queue()
+    results = []
+    lock = threading.Lock()
+
+    def count(emit):
+        for number in range(100):
+            emit(number)
+
+    def double(items, emit):
+        for number in items:
+            emit(number * 2)
+
+    def collect(items, emit):
+        with lock:
+            results.extend(items)
+
+    pipeline.source("count", count, numbers)
+    pipeline.stage("double", double, numbers, doubled, workers=4, batch_size=5)
+    pipeline.stage("collect", collect, doubled, workers=2)
+    pipeline.join()
+    assert sorted(results) == [number * 2 for number in range(100)]
+
+def test_stage_error_stops_every_stage_and_is_raised_by_join():
+    pipeline = StagedPipeline(queue_size=2)
+    numbers, checked = pipeline.queue(), pipeline.queue()
+    seen = []
+
+    def count_forever(emit):
+        number = 0
+        while True:
+            emit(number)
+            number += 1
+
+    def check(items, emit):
+        for number in items:
+            if number == 10:
+                raise RuntimeError("bad item")
+            emit(number)
+
+    pipeline.source("count", count_forever, numbers)
+    pipeline.stage("check", check, numbers, checked)
+    pipeline.stage("collect", lambda items, emit: seen.extend(items), checked)
+    with pytest.raises(RuntimeError, match="bad item"):
+        pipeline.join()
+    assert pipeline.stop.is_set()
+    assert seen == list(range(len(seen))) and len(seen) <= 10
+
+def record(key, offset):
+    return {"id": f"{key}#chunk{offset}", "values": [0.0], "metadata": {"text": f"{key} {offset}", "source": key}}
+
+def test_resumed_writer_drops_torn_lines_and_unchecked_items(data_dirs):
+    # The crashed run wrote item a, then appended item b's records but crashed before checkpointing b
+    with open(data_pipeline.part_file_path("news"), 'w') as f:
+        f.write(''.join(json.dumps(record(key, offset)) + '\n' for key, offset in (("a", 0), ("a", 100), ("b", 0))))
+        f.write('{"id": "b#chunk100", "val')
+    writer = data_pipeline.DatasetWriter("jsonl")
+    writer.start("news", [("a", True), ("b", False), ("c", False)])
+    with open(data_pipeline.part_file_path("news")) as f:
+        assert [json.loads(line)["id"] for line in f] == ["a#chunk0", "a#chunk100"]
+
+    writer.write("news", "c", [record("c", 0)])
+    writer.write("news", "b", [record("b", 0), record("b", 100)])
+    assert [record["id"] for record in data_pipeline.read_jsonl_records("news")] == \
+        ["a#chunk0", "a#chunk100", "b#chunk0", "b#chunk100", "c#chunk0"]
+
+@pytest.fixture
+def scrape_stubs(data_dirs, monkeypatch):
+    # Sections list three articles each; fetches, embeddings and checkpoints are local and recorded. With crash_after
+    # set, embedding fails once that many articles were embedded and written.
+    stubs = {"fetched": [], "embedded": 0, "written": [], "failing_sections": set(), "crash_after": None}
+    monkeypatch.setattr(data_pipeline, "news_sections", ["us", "world", "politics"])
+    monkeypatch.setattr(data_pipeline, "EMBED_ARTICLES_PER_BATCH", 1)
+
+    def get_article_urls(section, max_articles):
+        if section in stubs["failing_sections"]:
+            raise IOError(f"503 Server Error for https://www.cnn.com/{section}")
+        return [f"http://cnn.com/2024/01/02/{section}/story-{i}/index.html" for i in range(3)][:max_articles]
+
+    def get_article_detail(url):
+        stubs["fetched"].append(url)
+        return {"url": url, "text": f"The text of {url}. " * 5, "scrape_date": "01/02/2024"}
+
+    def embed_texts(texts):
+        if stubs["embedded"] == stubs["crash_after"]:
+            deadline = time.monotonic() + 5
+            while len(stubs["written"]) < stubs["embedded"] and time.monotonic() < deadline:
+                time.sleep(0.01)
+            raise RuntimeError("embedding service unavailable")
+        stubs["embedded"] += 1
+        return [fake_embedding(text, 8) for text in texts]
+
+    def mark_written(conn, dataset, item):
+        write_checkpoint(conn, dataset, item)
+        stubs["written"].append(item)
+
+    monkeypatch.setattr(data_pipeline, "get_article_urls", get_article_urls)
+    monkeypatch.setattr(data_pipeline, "get_article_detail", get_article_detail)
+    monkeypatch.setattr(data_pipeline, "embed_texts", embed_texts)
+    monkeypatch.setattr(data_pipeline, "embedding_model_name", lambda: "fake")
+    write_checkpoint = data_pipeline.mark_written
+    monkeypatch.setattr(data_pipeline, "mark_written", mark_written)
+    return stubs
+
+def dataset_sources(name):
+    records = data_pipeline.read_jsonl_records(name)
+    return None if records is None else sorted({record["metadata"]["source"] for record in records})
+
+def test_resumed_scrape_skips_written_articles(scrape_stubs):
+    # Four of the nine articles are written before the crash
+    scrape_stubs["crash_after"] = 4
+    with pytest.raises(RuntimeError, match="embedding service unavailable"):
+        data_pipeline.scrape(vector_format="jsonl", workers=2, dedup=False)
+    assert len(scrape_stubs["written"]) == 4
+    # A finished section's checkpoint is cleared, so only the written articles of unfinished sections stay skipped
+    skipped = {url for section in data_pipeline.news_sections
+               for url, done in data_pipeline.get_checkpoint(data_pipeline.get_cache(), data_pipeline.dataset_name(section))
+               if done}
+    assert skipped and skipped <= set(scrape_stubs["written"])
+
+    scrape_stubs["crash_after"] = None
+    scrape_stubs["fetched"].clear()
+    data_pipeline.scrape(vector_format="jsonl", workers=2, dedup=False)
+
+    every_url = {url for section in data_pipeline.news_sections for url in data_pipeline.get_article_urls(section, 3)}
+    assert sorted(scrape_stubs["fetched"]) == sorted(every_url - skipped)
+    for section in data_pipeline.news_sections:
+        assert dataset_sources(data_pipeline.dataset_name(section)) == \
+            [f"http://cnn.com/2024/01/02/{section}/story-{i}/index.html" for i in range(3)]
+        assert data_pipeline.get_checkpoint(data_pipeline.get_cache(), data_pipeline.dataset_name(section)) == []
+
+def test_failed_section_listing_skips_only_that_section(scrape_stubs):
+    scrape_stubs["failing_sections"].add("world")
+    data_pipeline.scrape(vector_format="jsonl", workers=2, dedup=True)
+
+    assert dataset_sources("cnn_articles_world") is None
+    for section in ("us", "politics"):
+        assert len(dataset_sources(data_pipeline.dataset_name(section))) == 3
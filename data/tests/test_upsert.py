@@ -0,0 +1,94 @@
+import pytest
+
+import data_pipeline
+from fakes import FakeIndex, fake_embedding
+
+# Incremental upserts of data_pipeline.py into a fake index
+
+def article_dataset(name, text, section="us"):
+    # Writes one article as the scrape does and returns its vector ids
+    article = {"url": f"http://cnn.com/2024/01/02/{name}/index.html", "text": text, "scrape_date": "01/02/2024"}
+    chunks = list(data_pipeline.chunk_text(text, "characters"))
+    records = data_pipeline.article_records(section, article, chunks, [fake_embedding(chunk['text'], 8) for chunk in chunks])
+    data_pipeline.write_dataset(name, records, "jsonl")
+    return {record['id'] for record in records}
+
+@pytest.fixture
+def index(data_dirs, monkeypatch):
+    index = FakeIndex()
+    monkeypatch.setattr(data_pipeline, "create_index", lambda: index)
+    monkeypatch.setattr(data_pipeline, "PINECONE_NAMESPACE", "news")
+    return index
+
+def test_upsert_deletes_chunks_of_an_article_that_got_shorter(index):
+    long_ids = article_dataset("cnn_articles_us", "The storm moved north overnight. " * 60)
+    data_pipeline.upsert()
+    assert index.ids["news"] == long_ids
+
+    short_ids = article_dataset("cnn_articles_us", "The storm moved north overnight. " * 20)
+    assert short_ids < long_ids
+    data_pipeline.upsert()
+    assert index.ids["news"] == short_ids
+
+    # The deleted ids are forgotten, so the same chunks are upserted again when the article grows back
+    article_dataset("cnn_articles_us", "The storm moved north overnight. " * 60)
+    data_pipeline.upsert()
+    assert index.ids["news"] == long_ids
+
+def test_upsert_only_deletes_what_left_the_datasets_of_a_namespace(index):
+    first = article_dataset("pdf-first_lectures", "Lecture one covers vectors. " * 40)
+    second = article_dataset("pdf-second_lectures", "Lecture two covers indexes and queries. " * 40)
+    data_pipeline.upsert_into_namespace()
+    assert not first & second
+    assert index.ids["lectures"] == first | second
+
+    # Vectors of the namespace that were not upserted from a dataset are left alone
+    index.upsert([{"id": "manual"}], namespace="lectures")
+    shorter = article_dataset("pdf-second_lectures", "Lecture two covers indexes and queries. " * 10)
+    data_pipeline.upsert_into_namespace()
+    assert index.ids["lectures"] == first | shorter | {"manual"}
+
+def sized(count, size=100):
+    return [({"id": f"v{i}"}, size) for i in range(count)]
+
+def test_batches_respect_the_vector_and_byte_caps():
+    batches = list(data_pipeline.batch_records(iter(sized(25, 100)), max_vectors=10, max_bytes=350))
+    assert [len(batch) for batch in batches] == [3] * 8 + [1]
+    batches = list(data_pipeline.batch_records(iter(sized(25, 10)), max_vectors=10, max_bytes=350))
+    assert [len(batch) for batch in batches] == [10, 10, 5]
+    assert [record["id"] for batch in batches for record in batch] == [f"v{i}" for i in range(25)]
+
+def test_record_over_the_byte_cap_is_skipped(capsys):
+    records = [({"id": "small"}, 100), ({"id": "huge"}, 1000), ({"id": "last"}, 100)]
+    batches = list(data_pipeline.batch_records(iter(records), max_vectors=10, max_bytes=500))
+    assert batches == [[{"id": "small"}, {"id": "last"}]]
+    assert "Skipped vector huge" in capsys.readouterr().out
+
+class SlowIndex(FakeIndex):
+    # Tracks how many upserts run at the same time
+
+    def __init__(self):
+        super().__init__(latency=0.02)
+        self.active = 0
+        self.max_active = 0
+
+    def upsert(self, vectors, namespace=None, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        try:
+            super().upsert(vectors, namespace, **kwargs)
+        finally:
+            with self.lock:
+                self.active -= 1
+
+def test_upsert_batches_bounds_requests_in_flight_and_reports_every_batch():
+    index = SlowIndex()
+    batches = list(data_pipeline.batch_records(iter(sized(40)), max_vectors=4))
+    seen = []
+    upserted = data_pipeline.upsert_batches(index, iter(batches), "news", max_in_flight=3, on_upserted=seen.append)
+
+    assert upserted == 40
+    assert index.max_active == 3
+    assert sorted(seen, key=lambda batch: batch[0]["id"]) == sorted(batches, key=lambda batch: batch[0]["id"])
+    assert index.ids["news"] == {f"v{i}" for i in range(40)}
@@ -1,226 +1,267 @@
 import os
+import sys
 import json
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import boto3
-import botocore
-from botocore.config import Config
 import time
-from pinecone import ServerlessSpec
-from pinecone import Pinecone
-import vertexai
-from vertexai.generative_models import GenerativeModel
-from vertexai.language_models import TextEmbeddingModel
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../utils"))
+from query_cache import QueryCache
+from namespace_query import metadata_filter, scope_key, query_namespaces, aquery_namespaces
+from providers import get_embedder, get_generator
+from compression import projected_embedder
+from answer_cache import AnswerCache, DataVersions, answer_key
+from retrieval import (DATA_DIR, NPY_DIR, PROJECTION_PATH, VECTOR_BACKEND, LOCAL_INDEX_NPROBE,
+                       LOCAL_INDEX_SECTION_NAMESPACES, RETRIEVAL_TOP_K, QUERY_CACHE_SIZE, QUERY_CACHE_TTL,
+                       QUERY_CACHE_MAX_DISTANCE, ANSWER_CACHE_PATH, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL,
+                       ANSWER_CACHE_VERSION_REFRESH, construct_context, select_contexts, create_prompt)
 # load_dotenv()
 
 API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 PINECONE_NAMESPACE = os.getenv("PINECONE_NAMESPACE")
-DATA_DIR = os.path.join(os.path.dirname(__file__), "./jsonl")
-AWS_TITAN_ENABLED = os.getenv("AWS_TITAN_ENABLED").lower() == 'true'
-GCP_GEMINI_ENABLED = os.getenv("GCP_GEMINI_ENABLED").lower() == 'true'
-GEMINI_PROJECT=os.getenv("GEMINI_PROJECT", "")
-GEMINI_LOCATION=os.getenv("GEMINI_LOCATION", "us-central1")
-GEMINI_MODEL=os.getenv("GEMINI_MODEL", "textembedding-gecko@001")
-GEMINI_TEXT_GEN_MODEL=os.getenv("GEMINI_TEXT_GEN_MODEL", "gemini-1.0-pro")
+# Namespaces queried at the same time when a question searches several of them
+NAMESPACE_QUERY_WORKERS = int(os.getenv("NAMESPACE_QUERY_WORKERS", "8"))
+
+# Batch mode: concurrent calls allowed per stage
+BATCH_EMBED_CONCURRENCY = int(os.getenv("BATCH_EMBED_CONCURRENCY", "4"))
+BATCH_SEARCH_CONCURRENCY = int(os.getenv("BATCH_SEARCH_CONCURRENCY", "8"))
+BATCH_GENERATE_CONCURRENCY = int(os.getenv("BATCH_GENERATE_CONCURRENCY", "4"))
+
+query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_CACHE_MAX_DISTANCE)
 
 def create_pinecone_connection():
+    # Imported here so the actions that never query Pinecone don't pay for loading its client
+    from pinecone import Pinecone
     pc = Pinecone(api_key=API_KEY)
     return pc
 
-def create_bedrock_connection():
-    config = Config(connect_timeout=5, read_timeout=60, retries={"total_max_attempts": 20, "mode": "adaptive"})
-    region = 'us-east-1'
-    bedrock = boto3.client(
-                service_name='bedrock-runtime',
-                region_name=region,
-                endpoint_url=f'https://bedrock-runtime.{region}.amazonaws.com',
-                                    config=config)
-    return bedrock
-
-def create_gemini_connection():
-    vertexai.init(project=GEMINI_PROJECT, location=GEMINI_LOCATION)
-    return vertexai
-
-def titan_text_embeddings(docs: str, bedrock) -> list[float]:
-    body = json.dumps({
-        "inputText": docs,
-    })
-    
-    model_id = 'amazon.titan-embed-text-v1'
-    accept = 'application/json' 
-    content_type = 'application/json'
-    
-    # Invoke model 
-    response = bedrock.invoke_model(
-        body=body, 
-        modelId=model_id, 
-        accept=accept, 
-        contentType=content_type
-    )
-    
-    # Parse response
-    response_body = json.loads(response['body'].read())
-    embedding = response_body.get('embedding')
-    return embedding
-
-def gemini_text_embeddings(docs: str, gemini) -> list[float]:
-    model = TextEmbeddingModel.from_pretrained(GEMINI_MODEL)
-    embeddings = model.get_embeddings([docs])
-    return embeddings[0].values
-
-def gemini_text_generation(prompt: str, gemini) -> str:
-    model = GenerativeModel(GEMINI_TEXT_GEN_MODEL)
-    output = []
-    try:
-        body = json.dumps(model_args(prompt))
-        responses = model.generate_content(body, stream=True)
-        
-        for response in responses:
-            print(response.text, end="")
-                
-    except Exception as error:
-        print(f"Error during Gemini text generation: {error}")
-        
-    return ''.join(output)
-
-def model_args(query):
-    query_model_args = {"prompt": query, "max_tokens_to_sample": 1000, "stop_sequences": [], "temperature": 0.0, "top_p": 0.9 }
-    return query_model_args
-
-def invoke_bedrock(query, bedrock):
-    output = []
-    try:
-        body = json.dumps(model_args(query))
-        modelId = 'anthropic.claude-v2:1'
-        contentType = "application/json"
-        accept = "*/*"
-        response = bedrock.invoke_model_with_response_stream(body=body, modelId=modelId, accept=accept, contentType=contentType)
-        stream = response.get('body')
-        
-        i = 1
-        if stream:
-            for event in stream:
-                chunk = event.get('chunk')
-                if chunk:
-                    chunk_obj = json.loads(chunk.get('bytes').decode())
-                    text = chunk_obj['completion']
-                    output.append(text)
-                    print(text,end='')
-                    i+=1
-                
-    except botocore.exceptions.ClientError as error:
-        
-        if error.response['Error']['Code'] == 'AccessDeniedException':
-            print(f"\x1b[41m{error.response['Error']['Message']}\
-                    \nTo troubeshoot this issue please refer to the following resources.\
-                    \nhttps://docs.aws.amazon.com/IAM/latest/UserGuide/troubleshoot_access-denied.html\
-                    \nhttps://docs.aws.amazon.com/bedrock/latest/userguide/security-iam.html\x1b[0m\n")
-            
-        else:
-            raise error
-        
-def construct_context(contexts: list[str]) -> str:
-    chosen_sections = []
-    chosen_sections_len = 0
-    max_section_len = 1000
-    separator = "\n"
-
-    for text in contexts:
-        text = text.strip()
-        # Add contexts until we run out of space.
-        chosen_sections_len += len(text) + 2
-        if chosen_sections_len > max_section_len:
-            break
-        chosen_sections.append(text)
-    concatenated_doc = separator.join(chosen_sections)
-    return concatenated_doc
-
-def create_prompt(query, context_str):
-    prompt = f"""Human: Answer the following QUESTION based on the CONTEXT
-    given. If you do not know the answer and the CONTEXT doesn't
-    contain the answer truthfully say "I don't know".
+_local_index = None
+_namespace_executor = None
+_answer_cache = None
+_data_versions = None
 
-    QUESTION:
-    {query}
+def get_index(pc):
+    global _local_index
+    if VECTOR_BACKEND == "pinecone":
+        return pc.Index(PINECONE_INDEX_NAME)
+    if _local_index is None:
+        from local_index import load_local_index
+        namespace = None if LOCAL_INDEX_SECTION_NAMESPACES else PINECONE_NAMESPACE
+        _local_index = load_local_index(DATA_DIR, NPY_DIR, namespace, VECTOR_BACKEND, nprobe=LOCAL_INDEX_NPROBE)
+    return _local_index
 
-    CONTEXT:
-    {context_str}
+def get_namespace_executor():
+    global _namespace_executor
+    if _namespace_executor is None:
+        _namespace_executor = ThreadPoolExecutor(max_workers=NAMESPACE_QUERY_WORKERS)
+    return _namespace_executor
 
-    Assistant:
-    """
+def get_answer_cache():
+    global _answer_cache
+    if _answer_cache is None:
+        _answer_cache = AnswerCache(ANSWER_CACHE_PATH, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+    return _answer_cache
 
-    return prompt
+def get_data_versions(pc):
+    global _data_versions
+    if _data_versions is None:
+        _data_versions = DataVersions(get_index(pc), ANSWER_CACHE_VERSION_REFRESH)
+    return _data_versions
 
-        
+def generate(llm_prompt, generator):
+    output = []
+    for text in generator.stream(llm_prompt):
+        output.append(text)
+        print(text, end='')
+    return ''.join(output)
 
-def embed(query, bedrock, gemini):
+def embed(query, embedder):
     print("Query: " + query)
-    if AWS_TITAN_ENABLED:
-        query_embedding = titan_text_embeddings(query, bedrock)
-    elif GCP_GEMINI_ENABLED:
-        query_embedding = gemini_text_embeddings(query, gemini)
+    query_embedding = embedder.embed(query)
     print("Vector embedding generated: " + str(query_embedding))
     return query_embedding
 
-def search(query, bedrock, gemini, pc):
-    index = pc.Index(PINECONE_INDEX_NAME)
-    if AWS_TITAN_ENABLED:
-        query_embedding = titan_text_embeddings(query, bedrock)
-    elif GCP_GEMINI_ENABLED:
-        query_embedding = gemini_text_embeddings(query, gemini)
-    res = index.query(vector=query_embedding, top_k=10, namespace=PINECONE_NAMESPACE,include_metadata=True)
+def retrieve(query, embedder, pc, namespaces=None, filter=None):
+    # Checks the query cache in the same order as main.py: the exact question, then a nearby query embedding
+    namespaces = namespaces or [PINECONE_NAMESPACE]
+    scope = scope_key(namespaces, filter)
+    cached = query_cache.get(query, scope)
+    if cached is not None:
+        return cached
+    query_embedding = embedder.embed(query)
+    search_res = query_cache.get_similar(query_embedding, scope)
+    if search_res is None:
+        index = get_index(pc)
+        search_res = query_namespaces(index, namespaces, RETRIEVAL_TOP_K, get_namespace_executor(),
+                                      vector=query_embedding, filter=filter, include_metadata=True)
+    query_cache.put(query, query_embedding, search_res, scope)
+    return query_embedding, search_res
+
+def search(query, embedder, pc, namespaces=None, filter=None):
+    _, res = retrieve(query, embedder, pc, namespaces, filter)
     print("Semantic Search results: " + str(res))
     return res
 
-def prompt(query, bedrock, gemini, pc):
-    index = pc.Index(PINECONE_INDEX_NAME)
-    if AWS_TITAN_ENABLED:
-        query_embedding = titan_text_embeddings(query, bedrock)
-    elif GCP_GEMINI_ENABLED:
-        query_embedding = gemini_text_embeddings(query, gemini)
-    search_res = index.query(vector=query_embedding, top_k=10, namespace=PINECONE_NAMESPACE,include_metadata=True)
-    contexts = [match.metadata["text"] for match in search_res.matches]
+def prompt(query, embedder, pc, namespaces=None, filter=None):
+    _, search_res = retrieve(query, embedder, pc, namespaces, filter)
+    contexts = select_contexts(query, search_res)
     context_str = construct_context(contexts=contexts)
     llm_prompt = create_prompt(query, context_str)
     print("Prompt generated: " + str(llm_prompt))
     return llm_prompt
 
-def invoke(query, bedrock, gemini, pc):
-    index = pc.Index(PINECONE_INDEX_NAME)
-    if AWS_TITAN_ENABLED:
-        query_embedding = titan_text_embeddings(query, bedrock)
-    elif GCP_GEMINI_ENABLED:
-        query_embedding = gemini_text_embeddings(query, gemini)
-    search_res = index.query(vector=query_embedding, top_k=10, namespace=PINECONE_NAMESPACE,include_metadata=True)
-    contexts = [match.metadata["text"] for match in search_res.matches]
+def invoke(query, embedder, generator, pc, namespaces=None, filter=None):
+    _, search_res = retrieve(query, embedder, pc, namespaces, filter)
+    contexts = select_contexts(query, search_res)
     context_str = construct_context(contexts=contexts)
     llm_prompt = create_prompt(query, context_str)
-    if AWS_TITAN_ENABLED:
-        response = invoke_bedrock(llm_prompt, bedrock)
-    elif GCP_GEMINI_ENABLED:
-        response = gemini_text_generation(llm_prompt, gemini)
-    return response
+    # The same prompt for the same model and data is answered from the answer cache instead of calling the LLM
+    key = answer_key(generator, llm_prompt)
+    data_version = get_data_versions(pc).get(namespaces or [PINECONE_NAMESPACE])
+    answer = get_answer_cache().get(key, data_version)
+    if answer is not None:
+        print(answer, end='')
+        return answer
+    answer = generate(llm_prompt, generator)
+    get_answer_cache().put(key, answer, data_version)
+    return answer
+
+def read_questions(file):
+    # One JSON object per line with a "question" and an optional "id"; plain text lines are accepted too
+    for line_number, line in enumerate(file, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        item = json.loads(line) if line.startswith("{") else {"question": line}
+        item.setdefault("id", line_number)
+        yield item
+
+async def run_batch(file, stage, embedder, generator, pc, out, namespaces=None, filter=None):
+    # Questions go through embed -> search -> prompt -> generate with a concurrency limit per stage. Results are
+    # written as JSONL in completion order, and at most 2x the embedding concurrency batches are read ahead.
+    embed_limit = asyncio.Semaphore(BATCH_EMBED_CONCURRENCY)
+    search_limit = asyncio.Semaphore(BATCH_SEARCH_CONCURRENCY)
+    generate_limit = asyncio.Semaphore(BATCH_GENERATE_CONCURRENCY)
+    read_ahead = asyncio.Semaphore(BATCH_EMBED_CONCURRENCY * 2)
+    # Questions are embedded in batches of the largest size the provider accepts in one request
+    batch_size = embedder.batch_size
+    namespaces = namespaces or [PINECONE_NAMESPACE]
+    scope = scope_key(namespaces, filter)
+
+    def write(result):
+        out.write(json.dumps(result) + '\n')
+        out.flush()
+
+    async def answer(item, query_embedding):
+        result = {"id": item["id"], "question": item["question"]}
+        try:
+            if stage == "embed":
+                result["embedding"] = query_embedding
+                return write(result)
+            async with search_limit:
+                search_res = query_cache.get_similar(query_embedding, scope)
+                if search_res is None:
+                    index = get_index(pc)
+                    search_res = await aquery_namespaces(index, namespaces, RETRIEVAL_TOP_K, vector=query_embedding, filter=filter, include_metadata=True)
+                    query_cache.put(item["question"], query_embedding, search_res, scope)
+            if stage == "search":
+                result["matches"] = [{"id": match.id, "score": match.score, "metadata": match.metadata} for match in search_res.matches]
+                return write(result)
+            contexts = select_contexts(item["question"], search_res)
+            llm_prompt = create_prompt(item["question"], construct_context(contexts=contexts))
+            if stage == "prompt":
+                result["prompt"] = llm_prompt
+                return write(result)
+            # The index stats and the SQLite answer cache are blocking, so they run on the default executor
+            loop = asyncio.get_running_loop()
+            key = answer_key(generator, llm_prompt)
+            data_version = await loop.run_in_executor(None, get_data_versions(pc).get, namespaces)
+            result["answer"] = await loop.run_in_executor(None, get_answer_cache().get, key, data_version)
+            if result["answer"] is None:
+                async with generate_limit:
+                    result["answer"] = await generator.agenerate(llm_prompt)
+                await loop.run_in_executor(None, get_answer_cache().put, key, result["answer"], data_version)
+        except Exception as error:
+            result["error"] = str(error)
+        write(result)
+
+    async def process(items):
+        try:
+            async with embed_limit:
+                embeddings = await embedder.aembed_batch([item["question"] for item in items])
+            await asyncio.gather(*(answer(item, query_embedding) for item, query_embedding in zip(items, embeddings)))
+        except Exception as error:
+            for item in items:
+                write({"id": item["id"], "question": item["question"], "error": str(error)})
+        finally:
+            read_ahead.release()
+
+    # Lines are read on the default executor, so a slow stdin does not stall the questions already in flight
+    loop = asyncio.get_running_loop()
+    questions = read_questions(file)
+    tasks = []
+    batch = []
+    while True:
+        item = await loop.run_in_executor(None, next, questions, None)
+        if item is None:
+            break
+        batch.append(item)
+        if len(batch) == batch_size:
+            await read_ahead.acquire()
+            tasks.append(asyncio.create_task(process(batch)))
+            batch = []
+    if batch:
+        await read_ahead.acquire()
+        tasks.append(asyncio.create_task(process(batch)))
+    await asyncio.gather(*tasks)
+
+def batch(path, stage, embedder, generator, pc, output=None, namespaces=None, filter=None):
+    out = open(output, 'w') if output else sys.stdout
+    try:
+        if path == "-":
+            asyncio.run(run_batch(sys.stdin, stage, embedder, generator, pc, out, namespaces, filter))
+        else:
+            with open(path, 'r') as file:
+                asyncio.run(run_batch(file, stage, embedder, generator, pc, out, namespaces, filter))
+    finally:
+        if output:
+            out.close()
 
 def main():
     parser = argparse.ArgumentParser(description="CLI for querying pinecone index data")
-    parser.add_argument("action", choices=["embed", "search", "prompt", "invoke"], help="Action to perform: 'embed' generate the vector embeddings, 'search' to perform semantic search, 'prompt' to generate the prompt for LLM, 'invoke' to implement RAG")
-    parser.add_argument("query", help="Query to be used for embedding, search, or RAG")
+    parser.add_argument("action", choices=["embed", "search", "prompt", "invoke", "batch"], help="Action to perform: 'embed' generate the vector embeddings, 'search' to perform semantic search, 'prompt' to generate the prompt for LLM, 'invoke' to implement RAG, 'batch' to run a JSONL file of questions")
+    parser.add_argument("query", help="Query to be used for embedding, search, or RAG; for 'batch' a JSONL file of questions or '-' for stdin")
+    parser.add_argument("--stage", choices=["embed", "search", "prompt", "invoke"], default="invoke", help="Last stage to run for each question in batch mode")
+    parser.add_argument("--output", help="Write batch results to this file instead of stdout")
+    parser.add_argument("--namespaces", help="Comma separated namespaces to search concurrently instead of PINECONE_NAMESPACE")
+    parser.add_argument("--sections", help="Comma separated sections to restrict the search to")
+    parser.add_argument("--scrape-dates", help="Comma separated scrape dates (MM/DD/YYYY) to restrict the search to")
     args = parser.parse_args()
     query = args.query
+    namespaces = args.namespaces.split(",") if args.namespaces else None
+    filter = metadata_filter(args.sections.split(",") if args.sections else None,
+                             args.scrape_dates.split(",") if args.scrape_dates else None)
 
-    bedrock = create_bedrock_connection()
-    gemini = create_gemini_connection()
-    pc = create_pinecone_connection()
+    # Providers and clients are only built for the stages the action runs: embed needs the embedder alone, only
+    # the stages after it query the index, and only the pinecone backend needs a client for that
+    stage = args.stage if args.action == "batch" else args.action
+    embedder = projected_embedder(get_embedder(), PROJECTION_PATH)
+    generator = get_generator() if stage == "invoke" else None
+    pc = create_pinecone_connection() if stage != "embed" and VECTOR_BACKEND == "pinecone" else None
 
     if args.action == "embed":
-        embed(query, bedrock, gemini)
+        embed(query, embedder)
     elif args.action == "search":
-        search(query, bedrock, gemini, pc)
+        search(query, embedder, pc, namespaces, filter)
     elif args.action == "prompt":
-        prompt(query, bedrock, gemini, pc)
+        prompt(query, embedder, pc, namespaces, filter)
     elif args.action == "invoke":
-        invoke(query, bedrock, gemini, pc)
+        invoke(query, embedder, generator, pc, namespaces, filter)
+    elif args.action == "batch":
+        batch(query, args.stage, embedder, generator, pc, args.output, namespaces, filter)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
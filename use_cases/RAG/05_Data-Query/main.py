@@ -1,167 +1,295 @@
 from fastapi import FastAPI, Request
 import os
+import sys
 import json
 import argparse
+import asyncio
+import functools
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
-import boto3
-import botocore
-from botocore.config import Config
 import time
-from pinecone import ServerlessSpec
-from pinecone import Pinecone
 from fastapi.staticfiles import StaticFiles
-from google.cloud import aiplatform
+from fastapi.responses import StreamingResponse, PlainTextResponse, JSONResponse
+from starlette.background import BackgroundTask
 
-app = FastAPI()
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../utils"))
+from query_cache import QueryCache, normalize_query
+from local_index import load_local_index
+from namespace_query import metadata_filter, scope_key, aquery_namespaces
+from metrics import Counter, Gauge, span, record_span, add_span_hook, print_span, render
+from admission import ConcurrencyLimit, Overloaded, SingleFlight
+from providers import get_embedder, get_generator
+from compression import projected_embedder
+from answer_cache import AnswerCache, DataVersions, answer_key
 
 load_dotenv()
+# Imported after load_dotenv, so the shared settings see the .env file too
+from retrieval import (DATA_DIR, NPY_DIR, PROJECTION_PATH, VECTOR_BACKEND, LOCAL_INDEX_NPROBE,
+                       LOCAL_INDEX_SECTION_NAMESPACES, RETRIEVAL_TOP_K, QUERY_CACHE_SIZE, QUERY_CACHE_TTL,
+                       QUERY_CACHE_MAX_DISTANCE, ANSWER_CACHE_PATH, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL,
+                       ANSWER_CACHE_VERSION_REFRESH, construct_context, select_contexts, create_prompt)
 API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME = os.getenv("PINECONE_INDEX_NAME")
 PINECONE_NAMESPACE = os.getenv("PINECONE_NAMESPACE")
-AWS_TITAN_ENABLED = os.getenv("AWS_TITAN_ENABLED").lower() == 'true'
-GCP_GEMINI_ENABLED = os.getenv("GCP_GEMINI_ENABLED").lower() == 'true'
+# Upper bound on blocking provider calls running at the same time
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS", "32"))
+# Most namespaces a single question may search; they are queried concurrently on the executor
+MAX_QUERY_NAMESPACES = int(os.getenv("MAX_QUERY_NAMESPACES", "16"))
+# Provider calls in flight at once; further calls wait up to ADMISSION_QUEUE_TIMEOUT seconds in a queue of at
+# most ADMISSION_MAX_QUEUE before the request is rejected with a 429
+EMBED_MAX_CONCURRENCY = int(os.getenv("EMBED_MAX_CONCURRENCY", "16"))
+INDEX_MAX_CONCURRENCY = int(os.getenv("INDEX_MAX_CONCURRENCY", "16"))
+GENERATE_MAX_CONCURRENCY = int(os.getenv("GENERATE_MAX_CONCURRENCY", "8"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "2"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "1"))
+# "true" prints every timed stage (embed, retrieve, pack, first_token, completion) as it ends
+TRACE_SPANS = os.getenv("TRACE_SPANS", "false").lower() == 'true'
+
+REQUESTS = Counter("rag_requests_total", "Questions received", ["endpoint"])
+REQUESTS_IN_FLIGHT = Gauge("rag_requests_in_flight", "Questions currently being answered", ["endpoint"])
+QUERY_CACHE_LOOKUPS = Counter("rag_query_cache_lookups_total", "Query cache lookups by result", ["result"])
+REQUESTS_SHED = Counter("rag_requests_shed_total", "Questions rejected with a 429 because a provider limit was saturated", ["limit"])
+REQUESTS_COALESCED = Counter("rag_requests_coalesced_total", "Questions answered by joining an identical question already in flight")
+ANSWER_CACHE_LOOKUPS = Counter("rag_answer_cache_lookups_total", "Answer cache lookups by result", ["result"])
+if TRACE_SPANS:
+    add_span_hook(print_span)
+
+@asynccontextmanager
+async def lifespan(app):
+    # Clients are created once and shared by every request instead of being rebuilt per question
+    app.state.executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
+    app.state.embedder = projected_embedder(get_embedder(), PROJECTION_PATH)
+    try:
+        app.state.generator = get_generator()
+    except ValueError as error:
+        # E5 only embeds; the app still starts and answers questions with an error instead of failing to boot
+        print(f"No text generation provider: {error}")
+        app.state.generator = None
+    app.state.pc = create_pinecone_connection() if VECTOR_BACKEND == "pinecone" else None
+    app.state.index = create_index(app.state.pc)
+    app.state.query_cache = QueryCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_CACHE_MAX_DISTANCE)
+    app.state.answer_cache = AnswerCache(ANSWER_CACHE_PATH, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+    app.state.data_versions = DataVersions(app.state.index, ANSWER_CACHE_VERSION_REFRESH)
+    app.state.single_flight = SingleFlight()
+    app.state.limits = {name: ConcurrencyLimit(name, limit, ADMISSION_MAX_QUEUE, ADMISSION_QUEUE_TIMEOUT)
+                        for name, limit in (("embed", EMBED_MAX_CONCURRENCY), ("index", INDEX_MAX_CONCURRENCY),
+                                            ("generate", GENERATE_MAX_CONCURRENCY))}
+    await warm_up(app.state)
+    yield
+    app.state.executor.shutdown(wait=False)
+
+app = FastAPI(lifespan=lifespan)
+
+@app.exception_handler(Overloaded)
+async def overloaded(request: Request, error: Overloaded):
+    REQUESTS_SHED.inc(limit=error.limit)
+    return JSONResponse({"error": str(error)}, status_code=429, headers={"Retry-After": str(ADMISSION_RETRY_AFTER)})
+
+async def run_blocking(state, func, *args, **kwargs):
+    # boto3 and the Pinecone client are blocking, so they run on the bounded executor instead of the event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(state.executor, functools.partial(func, *args, **kwargs))
+
+async def warm_up(state):
+    # Open the Pinecone and embedding provider connections before the first question arrives
+    start_time = time.time()
+    try:
+        await run_blocking(state, state.index.describe_index_stats)
+        await state.embedder.aembed("warm up", state.executor)
+    except Exception as error:
+        print(f"Warm up failed: {error}")
+    print(f"Warm up execution time: {(time.time() - start_time) * 1000} ms")
+
+def create_index(pc):
+    if VECTOR_BACKEND == "pinecone":
+        return pc.Index(PINECONE_INDEX_NAME)
+    namespace = None if LOCAL_INDEX_SECTION_NAMESPACES else PINECONE_NAMESPACE
+    return load_local_index(DATA_DIR, NPY_DIR, namespace, VECTOR_BACKEND, nprobe=LOCAL_INDEX_NPROBE)
 
 def create_pinecone_connection():
+    from pinecone import Pinecone
     pc = Pinecone(api_key=API_KEY)
     return pc
 
-def create_bedrock_connection():
-    config = Config(connect_timeout=5, read_timeout=60, retries={"total_max_attempts": 20, "mode": "adaptive"})
-    region = 'us-east-1'
-    bedrock = boto3.client(
-                service_name='bedrock-runtime',
-                region_name=region,
-                endpoint_url=f'https://bedrock-runtime.{region}.amazonaws.com',
-                                    config=config)
-    return bedrock
-
-def create_gemini_connection():
-    aiplatform.init()
-    return aiplatform
-
-def titan_text_embeddings(docs: str, bedrock) -> list[float]:
-    body = json.dumps({
-        "inputText": docs,
-    })
-    
-    model_id = 'amazon.titan-embed-text-v1'
-    accept = 'application/json' 
-    content_type = 'application/json'
-    
-    # Invoke model 
-    response = bedrock.invoke_model(
-        body=body, 
-        modelId=model_id, 
-        accept=accept, 
-        contentType=content_type
-    )
-    
-    # Parse response
-    response_body = json.loads(response['body'].read())
-    embedding = response_body.get('embedding')
-    return embedding
-
-def gemini_text_embeddings(docs: str, gemini) -> list[float]:
-    model = gemini.TextEmbeddingModel.from_pretrained("textembedding-gecko@001")
-    embeddings = model.get_embeddings([docs])
-    return embeddings[0]
-
-def model_args(query):
-    query_model_args = {"prompt": query, "max_tokens_to_sample": 1000, "stop_sequences": [], "temperature": 0.0, "top_p": 0.9 }
-    return query_model_args
-
-def invoke_bedrock(query, bedrock):
-    output = []
-    try:
-        body = json.dumps(model_args(query))
-        modelId = 'anthropic.claude-v2:1'
-        contentType = "application/json"
-        accept = "*/*"
-        response = bedrock.invoke_model_with_response_stream(body=body, modelId=modelId, accept=accept, contentType=contentType)
-        stream = response.get('body')
-        
-        i = 1
-        if stream:
-            for event in stream:
-                chunk = event.get('chunk')
-                if chunk:
-                    chunk_obj = json.loads(chunk.get('bytes').decode())
-                    text = chunk_obj['completion']
-                    output.append(text)
-                    print(text,end='')
-                    i+=1
-        qry_resp = ''.join(output)
-        return qry_resp
-                
-    except botocore.exceptions.ClientError as error:
-        
-        if error.response['Error']['Code'] == 'AccessDeniedException':
-            print(f"\x1b[41m{error.response['Error']['Message']}\
-                    \nTo troubeshoot this issue please refer to the following resources.\
-                    \nhttps://docs.aws.amazon.com/IAM/latest/UserGuide/troubleshoot_access-denied.html\
-                    \nhttps://docs.aws.amazon.com/bedrock/latest/userguide/security-iam.html\x1b[0m\n")
-            
-        else:
-            raise error
-        
-def construct_context(contexts: list[str]) -> str:
-    chosen_sections = []
-    chosen_sections_len = 0
-    max_section_len = 1000
-    separator = "\n"
-
-    for text in contexts:
-        text = text.strip()
-        # Add contexts until we run out of space.
-        chosen_sections_len += len(text) + 2
-        if chosen_sections_len > max_section_len:
-            break
-        chosen_sections.append(text)
-    concatenated_doc = separator.join(chosen_sections)
-    return concatenated_doc
-
-def create_prompt(query, context_str):
-    prompt = f"""Human: Answer the following QUESTION based on the CONTEXT
-    given. If you do not know the answer and the CONTEXT doesn't
-    contain the answer truthfully say "I don't know".
-
-    QUESTION:
-    {query}
-
-    CONTEXT:
-    {context_str}
-
-    Assistant:
-    """
-
-    return prompt
+NO_GENERATOR_ERROR = "No embedding service enabled"
+
+def sse_event(data):
+    return f"data: {json.dumps(data)}\n\n"
+
+def parse_question(body):
+    # Returns (question, namespaces, filter); a malformed body raises ValueError and is answered with a 400
+    if not isinstance(body, dict) or not isinstance(body.get('question'), str) or not body['question'].strip():
+        raise ValueError("question must be a non-empty string")
+    return (body['question'], *parse_scope(body))
+
+def bad_request(error):
+    return JSONResponse({"error": str(error)}, status_code=400)
+
+def parse_scope(body):
+    # Optional "namespaces", "sections" and "scrape_dates" lists in the request body narrow or widen the search
+    namespaces = body.get('namespaces') or [PINECONE_NAMESPACE]
+    if not isinstance(namespaces, list) or len(namespaces) > MAX_QUERY_NAMESPACES:
+        raise ValueError(f"namespaces must be a list of at most {MAX_QUERY_NAMESPACES} namespaces")
+    return namespaces, metadata_filter(string_list(body, 'sections'), string_list(body, 'scrape_dates'))
+
+def string_list(body, name):
+    # A single string stands for a list of one; anything else must be a list of strings
+    values = body.get(name)
+    if isinstance(values, str):
+        return [values]
+    if values is not None and (not isinstance(values, list) or not all(isinstance(value, str) for value in values)):
+        raise ValueError(f"{name} must be a list of strings")
+    return values
+
+async def retrieve(query, state, namespaces, filter=None):
+    # Repeated and near-duplicate questions are answered from the query cache instead of re-embedding and re-querying
+    scope = scope_key(namespaces, filter)
+    cached = state.query_cache.get(query, scope)
+    if cached is not None:
+        QUERY_CACHE_LOOKUPS.inc(result="exact")
+        return cached[1]
+    async with state.limits["embed"].slot():
+        with span("embed"):
+            query_embedding = await state.embedder.aembed(query, state.executor)
 
+    search_res = state.query_cache.get_similar(query_embedding, scope)
+    QUERY_CACHE_LOOKUPS.inc(result="miss" if search_res is None else "semantic")
+    if search_res is None:
+        async with state.limits["index"].slot():
+            with span("retrieve", namespaces=len(namespaces)):
+                search_res = await aquery_namespaces(state.index, namespaces, RETRIEVAL_TOP_K, state.executor,
+                                                     vector=query_embedding, filter=filter, include_metadata=True)
+    state.query_cache.put(query, query_embedding, search_res, scope)
+    return search_res
+
+async def build_prompt(query, state, namespaces, filter=None):
+    search_res = await retrieve(query, state, namespaces, filter)
+
+    with span("pack"):
+        contexts = select_contexts(query, search_res)
+        context_str = construct_context(contexts=contexts)
+        return create_prompt(query, context_str)
+
+async def cached_answer(llm_prompt, state, namespaces):
+    # Returns (cache key, data version, cached answer or None). Looking up the data version may query the index.
+    key = answer_key(state.generator, llm_prompt)
+    data_version = await run_blocking(state, state.data_versions.get, namespaces)
+    answer, result = await run_blocking(state, state.answer_cache.lookup, key, data_version)
+    ANSWER_CACHE_LOOKUPS.inc(result=result)
+    return key, data_version, answer
+
+async def answer_question(query, state, namespaces, filter=None):
+    llm_prompt = await build_prompt(query, state, namespaces, filter)
+    key, data_version, answer = await cached_answer(llm_prompt, state, namespaces)
+    if answer is not None:
+        return answer
+    async with state.limits["generate"].slot():
+        with span("completion"):
+            answer = await state.generator.agenerate(llm_prompt, state.executor)
+    await run_blocking(state, state.answer_cache.put, key, answer, data_version)
+    return answer
+
+def coalesce_key(stage, query, namespaces, filter=None):
+    return (stage, normalize_query(query), scope_key(namespaces, filter))
+
+async def coalesce(state, key, func):
+    # A key that is already in flight is joined instead of run again
+    if key in state.single_flight.calls:
+        REQUESTS_COALESCED.inc()
+    return await state.single_flight.do(key, func)
 
 @app.post("/submit-question")
 async def invoke(request: Request):
-    body = await request.json()
-    query = body['question']
-    bedrock = create_bedrock_connection() if AWS_TITAN_ENABLED else None
-    gemini = create_gemini_connection() if GCP_GEMINI_ENABLED else None
-    pc = create_pinecone_connection()
-    index = pc.Index(PINECONE_INDEX_NAME)
-
-    if AWS_TITAN_ENABLED:
-        query_embedding = titan_text_embeddings(query, bedrock)
-    elif GCP_GEMINI_ENABLED:
-        query_embedding = gemini_text_embeddings(query, gemini)
-    else:
-        return {"error": "No embedding service enabled"}
+    try:
+        # A body that isn't JSON raises a JSONDecodeError, which is a ValueError too
+        query, namespaces, filter = parse_question(await request.json())
+    except ValueError as error:
+        return bad_request(error)
+    state = request.app.state
+    if state.generator is None:
+        return {"error": NO_GENERATOR_ERROR}
+    REQUESTS.inc(endpoint="submit-question")
+    REQUESTS_IN_FLIGHT.inc(endpoint="submit-question")
+    try:
+        # Identical questions arriving while one is being answered share its answer instead of repeating every call
+        response = await coalesce(state, coalesce_key("answer", query, namespaces, filter),
+                                  lambda: answer_question(query, state, namespaces, filter))
+        return {"answer": response}
+    finally:
+        REQUESTS_IN_FLIGHT.dec(endpoint="submit-question")
 
-    start_time = time.time()
-    search_res = index.query(vector=query_embedding, top_k=10, namespace=PINECONE_NAMESPACE,include_metadata=True)
-    end_time = time.time()
-    print(f"Pinecone query execution time: {(end_time - start_time) * 1000} ms")
+@app.post("/submit-question-stream")
+async def invoke_stream(request: Request):
+    # Server-sent events: one {"token": ...} event per completion chunk, then {"done": true}
+    try:
+        # A body that isn't JSON raises a JSONDecodeError, which is a ValueError too
+        query, namespaces, filter = parse_question(await request.json())
+    except ValueError as error:
+        return bad_request(error)
+    state = request.app.state
+    if state.generator is None:
+        return {"error": NO_GENERATOR_ERROR}
+    REQUESTS.inc(endpoint="submit-question-stream")
+    REQUESTS_IN_FLIGHT.inc(endpoint="submit-question-stream")
+    generate_limit = state.limits["generate"]
+    try:
+        # Streams can't share tokens, but identical questions in flight share the retrieval and prompt. A cached
+        # answer needs no generation slot; otherwise the slot is taken before the response starts, so a saturated
+        # LLM still gets a 429.
+        llm_prompt = await coalesce(state, coalesce_key("prompt", query, namespaces, filter),
+                                    lambda: build_prompt(query, state, namespaces, filter))
+        key, data_version, answer = await cached_answer(llm_prompt, state, namespaces)
+        if answer is None:
+            await generate_limit.acquire()
+    except Exception:
+        REQUESTS_IN_FLIGHT.dec(endpoint="submit-question-stream")
+        raise
+
+    if answer is not None:
+        # A cached answer is replayed at once as a single token, without taking a generation slot
+        REQUESTS_IN_FLIGHT.dec(endpoint="submit-question-stream")
+        replay = sse_event({"token": answer}) + sse_event({"done": True})
+        return StreamingResponse(iter([replay]), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+    finished = False
+
+    def finish():
+        # Called when the stream ends and again as a background task, which also runs if the client disconnects
+        # before the stream starts
+        nonlocal finished
+        if not finished:
+            finished = True
+            generate_limit.release()
+            REQUESTS_IN_FLIGHT.dec(endpoint="submit-question-stream")
+
+    async def events():
+        start_time = time.perf_counter()
+        first_token = True
+        tokens = []
+        try:
+            with span("completion"):
+                async for text in state.generator.astream(llm_prompt, state.executor):
+                    if first_token:
+                        record_span("first_token", time.perf_counter() - start_time)
+                        first_token = False
+                    tokens.append(text)
+                    yield sse_event({"token": text})
+            # Only completed answers are cached; a disconnect or an error leaves the loop before this point
+            await run_blocking(state, state.answer_cache.put, key, ''.join(tokens), data_version)
+        except Exception as error:
+            print(f"Error while streaming answer: {error}")
+            yield sse_event({"error": str(error)})
+        finally:
+            finish()
+        yield sse_event({"done": True})
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"},
+                             background=BackgroundTask(finish))
 
-    contexts = [match.metadata["text"] for match in search_res.matches]
-    context_str = construct_context(contexts=contexts)
-    llm_prompt = create_prompt(query, context_str)
-    response = invoke_bedrock(llm_prompt, bedrock)
-    return {"answer": response}
+@app.get("/metrics")
+async def metrics(request: Request):
+    return PlainTextResponse(render(), media_type="text/plain; version=0.0.4")
 
-app.mount("/", StaticFiles(directory="static"), name="static")
\ No newline at end of file
+app.mount("/", StaticFiles(directory=os.path.join(os.path.dirname(__file__), "static")), name="static")
\ No newline at end of file
@@ -0,0 +1,61 @@
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../utils"))
+from rerank import rerank, pack_context
+
+# Retrieval, prompt and cache settings shared by main.py and data_query.py. They are read when this module is first
+# imported, so main.py loads its .env file before importing it.
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "../../../data/jsonl")
+NPY_DIR = os.path.join(os.path.dirname(__file__), "../../../data/npy")
+# Written by data_pipeline.py compress; when it exists query embeddings are projected into the compressed space
+PROJECTION_PATH = os.getenv("PROJECTION_PATH", os.path.join(NPY_DIR, "projection.npz"))
+# "pinecone" queries the hosted index; "exact" and "ivf" search the vectors in DATA_DIR/NPY_DIR in process
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "pinecone")
+LOCAL_INDEX_NPROBE = int(os.getenv("LOCAL_INDEX_NPROBE", "4"))
+# "true" loads each data file into its own section namespace, like data_pipeline.py upsert_into_namespace
+LOCAL_INDEX_SECTION_NAMESPACES = os.getenv("LOCAL_INDEX_SECTION_NAMESPACES", "false").lower() == 'true'
+# Matches requested from the index, and how many of them are kept after reranking
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "10"))
+RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "5"))
+# Weight of the dense scores against BM25 over the retrieved chunks; 1.0 disables BM25
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", "0.7"))
+# Weight of relevance against redundancy when dropping overlapping chunks; 1.0 keeps the relevance order
+MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.7"))
+# Approximate LLM tokens of context put into the prompt
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "512"))
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "300"))
+# Cosine distance under which a cached retrieval result is reused for a different question; 0 disables it
+QUERY_CACHE_MAX_DISTANCE = float(os.getenv("QUERY_CACHE_MAX_DISTANCE", "0.02"))
+# Generated answers are cached on disk by model, generation args and prompt, and reused until ANSWER_CACHE_TTL
+# seconds pass or the vector count of a searched namespace changes (checked every ANSWER_CACHE_VERSION_REFRESH
+# seconds); ANSWER_CACHE_SIZE=0 disables the cache
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", os.path.join(os.path.dirname(__file__), "cache/answers.db"))
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "10000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "86400"))
+ANSWER_CACHE_VERSION_REFRESH = float(os.getenv("ANSWER_CACHE_VERSION_REFRESH", "60"))
+
+def construct_context(contexts: list[str]) -> str:
+    return pack_context(contexts, CONTEXT_MAX_TOKENS)
+
+def select_contexts(query, search_res):
+    matches = rerank(query, search_res.matches, RERANK_TOP_N, HYBRID_ALPHA, MMR_LAMBDA)
+    return [match.metadata["text"] for match in matches]
+
+def create_prompt(query, context_str):
+    prompt = f"""Human: Answer the following QUESTION based on the CONTEXT
+    given. If you do not know the answer and the CONTEXT doesn't
+    contain the answer truthfully say "I don't know".
+
+    QUESTION:
+    {query}
+
+    CONTEXT:
+    {context_str}
+
+    Assistant:
+    """
+
+    return prompt
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../../utils"))
+from admission import ConcurrencyLimit, Overloaded, SingleFlight
+
+# ConcurrencyLimit and SingleFlight of utils/admission.py
+
+async def queued(limit, order, name, hold=0):
+    # Starts a request as a task and returns it once it is waiting in the queue. It holds its slot for hold seconds.
+    async def request():
+        async with limit.slot():
+            order.append(name)
+            await asyncio.sleep(hold)
+    task = asyncio.ensure_future(request())
+    await asyncio.sleep(0)
+    return task
+
+def test_released_slot_goes_to_the_oldest_waiter():
+    async def run():
+        limit = ConcurrencyLimit("generate", 1, max_queue=10, queue_timeout=1)
+        order = []
+        await limit.acquire()
+        tasks = [await queued(limit, order, name) for name in ("first", "second", "third")]
+        limit.release()
+        # A request arriving right after a release queues behind the waiters instead of taking the slot
+        tasks.append(await queued(limit, order, "late"))
+        await asyncio.gather(*tasks)
+        return order, limit
+
+    order, limit = asyncio.run(run())
+    assert order == ["first", "second", "third", "late"]
+    assert (limit.active, len(limit.waiters)) == (0, 0)
+
+def test_full_queue_is_shed_at_once():
+    async def run():
+        limit = ConcurrencyLimit("generate", 1, max_queue=1, queue_timeout=10)
+        await limit.acquire()
+        waiting = await queued(limit, [], "waiting")
+        with pytest.raises(Overloaded):
+            limit.check()
+        with pytest.raises(Overloaded) as error:
+            await limit.acquire()
+        limit.release()
+        await waiting
+        return error.value, limit
+
+    error, limit = asyncio.run(run())
+    assert error.limit == "generate"
+    assert (limit.active, len(limit.waiters)) == (0, 0)
+
+def test_expired_wait_is_shed_and_leaves_the_queue():
+    async def run():
+        limit = ConcurrencyLimit("index", 1, max_queue=10, queue_timeout=0.01)
+        await limit.acquire()
+        with pytest.raises(Overloaded):
+            await limit.acquire()
+        assert len(limit.waiters) == 0
+        limit.release()
+        return limit
+
+    limit = asyncio.run(run())
+    assert (limit.active, len(limit.waiters)) == (0, 0)
+
+def test_waiter_cancelled_after_the_handoff_does_not_leak_the_slot():
+    async def run():
+        limit = ConcurrencyLimit("embed", 1, max_queue=10, queue_timeout=1)
+        order = []
+        await limit.acquire()
+        cancelled = await queued(limit, order, "cancelled", hold=10)
+        next_waiter = await queued(limit, order, "next")
+        # The slot is handed to the first waiter, which is cancelled before it resumes and passes the slot on
+        limit.release()
+        cancelled.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+        await asyncio.wait_for(next_waiter, 0.1)
+        # With nobody left waiting the slot is freed, so a new request gets it at once
+        await asyncio.wait_for(limit.acquire(), 0.1)
+        limit.release()
+        return order, limit
+
+    order, limit = asyncio.run(run())
+    assert order == ["next"]
+    assert (limit.active, len(limit.waiters)) == (0, 0)
+
+def test_active_count_does_not_drift_under_timeouts_and_cancellations():
+    async def run():
+        limit = ConcurrencyLimit("generate", 3, max_queue=5, queue_timeout=0.01)
+        rng = random.Random(0)
+        running = []
+        peak = 0
+        results = {"ok": 0, "shed": 0, "cancelled": 0}
+
+        async def request():
+            nonlocal peak
+            try:
+                async with limit.slot():
+                    running.append(1)
+                    peak = max(peak, len(running))
+                    try:
+                        await asyncio.sleep(rng.random() * 0.01)
+                    finally:
+                        running.pop()
+                results["ok"] += 1
+            except Overloaded:
+                results["shed"] += 1
+
+        tasks = []
+        for _ in range(300):
+            tasks.append(asyncio.ensure_future(request()))
+            if rng.random() < 0.2:
+                rng.choice(tasks).cancel()
+            await asyncio.sleep(rng.random() * 0.001)
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, asyncio.CancelledError):
+                results["cancelled"] += 1
+        return limit, peak, results
+
+    limit, peak, results = asyncio.run(run())
+    assert (limit.active, len(limit.waiters)) == (0, 0)
+    assert peak == 3
+    assert results["ok"] and results["shed"] and results["cancelled"]
+
+def test_single_flight_shares_one_call():
+    async def run():
+        single_flight = SingleFlight()
+        calls = []
+
+        async def answer():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        results = await asyncio.gather(*(single_flight.do("question", answer) for _ in range(5)))
+        return results, calls, single_flight
+
+    results, calls, single_flight = asyncio.run(run())
+    assert results == ["answer"] * 5
+    assert len(calls) == 1
+    assert single_flight.coalesced == 4
+    assert single_flight.calls == {}
+
+def test_single_flight_shares_the_exception_and_runs_again_afterwards():
+    async def run():
+        single_flight = SingleFlight()
+        calls = []
+
+        async def fail():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            raise RuntimeError("provider error")
+
+        results = await asyncio.gather(*(single_flight.do("question", fail) for _ in range(3)), return_exceptions=True)
+        with pytest.raises(RuntimeError):
+            await single_flight.do("question", fail)
+        return results, calls
+
+    results, calls = asyncio.run(run())
+    assert all(isinstance(result, RuntimeError) and str(result) == "provider error" for result in results)
+    assert len(calls) == 2
+
+def test_single_flight_survives_a_cancelled_caller():
+    async def run():
+        single_flight = SingleFlight()
+
+        async def answer():
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        first = asyncio.ensure_future(single_flight.do("question", answer))
+        second = asyncio.ensure_future(single_flight.do("question", answer))
+        await asyncio.sleep(0)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second, single_flight
+
+    result, single_flight = asyncio.run(run())
+    assert result == "answer"
+    assert single_flight.calls == {}
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(os.path.dirname(__file__), "../../../../utils"))
+import main
+from fakes import FakeIndex, FakePinecone, register_fake_provider
+from metrics import add_span_hook, remove_span_hook
+
+# /submit-question-stream against the fake Bedrock provider and an empty fake Pinecone index
+
+@pytest.fixture(autouse=True)
+def settings(tmp_path, monkeypatch):
+    # main.py reads its configuration at import time, so the module settings are patched instead of the environment
+    monkeypatch.setenv("PROVIDER", "fake")
+    monkeypatch.setattr(main, "VECTOR_BACKEND", "pinecone")
+    monkeypatch.setattr(main, "PINECONE_INDEX_NAME", "test")
+    monkeypatch.setattr(main, "PINECONE_NAMESPACE", "test")
+    monkeypatch.setattr(main, "ANSWER_CACHE_PATH", str(tmp_path / "answers.db"))
+    monkeypatch.setattr(main, "create_pinecone_connection", lambda: FakePinecone(FakeIndex()))
+
+@pytest.fixture
+def spans():
+    names = []
+    hook = lambda name, duration, attributes, error: names.append(name)
+    add_span_hook(hook)
+    yield names
+    remove_span_hook(hook)
+
+def ask_stream(question):
+    async def run():
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                async with client.stream("POST", "/submit-question-stream", json={"question": question}) as response:
+                    assert response.status_code == 200
+                    assert response.headers["content-type"].startswith("text/event-stream")
+                    return [json.loads(line[len("data: "):]) async for line in response.aiter_lines() if line.startswith("data: ")]
+    return asyncio.run(run())
+
+def test_stream_sends_tokens_before_done_and_records_first_token(spans):
+    register_fake_provider(token_latency=0.001)
+
+    events = ask_stream("What happened in the world today?")
+
+    assert events[-1] == {"done": True}
+    tokens = events[:-1]
+    assert len(tokens) > 1
+    assert all(set(event) == {"token"} for event in tokens)
+    assert spans.count("first_token") == 1
+    assert spans.index("first_token") < spans.index("completion")
+
+def test_stream_replays_cached_answer_while_generation_is_saturated():
+    register_fake_provider()
+
+    async def run():
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                question = {"question": "Which answer is cached?"}
+                answer = (await client.post("/submit-question", json=question)).json()["answer"]
+                # No free generation slot and no room in the queue
+                generate_limit = main.app.state.limits["generate"]
+                generate_limit.limit, generate_limit.max_queue = 0, 0
+                cached = await client.post("/submit-question-stream", json=question)
+                uncached = await client.post("/submit-question-stream", json={"question": "Which answer is new?"})
+                return answer, cached, uncached
+
+    answer, cached, uncached = asyncio.run(run())
+    assert cached.status_code == 200
+    assert cached.text == main.sse_event({"token": answer}) + main.sse_event({"done": True})
+    assert uncached.status_code == 429
+
+def test_malformed_questions_are_rejected_with_400():
+    register_fake_provider()
+    bodies = [{}, {"question": ""}, {"question": ["two", "questions"]}, ["not an object"],
+              {"question": "Valid?", "namespaces": "news"}, {"question": "Valid?", "sections": [1, 2]},
+              {"question": "Valid?", "scrape_dates": {"from": "07/17/2024"}}]
+
+    async def run():
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                responses = [await client.post(path, json=body) for body in bodies
+                             for path in ("/submit-question", "/submit-question-stream")]
+                responses.append(await client.post("/submit-question", content=b"{not json"))
+                return responses
+
+    for response in asyncio.run(run()):
+        assert response.status_code == 400
+        assert "error" in response.json()
@@ -0,0 +1,99 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+
+# Admission control for the RAG sample app. SingleFlight lets concurrent identical requests share one execution,
+# and ConcurrencyLimit caps the calls in flight to one provider with a bounded, time-limited wait queue. A full
+# queue or an expired wait raises Overloaded, which the app turns into a fast 429 instead of queueing
+# indefinitely behind a throttled provider.
+
+class Overloaded(Exception):
+
+    def __init__(self, limit):
+        super().__init__(f"Too many concurrent requests to {limit}, try again later")
+        self.limit = limit
+
+class ConcurrencyLimit:
+
+    def __init__(self, name, limit, max_queue, queue_timeout):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.waiters = deque()
+
+    def check(self):
+        # Sheds up front when the queue is already full, before any work is done for the request
+        if self.active >= self.limit and len(self.waiters) >= self.max_queue:
+            raise Overloaded(self.name)
+
+    async def acquire(self):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        self.check()
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        self.waiters.append(waiter)
+        # A timer instead of asyncio.wait_for, which before Python 3.12 swallows a cancellation that arrives after
+        # the slot was handed over and leaves the cancelled request holding it
+        timer = loop.call_later(self.queue_timeout, self.expire, waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as the request was cancelled, so pass it on
+                self.release()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+            raise
+        finally:
+            timer.cancel()
+
+    def expire(self, waiter):
+        if not waiter.done():
+            self.waiters.remove(waiter)
+            waiter.set_exception(Overloaded(self.name))
+
+    def release(self):
+        # Hands the slot directly to the oldest waiter so a newly arriving request can't jump the queue
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+class SingleFlight:
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    async def do(self, key, func):
+        # The first caller for a key runs func(); callers arriving before it finishes await the same task. The task
+        # is shielded so a disconnecting caller doesn't cancel it for the others.
+        task = self.calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self.calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self.calls.get(key) is task:
+            del self.calls[key]
+        if not task.cancelled():
+            # Mark the exception as retrieved even if every caller has gone away
+            task.exception()
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Persistent cache of generated answers, shared by data_query.py and the RAG sample app. An answer is keyed by a
+# hash of the model, its generation arguments and the prompt, so it is only reused for the exact same completion
+# request.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    key TEXT PRIMARY KEY,
+    answer TEXT NOT NULL,
+    data_version TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answers_used_at ON answers (used_at);
+"""
+
+def answer_key(generator, prompt):
+    request = {"model": generator.model_name, "args": generator.generation_args, "prompt": prompt}
+    return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+class AnswerCache:
+    # SQLite table of answers. Entries expire after ttl seconds, or earlier when the data version of the namespaces
+    # they were retrieved from changes, and the least recently used entries are evicted beyond max_entries. A
+    # max_entries of 0 disables the cache.
+
+    def __init__(self, path, max_entries=10000, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = {"hit": 0, "stale": 0, "miss": 0}
+        self._lock = threading.Lock()
+        self._conn = None
+        if max_entries > 0:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._conn = sqlite3.connect(path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+
+    def get(self, key, data_version=""):
+        # Returns the cached answer, or None when there is none or it is expired or from another data version
+        return self.lookup(key, data_version)[0]
+
+    def lookup(self, key, data_version=""):
+        # Returns (answer or None, "hit", "stale" or "miss"); a disabled cache always misses
+        if self._conn is None:
+            return None, "miss"
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT answer, data_version, created_at FROM answers WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                result = "miss"
+            elif row[1] != data_version or now - row[2] > self.ttl:
+                self._conn.execute("DELETE FROM answers WHERE key = ?", (key,))
+                result = "stale"
+            else:
+                self._conn.execute("UPDATE answers SET used_at = ? WHERE key = ?", (now, key))
+                result = "hit"
+            self.hits[result] += 1
+            return (row[0] if result == "hit" else None), result
+
+    def put(self, key, answer, data_version=""):
+        # Empty answers, such as those of a generator that swallowed an access error, are not cached
+        if self._conn is None or not answer:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?)", (key, answer, data_version, now, now))
+            excess = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._conn.execute("DELETE FROM answers WHERE key IN (SELECT key FROM answers ORDER BY used_at LIMIT ?)", (excess,))
+
+class DataVersions:
+    # The data version of a set of namespaces is their vector counts in the index, so upserting new vectors or
+    # deleting a namespace invalidates the answers retrieved from it. Counts are re-read at most every refresh
+    # seconds; changes to existing vectors are only picked up by the answer cache TTL.
+
+    def __init__(self, index, refresh=60):
+        self.index = index
+        self.refresh = refresh
+        self._stats = None
+        self._read_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self, namespaces):
+        with self._lock:
+            if self._stats is None or time.monotonic() - self._read_at > self.refresh:
+                self._stats = self.index.describe_index_stats()
+                self._read_at = time.monotonic()
+            stats = self._stats
+        counts = {namespace: vector_count(stats["namespaces"].get(namespace)) for namespace in sorted(namespaces)}
+        return json.dumps(counts, sort_keys=True)
+
+def vector_count(summary):
+    if summary is None:
+        return 0
+    return summary["vector_count"] if isinstance(summary, dict) else summary.vector_count
@@ -0,0 +1,249 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+# Benchmarks for the ingest (data/data_pipeline.py) and query (use_cases/RAG/05_Data-Query) pipelines. Bedrock,
+# Vertex AI and Pinecone are replaced by the deterministic fakes in fakes.py, so results only depend on this
+# machine and on the simulated provider latency. Results are written as JSON.
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DATA_DIR = os.path.join(ROOT_DIR, "data/jsonl")
+QUERY_DIR = os.path.join(ROOT_DIR, "use_cases/RAG/05_Data-Query")
+BENCHMARKS = ["chunking", "embedding", "serialization", "upsert", "retrieval", "context", "submit_question", "startup"]
+# Module-load cost that every action of the CLIs pays, and the packages that must only be imported by the actions
+# that use them
+CLI_SCRIPTS = {"data_pipeline": os.path.join(ROOT_DIR, "data/data_pipeline.py"), "data_query": os.path.join(QUERY_DIR, "data_query.py")}
+STARTUP_BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "500"))
+LAZY_MODULES = ["pinecone", "boto3", "botocore", "vertexai", "transformers", "torch", "pandas", "bs4", "requests", "pymupdf"]
+
+# The pipeline modules read their configuration at import time
+os.environ.update({"PROVIDER": "fake", "AWS_TITAN_ENABLED": "true", "GCP_GEMINI_ENABLED": "false", "PINECONE_API_KEY": "benchmark",
+                   "PINECONE_INDEX_NAME": "benchmark", "PINECONE_NAMESPACE": "benchmark", "VECTOR_BACKEND": "pinecone",
+                   "PIPELINE_CACHE_PATH": os.path.join(tempfile.mkdtemp(prefix="benchmark-cache-"), "pipeline.db"),
+                   "ANSWER_CACHE_PATH": os.path.join(tempfile.mkdtemp(prefix="benchmark-cache-"), "answers.db")})
+sys.path.append(os.path.dirname(__file__))
+sys.path.append(os.path.join(ROOT_DIR, "data"))
+sys.path.append(QUERY_DIR)
+
+from fakes import FakeIndex, FakePinecone, register_fake_provider
+from local_index import LocalIndex, load_local_index
+from providers import get_embedder
+
+def percentile(latencies, q):
+    return float(np.percentile(latencies, q) * 1000) if latencies else None
+
+def summarize(name, latencies, items, elapsed, peak_memory, **extra):
+    return {"name": name,
+            "calls": len(latencies),
+            "items": items,
+            "throughput_per_s": items / elapsed if elapsed else None,
+            "p50_ms": percentile(latencies, 50),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "peak_memory_bytes": peak_memory,
+            **extra}
+
+def measure(name, func, inputs, items_per_call=1, **extra):
+    # Timed pass first, then one traced call to measure peak memory without tracemalloc skewing the latencies
+    latencies = []
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        start_time = time.perf_counter()
+        for value in inputs:
+            call_start = time.perf_counter()
+            func(value)
+            latencies.append(time.perf_counter() - call_start)
+        elapsed = time.perf_counter() - start_time
+        tracemalloc.start()
+        func(inputs[0])
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return summarize(name, latencies, items_per_call * len(inputs), elapsed, peak_memory, **extra)
+
+def load_corpus():
+    records = []
+    for filename in sorted(os.listdir(DATA_DIR)):
+        if filename.endswith(".jsonl"):
+            with open(os.path.join(DATA_DIR, filename), 'r') as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+    articles = {}
+    for record in records:
+        articles.setdefault(record["metadata"]["source"], []).append(record["metadata"]["text"])
+    return records, ["".join(chunks) for chunks in articles.values()]
+
+def questions(records, count):
+    # Numbered so every question misses the query cache
+    return [f"{records[i % len(records)]['metadata']['text'][:80]} #{i}" for i in range(count)]
+
+def bench_chunking(args, records, articles):
+    import data_pipeline
+    return [measure(f"chunking_{chunker}", lambda article: list(data_pipeline.chunk_text(article, chunker)), articles * args.repeat,
+                    chars=sum(len(article) for article in articles) * args.repeat)
+            for chunker in ("characters", "sentences")]
+
+def bench_embedding(args, records, articles):
+    import data_pipeline
+    register_fake_provider(latency=args.latency_ms / 1000, dimension=len(records[0]["values"]))
+    texts = [record["metadata"]["text"] for record in records]
+    batches = [texts[i:i + args.batch_size] for i in range(0, len(texts), args.batch_size)] * args.repeat
+    return [measure("embedding", data_pipeline.embed_texts, batches, items_per_call=len(texts) * args.repeat / len(batches))]
+
+def bench_serialization(args, records, articles):
+    import data_pipeline
+    from vector_files import write_vector_file
+    directory = tempfile.mkdtemp(prefix="benchmark-vectors-")
+    data_pipeline.DATA_DIR = data_pipeline.NPY_DIR = directory
+
+    def write_jsonl(_):
+        with open(os.path.join(directory, "bench_jsonl.jsonl"), 'w') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def read(name):
+        for _ in data_pipeline.iter_dataset_records(name):
+            pass
+
+    results = [measure("serialization_write_jsonl", write_jsonl, [None] * args.repeat, items_per_call=len(records)),
+               measure("serialization_write_npy", lambda _: write_vector_file(directory, "bench_npy", records),
+                       [None] * args.repeat, items_per_call=len(records)),
+               measure("serialization_read_jsonl", read, ["bench_jsonl"] * args.repeat, items_per_call=len(records)),
+               measure("serialization_read_npy", read, ["bench_npy"] * args.repeat, items_per_call=len(records))]
+    for result in results:
+        result["file_bytes"] = sum(os.path.getsize(os.path.join(directory, filename)) for filename in os.listdir(directory)
+                                   if filename.startswith("bench_" + result["name"].split("_")[-1]))
+    return results
+
+def bench_upsert(args, records, articles):
+    import data_pipeline
+    index = FakeIndex(latency=args.latency_ms / 1000)
+    sized_records = [(record, len(json.dumps(record))) for record in records]
+    upsert = lambda _: data_pipeline.upsert_batches(index, data_pipeline.batch_records(iter(sized_records)), "benchmark")
+    return [measure("upsert", upsert, [None] * args.repeat, items_per_call=len(records))]
+
+def bench_retrieval(args, records, articles):
+    import data_query
+    exact = load_local_index(DATA_DIR, "", namespace="benchmark")
+    ivf = LocalIndex("ivf", nprobe=4)
+    ivf.namespaces = {"benchmark": {key: exact.namespaces["benchmark"][key] for key in ("ids", "metadata", "vectors")}}
+    ivf.build()
+    vectors = [record["values"] for record in records] * args.repeat
+    query = lambda index: (lambda vector: index.query(vector=vector, top_k=10, namespace="benchmark", include_metadata=True))
+
+    register_fake_provider(latency=args.latency_ms / 1000, dimension=len(records[0]["values"]))
+    embedder = get_embedder()
+    pc = FakePinecone(FakeIndex(exact, latency=args.latency_ms / 1000))
+    retrieve = lambda question: data_query.retrieve(question, embedder, pc)
+    return [measure("retrieval_local_exact", query(exact), vectors),
+            measure("retrieval_local_ivf", query(ivf), vectors),
+            measure("retrieval_embed_and_query", retrieve, questions(records, args.requests))]
+
+def bench_context(args, records, articles):
+    import data_query
+    contexts = [[record["metadata"]["text"] for record in records[i:i + 10]] for i in range(0, len(records), 10)] * args.repeat
+    build = lambda texts: data_query.create_prompt("benchmark question", data_query.construct_context(contexts=texts))
+    index = load_local_index(DATA_DIR, "", namespace="benchmark")
+    results = [index.query(vector=record["values"], top_k=10, namespace="benchmark", include_metadata=True) for record in records]
+    select = lambda search_res: data_query.select_contexts(search_res.matches[0].metadata["text"][:80], search_res)
+    return [measure("context_and_prompt", build, contexts),
+            measure("rerank", select, results * args.repeat)]
+
+def bench_submit_question(args, records, articles):
+    import httpx
+    import main
+    fake_index = FakeIndex(load_local_index(DATA_DIR, "", namespace="benchmark"), latency=args.latency_ms / 1000)
+    register_fake_provider(latency=args.latency_ms / 1000, token_latency=args.token_latency_ms / 1000,
+                           dimension=len(records[0]["values"]))
+    main.create_pinecone_connection = lambda: FakePinecone(fake_index)
+
+    async def run():
+        latencies = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+        async with main.app.router.lifespan_context(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=None) as client:
+                async def ask(question):
+                    async with semaphore:
+                        call_start = time.perf_counter()
+                        response = await client.post("/submit-question", json={"question": question})
+                        response.raise_for_status()
+                        latencies.append(time.perf_counter() - call_start)
+
+                start_time = time.perf_counter()
+                await asyncio.gather(*(ask(question) for question in questions(records, args.requests)))
+                return latencies, time.perf_counter() - start_time
+
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        tracemalloc.start()
+        latencies, elapsed = asyncio.run(run())
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return [summarize("submit_question", latencies, len(latencies), elapsed, peak_memory, concurrency=args.concurrency)]
+
+def import_times(script):
+    # Runs the CLI's --help under -X importtime, which loads every module the script imports at the top but no
+    # action. Returns the total import time in seconds and the top-level packages that were imported.
+    result = subprocess.run([sys.executable, "-X", "importtime", script, "--help"], capture_output=True, text=True, check=True)
+    total_us = 0
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        packages.add(name.strip().split(".")[0])
+        # Nested imports are indented and already counted in the cumulative time of their parent
+        if not name[1:].startswith(" "):
+            total_us += int(cumulative)
+    return total_us / 1e6, packages
+
+def bench_startup(args, records, articles):
+    results = []
+    for name, script in CLI_SCRIPTS.items():
+        latencies = []
+        for _ in range(args.repeat):
+            seconds, packages = import_times(script)
+            latencies.append(seconds)
+        eager = sorted(packages & set(LAZY_MODULES))
+        p50_ms = percentile(latencies, 50)
+        results.append(summarize(f"startup_{name}", latencies, len(latencies), sum(latencies), None,
+                                 budget_ms=args.startup_budget_ms, eager_imports=eager,
+                                 within_budget=p50_ms <= args.startup_budget_ms and not eager))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the ingest and query pipelines with fake providers")
+    parser.add_argument("--only", default=",".join(BENCHMARKS), help=f"Comma separated benchmarks to run: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--output", help="Write the JSON results to this file instead of stdout")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Simulated latency of each provider call")
+    parser.add_argument("--token-latency-ms", type=float, default=0.0, help="Simulated delay between streamed LLM tokens")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of passes over the corpus")
+    parser.add_argument("--batch-size", type=int, default=16, help="Embedding batch size")
+    parser.add_argument("--requests", type=int, default=200, help="Number of questions for the query benchmarks")
+    parser.add_argument("--concurrency", type=int, default=16, help="Concurrent /submit-question requests")
+    parser.add_argument("--startup-budget-ms", type=float, default=STARTUP_BUDGET_MS, help="Largest median import time of a CLI")
+    args = parser.parse_args()
+
+    records, articles = load_corpus()
+    results = []
+    for name in args.only.split(","):
+        results.extend(globals()[f"bench_{name.strip()}"](args, records, articles))
+
+    report = {"python": platform.python_version(), "platform": platform.platform(), "args": vars(args), "results": results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+    # A CLI over its startup budget, or importing a package eagerly, fails the run so it can gate CI
+    if any(result.get("within_budget") is False for result in results):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
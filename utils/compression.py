@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import time
+import numpy as np
+from providers import Embedder
+from local_index import normalize_rows, top_k_indices
+from vector_files import dequantize, quantize
+
+# Dimensionality reduction for stored embeddings. "pca" projects onto the principal components of the corpus;
+# "truncate" keeps the leading dimensions, which only preserves quality for Matryoshka-trained models. The
+# projection fitted by data/data_pipeline.py compress is saved next to the npy files, and queries must be
+# projected with the same file (see ProjectedEmbedder).
+
+PROJECTION_METHODS = ["pca", "truncate"]
+
+def fit_projection(matrix, method, dimensions, sample=10000, seed=0):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if method == "truncate":
+        dimensions = min(dimensions, matrix.shape[1])
+        return {"method": method, "dimensions": dimensions}
+    if method != "pca":
+        raise ValueError(f"Unknown projection method: {method}")
+    # PCA is fitted on a sample; more vectors than that don't change the components much
+    if len(matrix) > sample:
+        matrix = matrix[np.random.default_rng(seed).choice(len(matrix), size=sample, replace=False)]
+    mean = matrix.mean(axis=0)
+    _, _, components = np.linalg.svd(matrix - mean, full_matrices=False)
+    dimensions = min(dimensions, len(components))
+    return {"method": method, "dimensions": dimensions, "mean": mean, "components": components[:dimensions]}
+
+def project(matrix, projection):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if projection["method"] == "truncate":
+        return np.ascontiguousarray(matrix[..., :projection["dimensions"]])
+    return (matrix - projection["mean"]) @ projection["components"].T
+
+def project_records(records, projection):
+    if not records:
+        return records
+    vectors = project([record['values'] for record in records], projection)
+    return [{**record, 'values': vector.tolist()} for record, vector in zip(records, vectors)]
+
+def save_projection(path, projection):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    arrays = {key: value for key, value in projection.items() if isinstance(value, np.ndarray)}
+    with open(path + ".tmp", 'wb') as f:
+        np.savez(f, method=projection["method"], dimensions=projection["dimensions"], **arrays)
+    os.replace(path + ".tmp", path)
+
+def load_projection(path):
+    with np.load(path) as data:
+        projection = {key: data[key] for key in data.files}
+    projection["method"] = str(projection["method"])
+    projection["dimensions"] = int(projection["dimensions"])
+    return projection
+
+class ProjectedEmbedder(Embedder):
+    # Embeds with the wrapped provider, then projects into the space of the compressed corpus
+
+    def __init__(self, embedder, projection):
+        self.embedder = embedder
+        self.projection = projection
+        self.batch_size = embedder.batch_size
+
+    @property
+    def model_name(self):
+        return f"{self.embedder.model_name}:{self.projection['method']}{self.projection['dimensions']}"
+
+    def embed_batch(self, texts):
+        return project(self.embedder.embed_batch(texts), self.projection).tolist()
+
+def projected_embedder(embedder, projection_path):
+    # Queries against a compressed corpus have to be projected the same way; without a projection file the
+    # embedder is returned unchanged
+    if not projection_path or not os.path.exists(projection_path):
+        return embedder
+    return ProjectedEmbedder(embedder, load_projection(projection_path))
+
+def load_corpus(data_dir):
+    vectors = []
+    for filename in sorted(os.listdir(data_dir)):
+        if filename.endswith(".jsonl"):
+            with open(os.path.join(data_dir, filename), 'r') as f:
+                vectors.extend(json.loads(line)["values"] for line in f if line.strip())
+    return np.asarray(vectors, dtype=np.float32)
+
+def search(matrix, queries, top_k):
+    # Exact cosine search that skips each query's own row, since the queries are taken from the corpus
+    scores = normalize_rows(queries) @ normalize_rows(matrix).T
+    return [set(top_k_indices(row, top_k + 1).tolist()) for row in scores]
+
+def evaluate(data_dir, methods=("pca", "truncate"), dimensions=(64, 128, 256, 512), dtypes=("float32", "float16", "int8"),
+             top_k=10, queries=100, seed=0):
+    # Recall@k of search over compressed vectors against search over the full-precision vectors
+    matrix = load_corpus(data_dir)
+    rows = np.random.default_rng(seed).choice(len(matrix), size=min(queries, len(matrix)), replace=False)
+    truth = [found - {row} for found, row in zip(search(matrix, matrix[rows], top_k), rows)]
+    results = [{"method": "none", "dimensions": matrix.shape[1], "dtype": "float32", "recall": 1.0,
+                "bytes_per_vector": matrix.shape[1] * 4}]
+
+    for method in methods:
+        for requested in dimensions:
+            projection = fit_projection(matrix, method, requested)
+            if projection["dimensions"] != requested:
+                continue
+            projected = project(matrix, projection)
+            for dtype in dtypes:
+                if dtype == "int8":
+                    stored = dequantize(*quantize(projected))
+                else:
+                    stored = projected.astype(dtype).astype(np.float32)
+                start_time = time.time()
+                found = search(stored, projected[rows], top_k)
+                latency_ms = (time.time() - start_time) * 1000 / len(rows)
+                recall = np.mean([len((f - {row}) & t) / len(t) for f, t, row in zip(found, truth, rows)])
+                results.append({"method": method, "dimensions": requested, "dtype": dtype, "recall": float(recall),
+                                "bytes_per_vector": requested * np.dtype(dtype).itemsize, "latency_ms": latency_ms})
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare recall of compressed and full-precision vectors")
+    parser.add_argument("--data-dir", default=os.path.join(os.path.dirname(__file__), "../data/jsonl"), help="Directory with the JSONL vector files")
+    parser.add_argument("--methods", default=",".join(PROJECTION_METHODS))
+    parser.add_argument("--dimensions", default="64,128,256,512")
+    parser.add_argument("--dtypes", default="float32,float16,int8")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+
+    results = evaluate(args.data_dir, args.methods.split(","), [int(d) for d in args.dimensions.split(",")],
+                       args.dtypes.split(","), args.top_k, args.queries)
+    print(f"{'method':<10}{'dims':>6}{'dtype':>9}{'recall@' + str(args.top_k):>12}{'bytes':>8}{'latency ms':>12}")
+    for result in results:
+        latency = f"{result['latency_ms']:.3f}" if 'latency_ms' in result else '-'
+        print(f"{result['method']:<10}{result['dimensions']:>6}{result['dtype']:>9}{result['recall']:>12.3f}{result['bytes_per_vector']:>8}{latency:>12}")
+
+if __name__ == "__main__":
+    main()
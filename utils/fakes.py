@@ -0,0 +1,104 @@
+import hashlib
+import io
+import json
+import threading
+import time
+from types import SimpleNamespace
+import numpy as np
+from providers import ClaudeGenerator, TitanEmbedder, register_provider
+
+# Deterministic stand-ins for the Bedrock, Vertex AI and Pinecone clients, used by the benchmarks. Each call can
+# sleep for a fixed latency to simulate the network round trip of the real service.
+
+def fake_embedding(text, dimension=1024):
+    seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimension).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+def fake_completion(prompt, tokens=50):
+    words = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+    return [f"{words[i % len(words):i % len(words) + 4]} " for i in range(tokens)]
+
+class FakeBedrock:
+    # Titan embeddings through invoke_model and Claude completions through invoke_model_with_response_stream
+
+    def __init__(self, latency=0.0, token_latency=0.0, dimension=1024, tokens=50):
+        self.latency = latency
+        self.token_latency = token_latency
+        self.dimension = dimension
+        self.tokens = tokens
+
+    def invoke_model(self, body, modelId, accept, contentType):
+        time.sleep(self.latency)
+        text = json.loads(body)["inputText"]
+        return {"body": io.BytesIO(json.dumps({"embedding": fake_embedding(text, self.dimension)}).encode())}
+
+    def invoke_model_with_response_stream(self, body, modelId, accept, contentType):
+        time.sleep(self.latency)
+        prompt = json.loads(body)["prompt"]
+        return {"body": self._events(fake_completion(prompt, self.tokens))}
+
+    def _events(self, words):
+        for word in words:
+            time.sleep(self.token_latency)
+            yield {"chunk": {"bytes": json.dumps({"completion": word}).encode()}}
+
+class FakeGeminiEmbeddingModel:
+
+    def __init__(self, latency=0.0, dimension=768):
+        self.latency = latency
+        self.dimension = dimension
+
+    def get_embeddings(self, texts):
+        time.sleep(self.latency)
+        return [SimpleNamespace(values=fake_embedding(text, self.dimension)) for text in texts]
+
+class FakeIndex:
+    # Queries are answered by an optional LocalIndex so retrieval returns real corpus text. The ids of upserted
+    # vectors are kept per namespace, so upserts and deletes can be checked.
+
+    def __init__(self, local_index=None, latency=0.0):
+        self.local_index = local_index
+        self.latency = latency
+        self.upserted = 0
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def upsert(self, vectors, namespace=None, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.upserted += len(vectors)
+            self.ids.setdefault(namespace, set()).update(vector['id'] for vector in vectors)
+
+    def query(self, **kwargs):
+        time.sleep(self.latency)
+        if self.local_index is None:
+            return SimpleNamespace(matches=[], namespace=kwargs.get("namespace"))
+        return self.local_index.query(**kwargs)
+
+    def describe_index_stats(self, **kwargs):
+        if self.local_index is None:
+            return {"namespaces": {}, "total_vector_count": 0}
+        return self.local_index.describe_index_stats()
+
+    def delete(self, ids=None, namespace=None, delete_all=False, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            if delete_all:
+                self.ids.pop(namespace, None)
+            else:
+                self.ids.get(namespace, set()).difference_update(ids or ())
+
+class FakePinecone:
+
+    def __init__(self, index):
+        self.index = index
+
+    def Index(self, name="", **kwargs):
+        return self.index
+
+def register_fake_provider(name="fake", latency=0.0, token_latency=0.0, dimension=1024):
+    # The real Titan and Claude provider classes on top of FakeBedrock, so response parsing is exercised too
+    bedrock = FakeBedrock(latency, token_latency, dimension)
+    register_provider(name, embedder=lambda: TitanEmbedder(bedrock), generator=lambda: ClaudeGenerator(bedrock))
+    return bedrock
@@ -0,0 +1,195 @@
+import argparse
+import json
+import os
+import time
+from types import SimpleNamespace
+import numpy as np
+from vector_files import list_vector_files, load_vectors, vector_file_paths
+
+# In-process replacement for a Pinecone index handle, loaded from the files written by data/data_pipeline.py.
+# query() takes the same arguments as Index.query and returns an object with the same .matches shape, so it can
+# be used wherever the RAG code expects a Pinecone index. Scores are cosine similarities.
+
+class LocalIndex:
+
+    def __init__(self, algorithm="exact", nlist=None, nprobe=4, seed=0):
+        if algorithm not in ("exact", "ivf"):
+            raise ValueError(f"Unknown local index algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.seed = seed
+        self.namespaces = {}
+
+    def add(self, namespace, ids, metadata, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.size == 0:
+            return
+        part = self.namespaces.setdefault(namespace, {"ids": [], "metadata": [], "vectors": []})
+        part["ids"].extend(ids)
+        part["metadata"].extend(metadata)
+        part["vectors"].append(vectors)
+        part.pop("matrix", None)
+
+    def build(self):
+        # Normalizes the vectors of every namespace and, for IVF, clusters them into inverted lists
+        for part in self.namespaces.values():
+            matrix = np.concatenate(part["vectors"]) if len(part["vectors"]) > 1 else part["vectors"][0]
+            part["vectors"] = [matrix]
+            part["matrix"] = normalize_rows(matrix)
+            part["columns"] = {}
+            if self.algorithm == "ivf":
+                nlist = self.nlist or max(1, int(np.sqrt(len(matrix))))
+                part["centroids"], assignments = kmeans(part["matrix"], nlist, seed=self.seed)
+                part["lists"] = [np.flatnonzero(assignments == cluster) for cluster in range(len(part["centroids"]))]
+        return self
+
+    def describe_index_stats(self):
+        return {"namespaces": {namespace: {"vector_count": len(part["ids"])} for namespace, part in self.namespaces.items()},
+                "total_vector_count": sum(len(part["ids"]) for part in self.namespaces.values())}
+
+    def query(self, vector, top_k=10, namespace="", include_metadata=False, include_values=False, filter=None, **kwargs):
+        part = self.namespaces.get(namespace or "")
+        if part is None:
+            return SimpleNamespace(matches=[], namespace=namespace)
+        if "matrix" not in part:
+            self.build()
+
+        query = normalize_rows(np.asarray(vector, dtype=np.float32)[None, :])[0]
+        rows = self._candidate_rows(part, query)
+        if filter:
+            mask = filter_mask(part, filter)
+            rows = np.flatnonzero(mask) if rows is None else rows[mask[rows]]
+        scores = part["matrix"] @ query if rows is None else part["matrix"][rows] @ query
+
+        top = top_k_indices(scores, top_k)
+        matches = []
+        for i in top:
+            row = int(i) if rows is None else int(rows[i])
+            matches.append(SimpleNamespace(id=part["ids"][row],
+                                           score=float(scores[i]),
+                                           metadata=part["metadata"][row] if include_metadata else None,
+                                           values=part["vectors"][0][row].tolist() if include_values else []))
+        return SimpleNamespace(matches=matches, namespace=namespace)
+
+    def _candidate_rows(self, part, query):
+        # None means every row; IVF only scores the rows of the nprobe closest clusters
+        if self.algorithm != "ivf":
+            return None
+        probes = top_k_indices(part["centroids"] @ query, self.nprobe)
+        return np.sort(np.concatenate([part["lists"][cluster] for cluster in probes]))
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).astype(np.float32)
+
+def top_k_indices(scores, top_k):
+    if len(scores) <= top_k:
+        return np.argsort(-scores)
+    top = np.argpartition(-scores, top_k)[:top_k]
+    return top[np.argsort(-scores[top])]
+
+def kmeans(matrix, k, iterations=10, seed=0):
+    # Spherical k-means on unit vectors; empty clusters keep their previous centroid
+    rng = np.random.default_rng(seed)
+    k = min(k, len(matrix))
+    centroids = matrix[rng.choice(len(matrix), size=k, replace=False)]
+    for _ in range(iterations):
+        assignments = np.argmax(matrix @ centroids.T, axis=1)
+        for cluster in range(k):
+            members = matrix[assignments == cluster]
+            if len(members):
+                centroids[cluster] = members.mean(axis=0)
+        centroids = normalize_rows(centroids)
+    return centroids, np.argmax(matrix @ centroids.T, axis=1)
+
+def filter_mask(part, filter):
+    # Supports the Pinecone filter operators used by the workshop: $eq, $ne, $in, $nin, $and, $or
+    mask = np.ones(len(part["ids"]), dtype=bool)
+    for field, condition in filter.items():
+        if field == "$and":
+            for sub_filter in condition:
+                mask &= filter_mask(part, sub_filter)
+            continue
+        if field == "$or":
+            mask &= np.logical_or.reduce([filter_mask(part, sub_filter) for sub_filter in condition])
+            continue
+        if field not in part["columns"]:
+            part["columns"][field] = np.array([metadata.get(field) for metadata in part["metadata"]], dtype=object)
+        column = part["columns"][field]
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, value in condition.items():
+            if operator == "$eq":
+                mask &= column == value
+            elif operator == "$ne":
+                mask &= column != value
+            elif operator == "$in":
+                mask &= np.isin(column, list(value))
+            elif operator == "$nin":
+                mask &= ~np.isin(column, list(value))
+            else:
+                raise ValueError(f"Unsupported filter operator: {operator}")
+    return mask
+
+def load_local_index(data_dir, npy_dir, namespace=None, algorithm="exact", nlist=None, nprobe=4):
+    # With a namespace every dataset is loaded into it, like data_pipeline.py upsert. Without one each dataset
+    # gets its own section namespace, like data_pipeline.py upsert_into_namespace.
+    index = LocalIndex(algorithm, nlist, nprobe)
+    npy_names = set(list_vector_files(npy_dir))
+    jsonl_names = {filename[:-len(".jsonl")] for filename in os.listdir(data_dir) if filename.endswith(".jsonl")} if os.path.isdir(data_dir) else set()
+    for name in sorted(npy_names | jsonl_names):
+        target = namespace if namespace is not None else name.split("_")[-1]
+        if name in npy_names:
+            _, meta_path = vector_file_paths(npy_dir, name)
+            with open(meta_path, 'r') as f:
+                rows = [json.loads(line) for line in f]
+            vectors = load_vectors(npy_dir, name)
+        else:
+            with open(os.path.join(data_dir, f"{name}.jsonl"), 'r') as f:
+                rows = [json.loads(line) for line in f if line.strip()]
+            vectors = [row["values"] for row in rows]
+        index.add(target, [row["id"] for row in rows], [row["metadata"] for row in rows], vectors)
+    return index.build()
+
+def compare(data_dir, npy_dir, top_k=10, queries=100, nprobes=(1, 2, 4, 8, 16)):
+    # Recall@k of IVF against exact search, using stored vectors as queries
+    exact = load_local_index(data_dir, npy_dir, namespace="")
+    matrix = exact.namespaces[""]["vectors"][0]
+    rng = np.random.default_rng(0)
+    sample = matrix[rng.choice(len(matrix), size=min(queries, len(matrix)), replace=False)]
+
+    start_time = time.time()
+    truth = [{match.id for match in exact.query(vector, top_k).matches} for vector in sample]
+    results = [{"algorithm": "exact", "nprobe": None, "recall": 1.0,
+                "latency_ms": (time.time() - start_time) * 1000 / len(sample)}]
+
+    ivf = LocalIndex("ivf")
+    ivf.namespaces = {"": {key: value for key, value in exact.namespaces[""].items() if key in ("ids", "metadata", "vectors")}}
+    ivf.build()
+    for nprobe in nprobes:
+        ivf.nprobe = nprobe
+        start_time = time.time()
+        found = [{match.id for match in ivf.query(vector, top_k).matches} for vector in sample]
+        latency_ms = (time.time() - start_time) * 1000 / len(sample)
+        recall = np.mean([len(f & t) / len(t) for f, t in zip(found, truth)])
+        results.append({"algorithm": "ivf", "nprobe": nprobe, "recall": float(recall), "latency_ms": latency_ms})
+    return results
+
+def main():
+    data_root = os.path.join(os.path.dirname(__file__), "../data")
+    parser = argparse.ArgumentParser(description="Compare recall and latency of the local exact and IVF vector indexes")
+    parser.add_argument("--data-dir", default=os.path.join(data_root, "jsonl"), help="Directory with the JSONL vector files")
+    parser.add_argument("--npy-dir", default=os.path.join(data_root, "npy"), help="Directory with the npy vector files")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=100)
+    args = parser.parse_args()
+
+    print(f"{'algorithm':<10}{'nprobe':>8}{'recall@' + str(args.top_k):>12}{'latency ms':>12}")
+    for result in compare(args.data_dir, args.npy_dir, args.top_k, args.queries):
+        nprobe = "-" if result["nprobe"] is None else result["nprobe"]
+        print(f"{result['algorithm']:<10}{nprobe:>8}{result['recall']:>12.3f}{result['latency_ms']:>12.3f}")
+
+if __name__ == "__main__":
+    main()
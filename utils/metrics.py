@@ -0,0 +1,136 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# Minimal Prometheus metrics: counters, gauges and histograms with labels, rendered in the Prometheus text
+# exposition format by render(). span() times a stage into a shared histogram, counts its errors and calls the
+# span hooks, e.g. print_span or an OpenTelemetry exporter added with add_span_hook().
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_metrics = []
+_span_hooks = []
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        _metrics.append(self)
+
+    def key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def label_text(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{label}="{escape(value)}"' for label, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{self.label_text(key)} {format_value(value)}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else format_value(bound)
+                    lines.append(f"{self.name}_bucket{self.label_text(key, [('le', le)])} {cumulative}")
+                lines.append(f"{self.name}_sum{self.label_text(key)} {format_value(total)}")
+                lines.append(f"{self.name}_count{self.label_text(key)} {cumulative}")
+        return lines
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+STAGE_SECONDS = Histogram("stage_duration_seconds", "Duration of each pipeline or request stage", ["stage"])
+STAGE_ERRORS = Counter("stage_errors_total", "Stages that raised an error, e.g. a failed provider call", ["stage"])
+
+def add_span_hook(hook):
+    # hook(name, duration, attributes, error) is called when every span ends; error is None on success
+    _span_hooks.append(hook)
+
+def remove_span_hook(hook):
+    _span_hooks.remove(hook)
+
+def print_span(name, duration, attributes, error):
+    details = " ".join(f"{key}={value}" for key, value in attributes.items())
+    print(f"[span] {name} {duration * 1000:.1f} ms {details}{' error=' + repr(error) if error is not None else ''}")
+
+def record_span(name, duration, attributes=None, error=None):
+    # For stages that can't be wrapped in a with block, e.g. the time to the first streamed token
+    STAGE_SECONDS.observe(duration, stage=name)
+    if error is not None:
+        STAGE_ERRORS.inc(stage=name)
+    for hook in _span_hooks:
+        hook(name, duration, attributes or {}, error)
+
+@contextmanager
+def span(name, **attributes):
+    start_time = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as exception:
+        error = exception
+        raise
+    finally:
+        record_span(name, time.perf_counter() - start_time, attributes, error)
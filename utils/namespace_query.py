@@ -0,0 +1,44 @@
+import asyncio
+import functools
+import heapq
+import itertools
+import json
+from types import SimpleNamespace
+
+# Queries several index namespaces at once, e.g. the per-section namespaces written by data_pipeline.py
+# upsert_into_namespace, and merges their matches into one top-k result. Works with Pinecone index handles and
+# with local_index.LocalIndex, whose matches are both sorted by descending score.
+
+def metadata_filter(sections=None, scrape_dates=None):
+    # scrape_date is stored as an "%m/%d/%Y" string, so dates can only be matched exactly, not as a range
+    conditions = []
+    if sections:
+        conditions.append({"section": {"$in": list(sections)}})
+    if scrape_dates:
+        conditions.append({"scrape_date": {"$in": list(scrape_dates)}})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+def scope_key(namespaces, filter=None):
+    # Query cache scope: results are only shared between queries over the same namespaces and filter
+    return json.dumps([sorted(namespaces), filter], sort_keys=True)
+
+def merge_results(results, namespaces, top_k):
+    # k-way merge of the already sorted match lists; only the first top_k merged matches are ever compared
+    merged = heapq.merge(*(result.matches for result in results), key=lambda match: -match.score)
+    return SimpleNamespace(matches=list(itertools.islice(merged, top_k)), namespace=",".join(namespaces))
+
+def query_namespaces(index, namespaces, top_k=10, executor=None, **kwargs):
+    # With an executor the namespaces are queried concurrently instead of one round trip after another
+    if len(namespaces) == 1:
+        return index.query(namespace=namespaces[0], top_k=top_k, **kwargs)
+    query = lambda namespace: index.query(namespace=namespace, top_k=top_k, **kwargs)
+    results = list(executor.map(query, namespaces) if executor is not None else map(query, namespaces))
+    return merge_results(results, namespaces, top_k)
+
+async def aquery_namespaces(index, namespaces, top_k=10, executor=None, **kwargs):
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(executor, functools.partial(index.query, namespace=namespace, top_k=top_k, **kwargs))
+                                     for namespace in namespaces))
+    return results[0] if len(results) == 1 else merge_results(results, namespaces, top_k)
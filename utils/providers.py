@@ -0,0 +1,288 @@
+import asyncio
+import atexit
+import functools
+import json
+import multiprocessing
+import os
+import threading
+
+# Embedding and text generation providers shared by data_pipeline.py, data_query.py and the RAG sample app.
+# get_embedder() and get_generator() build the provider selected by PROVIDER (or by AWS_TITAN_ENABLED /
+# GCP_GEMINI_ENABLED) once per process and return the same object on every call. New providers, such as the
+# benchmark fakes, are added with register_provider().
+
+TITAN_MODEL = 'amazon.titan-embed-text-v1'
+CLAUDE_MODEL = 'anthropic.claude-v2:1'
+E5_MODEL = 'intfloat/multilingual-e5-large'
+GEMINI_PROJECT = os.getenv("GEMINI_PROJECT", "")
+GEMINI_LOCATION = os.getenv("GEMINI_LOCATION", "us-central1")
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "textembedding-gecko@001")
+GEMINI_TEXT_GEN_MODEL = os.getenv("GEMINI_TEXT_GEN_MODEL", "gemini-1.0-pro")
+# textembedding-gecko accepts at most 5 texts per get_embeddings call
+GEMINI_EMBED_BATCH_SIZE = int(os.getenv("GEMINI_EMBED_BATCH_SIZE", "5"))
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "16"))
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", "32"))
+# Attempts per Bedrock call with adaptive retries; latency-sensitive callers may prefer failing fast
+BEDROCK_MAX_ATTEMPTS = int(os.getenv("BEDROCK_MAX_ATTEMPTS", "20"))
+# E5 runs in this process when E5_WORKERS is 0, otherwise in a pool of worker processes
+E5_WORKERS = int(os.getenv("E5_WORKERS", "0"))
+# Torch threads per worker; 0 splits the CPU cores evenly between the workers
+E5_THREADS_PER_WORKER = int(os.getenv("E5_THREADS_PER_WORKER", "0"))
+# "int8" applies dynamic int8 quantization to the model's linear layers
+E5_QUANTIZE = os.getenv("E5_QUANTIZE", "")
+
+def model_args(query):
+    query_model_args = {"prompt": query, "max_tokens_to_sample": 1000, "stop_sequences": [], "temperature": 0.0, "top_p": 0.9 }
+    return query_model_args
+
+def create_bedrock_connection(max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS):
+    import boto3
+    from botocore.config import Config
+    config = Config(connect_timeout=5, read_timeout=60, retries={"total_max_attempts": BEDROCK_MAX_ATTEMPTS, "mode": "adaptive"},
+                    max_pool_connections=max_pool_connections)
+    region = 'us-east-1'
+    bedrock = boto3.client(
+                service_name='bedrock-runtime',
+                region_name=region,
+                endpoint_url=f'https://bedrock-runtime.{region}.amazonaws.com',
+                                    config=config)
+    return bedrock
+
+@functools.lru_cache(maxsize=None)
+def shared_bedrock_connection():
+    # One client, and so one connection pool, for both Titan embeddings and Claude generation
+    return create_bedrock_connection()
+
+@functools.lru_cache(maxsize=None)
+def init_vertexai():
+    import vertexai
+    vertexai.init(project=GEMINI_PROJECT, location=GEMINI_LOCATION)
+
+class Embedder:
+    model_name = None
+    # Largest number of texts the provider accepts in one request
+    batch_size = 1
+
+    def embed(self, text):
+        return self.embed_batch([text])[0]
+
+    def embed_batch(self, texts):
+        raise NotImplementedError
+
+    async def aembed(self, text, executor=None):
+        return (await self.aembed_batch([text], executor))[0]
+
+    async def aembed_batch(self, texts, executor=None):
+        return await asyncio.get_running_loop().run_in_executor(executor, self.embed_batch, texts)
+
+class Generator:
+    model_name = None
+    # Sampling arguments sent with every prompt; part of the answer cache key
+    generation_args = {}
+
+    def stream(self, prompt):
+        raise NotImplementedError
+
+    def generate(self, prompt):
+        return ''.join(self.stream(prompt))
+
+    async def agenerate(self, prompt, executor=None):
+        return await asyncio.get_running_loop().run_in_executor(executor, self.generate, prompt)
+
+    async def astream(self, prompt, executor=None):
+        # Pulls one chunk at a time from the blocking stream on the executor, yielding each as soon as it arrives
+        loop = asyncio.get_running_loop()
+        iterator = self.stream(prompt)
+        done = object()
+        while True:
+            text = await loop.run_in_executor(executor, next, iterator, done)
+            if text is done:
+                break
+            yield text
+
+class TitanEmbedder(Embedder):
+    model_name = TITAN_MODEL
+
+    def __init__(self, bedrock):
+        self.bedrock = bedrock
+
+    def embed_batch(self, texts):
+        # Titan embeds one input per request, so only the client is shared
+        application_json = 'application/json'
+        embeddings = []
+        for text in texts:
+            body = json.dumps({"inputText": text})
+            response = self.bedrock.invoke_model(body=body, modelId=TITAN_MODEL, accept=application_json, contentType=application_json)
+            response_body = json.loads(response['body'].read())
+            embeddings.append(response_body.get('embedding'))
+        return embeddings
+
+class ClaudeGenerator(Generator):
+    model_name = CLAUDE_MODEL
+    generation_args = {key: value for key, value in model_args("").items() if key != "prompt"}
+
+    def __init__(self, bedrock):
+        self.bedrock = bedrock
+
+    def stream(self, prompt):
+        import botocore
+        try:
+            body = json.dumps(model_args(prompt))
+            response = self.bedrock.invoke_model_with_response_stream(body=body, modelId=CLAUDE_MODEL, accept="*/*", contentType="application/json")
+            stream = response.get('body')
+            if stream:
+                for event in stream:
+                    chunk = event.get('chunk')
+                    if chunk:
+                        chunk_obj = json.loads(chunk.get('bytes').decode())
+                        yield chunk_obj['completion']
+        except botocore.exceptions.ClientError as error:
+            if error.response['Error']['Code'] == 'AccessDeniedException':
+                print(f"\x1b[41m{error.response['Error']['Message']}\
+                        \nTo troubeshoot this issue please refer to the following resources.\
+                        \nhttps://docs.aws.amazon.com/IAM/latest/UserGuide/troubleshoot_access-denied.html\
+                        \nhttps://docs.aws.amazon.com/bedrock/latest/userguide/security-iam.html\x1b[0m\n")
+            else:
+                raise error
+
+class GeminiEmbedder(Embedder):
+    model_name = GEMINI_MODEL
+    batch_size = GEMINI_EMBED_BATCH_SIZE
+
+    def __init__(self):
+        self._model = None
+
+    @property
+    def model(self):
+        if self._model is None:
+            from vertexai.language_models import TextEmbeddingModel
+            init_vertexai()
+            self._model = TextEmbeddingModel.from_pretrained(GEMINI_MODEL)
+        return self._model
+
+    def embed_batch(self, texts):
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            embeddings.extend(response.values for response in self.model.get_embeddings(texts[i:i+self.batch_size]))
+        return embeddings
+
+class GeminiGenerator(Generator):
+    model_name = GEMINI_TEXT_GEN_MODEL
+
+    def __init__(self):
+        self._model = None
+
+    def stream(self, prompt):
+        if self._model is None:
+            from vertexai.generative_models import GenerativeModel
+            init_vertexai()
+            self._model = GenerativeModel(GEMINI_TEXT_GEN_MODEL)
+        for response in self._model.generate_content(prompt, stream=True):
+            yield response.text
+
+class E5Embedder(Embedder):
+    batch_size = EMBED_BATCH_SIZE
+
+    def __init__(self, workers=E5_WORKERS, threads_per_worker=E5_THREADS_PER_WORKER):
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // max(workers, 1))
+        self._pool = None
+
+    @property
+    def model_name(self):
+        # Quantized embeddings differ slightly, so they are reported under their own model name
+        return f"{E5_MODEL}:{E5_QUANTIZE}" if E5_QUANTIZE else E5_MODEL
+
+    def embed_batch(self, texts):
+        embeddings = [None] * len(texts)
+        # Batch texts of similar length together to keep padding to a minimum
+        order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+        batch_orders = [order[i:i+self.batch_size] for i in range(0, len(order), self.batch_size)]
+        batch_texts = [[texts[i] for i in batch_order] for batch_order in batch_orders]
+        # imap hands the batches to the workers in parallel but returns the results in submission order
+        results = self.pool.imap(e5_embed_batch, batch_texts) if self.workers > 0 else map(e5_embed_batch, batch_texts)
+        for batch_order, batch_embeddings in zip(batch_orders, results):
+            for i, embedding in zip(batch_order, batch_embeddings):
+                embeddings[i] = embedding
+        return embeddings
+
+    @property
+    def pool(self):
+        # Each worker loads the model once and then takes batches from the pool's shared task queue
+        if self._pool is None:
+            self._pool = multiprocessing.get_context("spawn").Pool(self.workers, initializer=init_e5_worker, initargs=(self.threads_per_worker,))
+            atexit.register(self._pool.terminate)
+        return self._pool
+
+@functools.lru_cache(maxsize=None)
+def load_e5_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(E5_MODEL)
+
+@functools.lru_cache(maxsize=None)
+def load_e5_model():
+    import torch
+    from transformers import AutoModel
+    model = AutoModel.from_pretrained(E5_MODEL)
+    model.eval()
+    if E5_QUANTIZE == "int8":
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+def init_e5_worker(threads):
+    import torch
+    torch.set_num_threads(threads)
+    load_e5_model()
+
+def e5_embed_batch(texts):
+    import torch
+    model, tokenizer = load_e5_model(), load_e5_tokenizer()
+    with torch.inference_mode():
+        tokens = tokenizer(texts, return_tensors='pt', padding=True, truncation=True, max_length=512)
+        outputs = model(**tokens)
+        # Average over real tokens only so padding added for batching doesn't change the embedding
+        mask = tokens['attention_mask'].unsqueeze(-1).to(outputs.last_hidden_state.dtype)
+        pooled = (outputs.last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+        return pooled.tolist()
+
+_providers = {}
+_instances = {}
+_lock = threading.Lock()
+
+def register_provider(name, embedder=None, generator=None):
+    # embedder and generator are factories called at most once, on first use
+    with _lock:
+        _providers[name] = {"embedder": embedder, "generator": generator}
+        _instances.pop((name, "embedder"), None)
+        _instances.pop((name, "generator"), None)
+
+def default_provider():
+    provider = os.getenv("PROVIDER")
+    if provider:
+        return provider
+    if os.getenv("AWS_TITAN_ENABLED", "false").lower() == 'true':
+        return "bedrock"
+    if os.getenv("GCP_GEMINI_ENABLED", "false").lower() == 'true':
+        return "gemini"
+    return "e5"
+
+def get_embedder(name=None):
+    return _get_instance(name or default_provider(), "embedder")
+
+def get_generator(name=None):
+    return _get_instance(name or default_provider(), "generator")
+
+def _get_instance(name, kind):
+    with _lock:
+        if (name, kind) not in _instances:
+            factory = _providers.get(name, {}).get(kind)
+            if factory is None:
+                raise ValueError(f"No {kind} is registered for provider: {name}")
+            _instances[(name, kind)] = factory()
+        return _instances[(name, kind)]
+
+register_provider("bedrock",
+                  embedder=lambda: TitanEmbedder(shared_bedrock_connection()),
+                  generator=lambda: ClaudeGenerator(shared_bedrock_connection()))
+register_provider("gemini", embedder=GeminiEmbedder, generator=GeminiGenerator)
+register_provider("e5", embedder=E5Embedder)
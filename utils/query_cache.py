@@ -0,0 +1,79 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+class QueryCache:
+    # Two-level retrieval cache. Level one maps the normalized query text to its embedding and matches. Level two
+    # returns the matches of a cached query whose embedding is within max_distance (cosine) of a new query
+    # embedding. Entries expire after ttl seconds and the least recently used entry is evicted beyond max_size.
+
+    def __init__(self, max_size=1024, ttl=300, max_distance=0.02):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.hits = {"exact": 0, "semantic": 0, "miss": 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._keys = None
+        self._matrix = None
+
+    def get(self, query, scope=None):
+        # Returns (embedding, result) for an exact match, or None
+        key = (scope, normalize_query(query))
+        with self._lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            self.hits["exact"] += 1
+            return entry["embedding"], entry["result"]
+
+    def get_similar(self, embedding, scope=None):
+        # Returns the result of the closest cached query in the same scope, or None if none is close enough
+        with self._lock:
+            if self.max_distance > 0 and self._entries:
+                keys, matrix = self._similarity_matrix()
+                vector = np.asarray(embedding, dtype=np.float32)
+                similarities = matrix @ (vector / (np.linalg.norm(vector) or 1.0))
+                for row in np.argsort(-similarities):
+                    if 1 - similarities[row] > self.max_distance:
+                        break
+                    entry = self._live_entry(keys[row])
+                    if entry is not None and keys[row][0] == scope:
+                        self._entries.move_to_end(keys[row])
+                        self.hits["semantic"] += 1
+                        return entry["result"]
+            self.hits["miss"] += 1
+            return None
+
+    def put(self, query, embedding, result, scope=None):
+        key = (scope, normalize_query(query))
+        vector = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._entries[key] = {"embedding": embedding,
+                                  "unit": vector / (np.linalg.norm(vector) or 1.0),
+                                  "result": result,
+                                  "expires_at": time.monotonic() + self.ttl}
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._keys = None
+
+    def _live_entry(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry["expires_at"] < time.monotonic():
+            del self._entries[key]
+            self._keys = None
+            return None
+        return entry
+
+    def _similarity_matrix(self):
+        # Rebuilt lazily after the cached keys change; bounded by max_size rows
+        if self._keys is None:
+            self._keys = list(self._entries)
+            self._matrix = np.stack([self._entries[key]["unit"] for key in self._keys])
+        return self._keys, self._matrix
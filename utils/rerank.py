@@ -0,0 +1,97 @@
+import functools
+import re
+import numpy as np
+
+# Reranking between index.query and the prompt: dense scores are optionally fused with BM25 scores computed over
+# the retrieved chunks, near-duplicate chunks are dropped with maximal marginal relevance (MMR), and the result
+# is packed into a token budget. Everything works on the ~10 retrieved matches, so it adds well under a
+# millisecond per query.
+
+WORD_PATTERN = re.compile(r"\w+")
+# Words and punctuation marks, a rough stand-in for LLM tokenizer tokens
+LLM_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+@functools.lru_cache(maxsize=16384)
+def tokenize(text):
+    return tuple(WORD_PATTERN.findall(text.lower()))
+
+@functools.lru_cache(maxsize=16384)
+def count_tokens(text):
+    return len(LLM_TOKEN_PATTERN.findall(text))
+
+def term_matrix(token_lists):
+    # Term counts as a dense (documents x vocabulary) matrix; the vocabulary of a few chunks is small
+    vocabulary = {}
+    rows, columns = [], []
+    for row, tokens in enumerate(token_lists):
+        for token in tokens:
+            columns.append(vocabulary.setdefault(token, len(vocabulary)))
+            rows.append(row)
+    matrix = np.zeros((len(token_lists), len(vocabulary)), dtype=np.float32)
+    np.add.at(matrix, (rows, columns), 1)
+    return matrix, vocabulary
+
+def bm25_scores(query_tokens, matrix, vocabulary, k1=1.5, b=0.75):
+    columns = [vocabulary[token] for token in set(query_tokens) if token in vocabulary]
+    if not columns:
+        return np.zeros(len(matrix), dtype=np.float32)
+    lengths = matrix.sum(axis=1, keepdims=True)
+    frequencies = matrix[:, columns]
+    document_frequencies = (frequencies > 0).sum(axis=0)
+    idf = np.log(1 + (len(matrix) - document_frequencies + 0.5) / (document_frequencies + 0.5))
+    saturation = frequencies * (k1 + 1) / (frequencies + k1 * (1 - b + b * lengths / max(lengths.mean(), 1)))
+    return (idf * saturation).sum(axis=1)
+
+def min_max(scores):
+    spread = scores.max() - scores.min()
+    return (scores - scores.min()) / spread if spread > 0 else np.zeros_like(scores)
+
+def normalize_rows(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def mmr(relevance, similarity, top_n, mmr_lambda):
+    # Greedily picks the chunk with the best trade-off between relevance and similarity to the chunks already picked
+    selected = []
+    remaining = np.ones(len(relevance), dtype=bool)
+    max_similarity = np.zeros(len(relevance), dtype=np.float32)
+    while remaining.any() and len(selected) < top_n:
+        scores = np.where(remaining, mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity, -np.inf)
+        best = int(np.argmax(scores))
+        selected.append(best)
+        remaining[best] = False
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return selected
+
+def rerank(query, matches, top_n=5, alpha=0.7, mmr_lambda=0.7):
+    # alpha weights the dense scores against BM25 (1.0 disables BM25); mmr_lambda weights relevance against
+    # redundancy (1.0 keeps the relevance order). Matches need metadata["text"]; if they carry their vector
+    # values, redundancy is measured on them, otherwise on the chunks' term counts.
+    if not matches:
+        return []
+    token_lists = [tokenize(match.metadata["text"]) for match in matches]
+    matrix, vocabulary = term_matrix(token_lists)
+    relevance = min_max(np.array([match.score for match in matches], dtype=np.float32))
+    if alpha < 1:
+        relevance = alpha * relevance + (1 - alpha) * min_max(bm25_scores(tokenize(query), matrix, vocabulary))
+    if all(len(getattr(match, "values", None) or []) for match in matches):
+        vectors = normalize_rows(np.array([match.values for match in matches], dtype=np.float32))
+    else:
+        vectors = normalize_rows(matrix)
+    similarity = vectors @ vectors.T
+    return [matches[i] for i in mmr(relevance, similarity, top_n, mmr_lambda)]
+
+def pack_context(texts, max_tokens=512, separator="\n"):
+    # Adds texts in rank order while they fit; a text that would overflow the budget is skipped, not truncated,
+    # so a later shorter chunk can still use the remaining space
+    chosen = []
+    used = 0
+    for text in texts:
+        text = text.strip()
+        tokens = count_tokens(text)
+        if used + tokens > max_tokens:
+            continue
+        chosen.append(text)
+        used += tokens
+    return separator.join(chosen)
@@ -0,0 +1,78 @@
+import json
+import os
+import itertools
+import numpy as np
+
+# Vectors are stored as a 2-D .npy matrix next to a .meta.jsonl file holding the id and metadata of each row.
+# int8 matrices are scalar quantized per dimension, with the scales in a .scale.npy file.
+VECTOR_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+def vector_file_paths(directory, name):
+    return os.path.join(directory, f"{name}.npy"), os.path.join(directory, f"{name}.meta.jsonl")
+
+def scale_file_path(directory, name):
+    return os.path.join(directory, f"{name}.scale.npy")
+
+def list_vector_files(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(filename[:-len(".npy")] for filename in os.listdir(directory)
+                  if filename.endswith(".npy") and not filename.endswith(".scale.npy"))
+
+def remove_vector_file(directory, name):
+    npy_path, meta_path = vector_file_paths(directory, name)
+    for path in (npy_path, meta_path, scale_file_path(directory, name)):
+        if os.path.exists(path):
+            os.remove(path)
+
+def quantize(matrix):
+    # Symmetric int8 quantization with one scale per dimension, so low-variance dimensions keep their precision
+    max_abs = np.abs(matrix).max(axis=0) if len(matrix) else np.ones(matrix.shape[1], dtype=np.float32)
+    scale = (127 / np.where(max_abs > 0, max_abs, 1)).astype(np.float32)
+    return np.clip(np.rint(matrix * scale), -127, 127).astype(np.int8), scale
+
+def dequantize(matrix, scale):
+    return matrix.astype(np.float32) / scale
+
+def write_vector_file(directory, name, records, dtype="float32"):
+    os.makedirs(directory, exist_ok=True)
+    npy_path, meta_path = vector_file_paths(directory, name)
+    if records:
+        matrix = np.asarray([record['values'] for record in records], dtype=np.float32 if dtype == "int8" else VECTOR_DTYPES[dtype])
+    else:
+        matrix = np.empty((0, 0), dtype=VECTOR_DTYPES[dtype])
+    scale_path = scale_file_path(directory, name)
+    if dtype == "int8" and records:
+        matrix, scale = quantize(matrix)
+        with open(scale_path + ".tmp", 'wb') as f:
+            np.save(f, scale)
+        os.replace(scale_path + ".tmp", scale_path)
+    elif os.path.exists(scale_path):
+        os.remove(scale_path)
+
+    # Write to temporary files and rename so readers never see a half written matrix
+    with open(npy_path + ".tmp", 'wb') as f:
+        np.save(f, matrix)
+    with open(meta_path + ".tmp", 'w') as f:
+        for record in records:
+            f.write(json.dumps({"id": record['id'], "metadata": record['metadata']}) + '\n')
+    os.replace(npy_path + ".tmp", npy_path)
+    os.replace(meta_path + ".tmp", meta_path)
+
+def load_vectors(directory, name):
+    # Memory-mapped, so rows are only read from disk when they are accessed. int8 matrices are dequantized to
+    # float32 in memory instead.
+    npy_path, _ = vector_file_paths(directory, name)
+    matrix = np.load(npy_path, mmap_mode='r')
+    if matrix.dtype == np.int8 and matrix.size:
+        return dequantize(matrix, np.load(scale_file_path(directory, name)))
+    return matrix
+
+def iter_vector_records(directory, name, limit=None):
+    vectors = load_vectors(directory, name)
+    _, meta_path = vector_file_paths(directory, name)
+    with open(meta_path, 'r') as f:
+        for row, line in enumerate(itertools.islice(f, limit)):
+            record = json.loads(line)
+            record['values'] = vectors[row]
+            yield record